@@ -36,6 +36,10 @@ Pyhop provides the following classes and functions:
 
 - print_state(foo) will print the variables and values in the state foo.
 
+- declare_static(foo, 'var1', ...) tells Pyhop that no operator ever writes
+  foo.var1, ...; they are frozen and shared by every copy of the state, while
+  the other dicts of foo are only copied when an operator writes to them.
+
 - print_goal(foo) will print the variables and values in the goal foo.
 
 - declare_operators(o1, o2, ..., ok) tells Pyhop that o1, o2, ..., ok
@@ -50,6 +54,11 @@ Pyhop provides the following classes and functions:
 
 - print_methods() will print out a list of all declared methods.
 
+- d = Domain('d') creates a domain with its own operators and methods:
+  d.declare_operators(...), d.declare_methods('foo', ...) and
+  Planner(d).plan(state1,tasklist) work like the functions above and below,
+  which use the default domain. A Planner can be used by many threads.
+
 - pyhop(state1,tasklist) tells Pyhop to find a plan for accomplishing tasklist
   (a list of tasks), starting from an initial state state1, using whatever
   methods and operators you declared previously.
@@ -60,6 +69,69 @@ Pyhop provides the following classes and functions:
 - if verbose = 1, it prints the initial parameters and the answer;
 - if verbose = 2, it also prints a message on each recursive call;
 - if verbose = 3, it also prints info about what it's computing.
+
+- add_trace_listener(f) makes Pyhop call f(event, fields) for each step of
+  the search (see "Tracing" below); JsonLinesSink(path) is a listener that
+  writes the events to a JSON-lines file, and remove_trace_listener(f)
+  detaches a listener. With no listener attached tracing costs nothing.
+
+- st = PlanStats(); pyhop(state1,tasklist,stats=st) fills st with the number
+  of nodes expanded, backtracks and maximum depth, applications and failures
+  of each operator, attempts and successes of each method, and the time
+  spent copying states, in operators and in methods; print(st) shows them.
+
+- pyhop(state1,tasklist,iterative=True) uses seek_plan_iterative, which finds
+  the same plans as the recursive seek_plan without Python's recursion limit.
+
+- pyhop(state1,tasklist,in_place=True) searches on a single working copy of
+  state1: operators mutate it directly, every write to its dicts and lists
+  and every rebinding of its variables (state.x = ...) is recorded in a
+  Trail, and the writes are undone when the search backtracks. Only the
+  final state that is returned gets copied. Writes to other mutable
+  objects (sets, instances of other classes) are not recorded, so domains
+  that mutate them in place should not use in_place.
+
+- schema = Schema('s', spaces, fluents); state2 = schema.compact(state1)
+  gives a compact version of state1: a __slots__ object whose dict-valued
+  variables (fluents) are arrays indexed by interned ids of their keys (and
+  values). Domain code reads and writes them like dicts, and copying a
+  compact state costs one array copy per fluent.
+
+- pyhop(state1,tasklist,memo_size=n) also remembers up to n search nodes
+  (state, remaining tasks) whose search failed, identified by an incremental
+  Zobrist hash of the state, and doesn't search them again.
+
+- pyhop(state1,tasklist,budget=Budget(time_limit=..., max_nodes=...,
+  max_depth=..., cancel=...)) bounds the search; when a limit is reached
+  it returns a BudgetExhausted (false, like []) whose reason says which.
+
+- for plan in pyhop_iter(state1,tasklist): ... generates the plans one by
+  one, lazily: each next plan resumes the search where the last one was
+  found, so rejecting a plan doesn't mean planning again from scratch.
+
+- declare_costs(op1=c1, ...) gives the operators costs (numbers, or
+  functions called like the operators); pyhop_optimize(state1,tasklist)
+  returns the cheapest plan, as [plan, final state, cost], and with a
+  budget the cheapest one found in time.
+
+- pyhop_parallel(state1,tasklist) searches the alternatives of the first
+  few choice points in worker processes; it returns the plan pyhop would
+  (or, with first_found=True, whichever plan is found first).
+
+- cache = PlanCache('plans.db'); pyhop(state1,tasklist,cache=cache) answers
+  problems solved before (by any process using the file) without searching;
+  the cache is keyed by a canonical digest of state1, tasklist and the
+  domain, and keeps the max_entries most recently used plans.
+
+- validate_plan(state1,plan) replays plan on one copy-on-write copy of
+  state1 and returns a ValidationResult that is true if every action
+  applied, or tells the first action that failed and why (using the
+  functions given to declare_preconditions); validate_plans checks many
+  plans against the same state in one call.
+
+- plan_batch([(state1,tasklist1), ...]) solves many problems in a pool of
+  worker processes and yields a BatchResult (plan, time, error) for each,
+  in order or as they complete.
 """
 
 # Pyhop's planning algorithm is very similar to the one in SHOP and JSHOP
@@ -101,15 +173,39 @@ Pyhop provides the following classes and functions:
 
 
 import copy
+import hashlib
+import importlib
+import json
+import os
+import pickle
+import threading
+import time
+import traceback
+import tracemalloc
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from operator import is_
 
 
 ############################################################
 # States and goals
 
+def state_variables(obj):
+    """Return the (name, value) pairs of the variables of a state or goal."""
+    if isinstance(obj, CompactState):
+        return obj.variables()
+    return [(name, val) for name, val in vars(obj).items() if name != '__name__']
+
+
 def to_string(obj):
     if not obj:
         return "False"
-    return " ".join(f"{obj.__name__}.{name} = {val}" for name, val in vars(obj).items() if name != '__name__')
+    return " ".join(f"{obj.__name__}.{name} = {val}" for name, val in state_variables(obj))
 
 
 class State:
@@ -143,9 +239,8 @@ class Goal:
 def print_state(state, indent=4):
     """Print each variable in state, indented by indent spaces."""
     if state:
-        for name, val in vars(state).items():
-            if name != '__name__':
-                print(' ' * indent + f"{state.__name__}.{name} = {val}")
+        for name, val in state_variables(state):
+            print(' ' * indent + f"{state.__name__}.{name} = {val}")
     else:
         print('False')
 
@@ -161,132 +256,3202 @@ def print_goal(goal, indent=4):
 
 
 ############################################################
-# Helper functions that may be useful in domain models
+# Static and dynamic state variables
+#
+# declare_static(state, 'var1', ...) freezes variables that operators never
+# write. Frozen values are shared by reference by every copy of the state.
+# The remaining (dynamic) dicts are copied on write: copy_state gives the
+# new state a CowDict that reads through to the old dict until the first
+# write, and only then copies it.
 
-def forall(seq, cond):
-    """Return True if cond(x) holds for all x in seq, otherwise False."""
-    return all(cond(x) for x in seq)
+def _read_only(self, *args, **kwargs):
+    raise TypeError(f"static state variable of type {type(self).__name__} is read-only")
 
 
-def find_if(cond, seq):
+class FrozenDict(dict):
+    """A read-only dict that is shared, not copied, by copy and deepcopy."""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    pop = popitem = setdefault = update = clear = _read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+class FrozenList(list):
+    """A read-only list that is shared, not copied, by copy and deepcopy."""
+
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+def freeze(value):
+    """Return a read-only version of value, freezing nested dicts, lists and sets."""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value
+    if isinstance(value, (dict, CowDict)):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+def is_static(value):
+    return isinstance(value, (FrozenDict, FrozenList))
+
+
+def declare_static(state, *names):
     """
-    Return the first element in seq such that cond(element) holds.
-    If no such element is found, return None.
+    Freeze the variables names of state, telling Pyhop that no operator
+    writes them, so that copies of state can share them by reference.
     """
-    return next((x for x in seq if cond(x)), None)
+    for name in names:
+        setattr(state, name, freeze(getattr(state, name)))
+    return state
 
 
-############################################################
-# Commands to tell Pyhop what the operators and methods are
+_ATOMIC_TYPES = frozenset((str, int, float, bool, type(None), frozenset))
 
-operators = {}
-methods = {}
 
+def _copy_value(val):
+    return val if type(val) in _ATOMIC_TYPES else copy.deepcopy(val)
 
-def declare_operators(*op_list):
+
+class CowDict(MutableMapping):
     """
-    Call this after defining the operators, to tell Pyhop what they are.
-    op_list must be a list of functions, not strings.
+    A copy-on-write view of a dict. Reads go to base until the first write,
+    which replaces base by a copy of it and turns the CowDict into an
+    OwnedDict. base must not be written while CowDicts read through to it;
+    the planner guarantees this because it never writes a state it has
+    copied. CowDicts are mappings but not dicts, so code that needs a real
+    dict (json, for one) rejects them instead of seeing an empty dict;
+    convert with dict(d) first.
     """
-    for op in op_list:
-        if not callable(op):
-            raise ValueError(f"Operator {op} is not callable")
-        operators[op.__name__] = op
-    return operators
 
+    __slots__ = ('base',)
 
-def declare_methods(task_name, *method_list):
+    def __init__(self, base):
+        self.base = base
+
+    def _own(self):
+        self.base = {k: _copy_value(v) for k, v in self.base.items()}
+        self.__class__ = OwnedDict
+
+    # Reads
+
+    def __getitem__(self, key):
+        return self.base[key]
+
+    def __contains__(self, key):
+        return key in self.base
+
+    def __iter__(self):
+        return iter(self.base)
+
+    def __reversed__(self):
+        return reversed(self.base)
+
+    def __len__(self):
+        return len(self.base)
+
+    def __eq__(self, other):
+        return self.base == (other.base if isinstance(other, CowDict) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.base)
+
+    def __or__(self, other):
+        return dict(self.base) | (other.base if isinstance(other, CowDict) else other)
+
+    def __ror__(self, other):
+        return other | self.base
+
+    def get(self, key, default=None):
+        return self.base.get(key, default)
+
+    def keys(self):
+        return self.base.keys()
+
+    def values(self):
+        return self.base.values()
+
+    def items(self):
+        return self.base.items()
+
+    def copy(self):
+        return dict(self.base)
+
+    # Writes
+
+    def __setitem__(self, key, value):
+        self._own()
+        self.base[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        del self.base[key]
+
+    def __ior__(self, other):
+        self._own()
+        self.base.update(other)
+        return self
+
+    def pop(self, *args):
+        self._own()
+        return self.base.pop(*args)
+
+    def popitem(self):
+        self._own()
+        return self.base.popitem()
+
+    def setdefault(self, key, default=None):
+        self._own()
+        return self.base.setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self._own()
+        self.base.update(*args, **kwargs)
+
+    def clear(self):
+        self._own()
+        self.base.clear()
+
+    # Copies
+
+    def __copy__(self):
+        return dict(self.base)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.base, memo)
+
+    def __reduce__(self):
+        return dict, (dict(self.base),)
+
+
+class OwnedDict(CowDict):
+    """A CowDict after its first write: base is its own dict, written directly."""
+
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        self.base[key] = value
+
+    def __delitem__(self, key):
+        del self.base[key]
+
+    def __ior__(self, other):
+        self.base.update(other)
+        return self
+
+    def pop(self, *args):
+        return self.base.pop(*args)
+
+    def popitem(self):
+        return self.base.popitem()
+
+    def setdefault(self, key, default=None):
+        return self.base.setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.base.update(*args, **kwargs)
+
+    def clear(self):
+        self.base.clear()
+
+
+def copy_state(state):
     """
-    Call this once for each task, to tell Pyhop what the methods are.
-    task_name must be a string.
-    method_list must be a list of functions, not strings.
+    Return a copy of state for an operator to modify. Static variables are
+    shared, dynamic dicts are copied on write and anything else is deep-copied.
     """
-    if not isinstance(task_name, str):
-        raise ValueError("Task name must be a string")
-    for method in method_list:
-        if not callable(method):
-            raise ValueError(f"Method {method} is not callable")
-    methods[task_name] = list(method_list)
-    return methods[task_name]
+    if isinstance(state, CompactState):
+        return state.clone()
+    new = object.__new__(type(state))
+    new_vars = new.__dict__
+    for name, val in state.__dict__.items():
+        cls = type(val)
+        if cls is CowDict or cls is OwnedDict:
+            new_vars[name] = CowDict(val.base)
+        elif cls is dict:
+            new_vars[name] = CowDict(val)
+        elif cls is FrozenDict or cls is FrozenList or cls in _ATOMIC_TYPES:
+            new_vars[name] = val
+        else:
+            new_vars[name] = copy.deepcopy(val)
+    return new
+
+
+def detach_state(state):
+    """Replace the CowDicts of state by plain dicts that no longer share items."""
+    for name, val in state_variables(state):
+        if isinstance(val, CowDict):
+            setattr(state, name, copy.deepcopy(val.base))
+    return state
 
 
 ############################################################
-# Commands to find out what the operators and methods are
+# Compact states
+#
+# A Schema describes the states of a domain: spaces of names (drivers,
+# locations, ...) and fluents, the dict-valued state variables whose keys
+# are the names of one space. schema.compact(state) returns an equivalent
+# CompactState, an instance of a class with __slots__ in which each fluent
+# is a FluentMap: an array indexed by the interned id of each key. If the
+# values of a fluent are names from declared spaces, the array holds their
+# ids too (InternedFluentMap); otherwise it is a list of the values.
+# FluentMaps read and write like dicts, so domain code works unchanged.
+# Copying one copies a single array, so copy_state clones compact states
+# instead of copying them on write, and they compare and hash by value.
+# Reading a FluentMap is slower than reading a dict: compact states pay off
+# when states are big and copied often rather than when they are read a lot.
 
-def print_operators(olist=operators):
-    """Print out a list of available operators."""
-    print(f"{'OPERATORS: '}{', '.join(olist)}")
+class _Space:
+    """The names of one or more spaces, in order, and their ids."""
 
+    def __init__(self, names):
+        self.names = FrozenList(names)
+        self.ids = FrozenDict((name, i) for i, name in enumerate(self.names))
+        if len(self.ids) != len(self.names):
+            raise ValueError("The names of a space must be unique")
 
-def print_methods(mlist=methods):
-    """Print out a table of what the methods are for each task"""
-    max_task_length = max(len(task) for task in mlist) if mlist else 4
-    print(f"{'TASK':<{max_task_length}} | METHODS")
-    for task in mlist:
-        print(f"{task:<{max_task_length + 1}}{'| '}{', '.join(f.__name__ for f in mlist[task])}")
+    def __eq__(self, other):
+        return self is other or (type(other) is _Space and self.names == other.names)
+
+    def __hash__(self):
+        return hash(tuple(self.names))
+
+
+class _EmptySlot:
+    """The value of the keys of a FluentMap that have no value."""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return '_EMPTY_SLOT'
+
+    def __repr__(self):
+        return '<empty>'
+
+
+_EMPTY_SLOT = _EmptySlot()
+
+
+class FluentMap:
+    """
+    A fluent of a CompactState: a dict-like map from the names of a fixed
+    key space to values, stored as a list indexed by key id. Values are
+    shared by copies, so operators must replace them (e.g. frozensets),
+    not modify them in place.
+    """
+
+    __slots__ = ('key_space', 'index', 'data', 'trail', 'path')
+    _EMPTY = _EMPTY_SLOT
+
+    def __init__(self, key_space, data, trail=None, path=None):
+        self.key_space = key_space
+        self.index = key_space.ids
+        self.data = data
+        self.trail = trail
+        self.path = path
+
+    @classmethod
+    def from_items(cls, key_space, items, *args):
+        fluent = cls(key_space, cls._empty_data(len(key_space.names)), *args)
+        for key, value in items:
+            fluent.data[fluent._key_id(key)] = fluent._encode(value)
+        return fluent
+
+    @classmethod
+    def _empty_data(cls, n):
+        return [cls._EMPTY] * n
+
+    def _key_id(self, key):
+        i = self.index.get(key)
+        if i is None:
+            raise KeyError(f"{key!r} is not in the key space of this fluent")
+        return i
+
+    def _encode(self, value):
+        return value
+
+    def _decode(self, raw):
+        return raw
+
+    def _value(self, raw):
+        return _MISSING if raw is self._EMPTY else self._decode(raw)
+
+    # Reads
+
+    def __getitem__(self, key):
+        raw = self.data[self.index[key]]
+        if raw is self._EMPTY:
+            raise KeyError(key)
+        return raw
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        if i is None:
+            return default
+        raw = self.data[i]
+        return default if raw is self._EMPTY else self._decode(raw)
+
+    def __contains__(self, key):
+        i = self.index.get(key)
+        return i is not None and self.data[i] is not self._EMPTY
+
+    def __iter__(self):
+        empty = self._EMPTY
+        return (key for key, raw in zip(self.key_space.names, self.data) if raw is not empty)
+
+    def __len__(self):
+        empty = self._EMPTY
+        return sum(1 for raw in self.data if raw is not empty)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        empty = self._EMPTY
+        decode = self._decode
+        return [(key, decode(raw)) for key, raw in zip(self.key_space.names, self.data) if raw is not empty]
+
+    def copy(self):
+        return dict(self.items())
+
+    def _same_layout(self, other):
+        return self.key_space == other.key_space
+
+    def __eq__(self, other):
+        if type(other) is type(self) and self._same_layout(other):
+            return self.data == other.data
+        if isinstance(other, (dict, CowDict, FluentMap)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    # Writes, logged in trail if there is one
+
+    def _log(self, i, key, value):
+        trail = self.trail
+        old = self.data[i]
+        trail.entries.append((self, i, old))
+        if trail.hashing:
+            trail.hash ^= _zobrist(self.path, key, self._value(old)) ^ _zobrist(self.path, key, value)
+
+    def __setitem__(self, key, value):
+        i = self._key_id(key)
+        raw = self._encode(value)
+        if self.trail is not None:
+            self._log(i, key, value)
+        self.data[i] = raw
+
+    def __delitem__(self, key):
+        i = self.index[key]
+        if self.data[i] is self._EMPTY:
+            raise KeyError(key)
+        if self.trail is not None:
+            self._log(i, key, _MISSING)
+        self.data[i] = self._EMPTY
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def _restore(self, i, old):
+        trail = self.trail
+        if trail.hashing:
+            key = self.key_space.names[i]
+            trail.hash ^= (_zobrist(self.path, key, self._value(self.data[i])) ^
+                           _zobrist(self.path, key, self._value(old)))
+        self.data[i] = old
+
+    # Copies
+
+    def clone(self):
+        """Return a copy of this FluentMap that logs no writes."""
+        new = object.__new__(FluentMap)
+        new.key_space = self.key_space
+        new.index = self.index
+        new.data = self.data[:]
+        new.trail = new.path = None
+        return new
+
+    def __copy__(self):
+        return self.clone()
+
+    def __deepcopy__(self, memo):
+        new = self.clone()
+        new.data = copy.deepcopy(self.data, memo)
+        return new
+
+    def __reduce__(self):
+        return _fluent_map, (type(self), self.key_space, self.data) + self._reduce_args()
+
+    def _reduce_args(self):
+        return ()
+
+
+class InternedFluentMap(FluentMap):
+    """A FluentMap whose values are names from declared spaces (or None),
+    stored as an array of their ids (-1 for a missing key)."""
+
+    __slots__ = ('value_space', 'ids', 'names')
+    _EMPTY = -1
+
+    def __init__(self, key_space, data, value_space, trail=None, path=None):
+        FluentMap.__init__(self, key_space, data, trail, path)
+        self.value_space = value_space
+        self.ids = value_space.ids
+        self.names = value_space.names
+
+    @classmethod
+    def _empty_data(cls, n):
+        return array('i', [-1]) * n
+
+    def _encode(self, value):
+        i = self.ids.get(value)
+        if i is None:
+            raise ValueError(f"{value!r} is not in the value space of this fluent")
+        return i
+
+    def _decode(self, raw):
+        return self.names[raw]
+
+    def _value(self, raw):
+        return _MISSING if raw < 0 else self.names[raw]
+
+    def __getitem__(self, key):
+        raw = self.data[self.index[key]]
+        if raw < 0:
+            raise KeyError(key)
+        return self.names[raw]
+
+    def get(self, key, default=None):
+        i = self.index.get(key)
+        if i is None:
+            return default
+        raw = self.data[i]
+        return default if raw < 0 else self.names[raw]
+
+    def __contains__(self, key):
+        i = self.index.get(key)
+        return i is not None and self.data[i] >= 0
+
+    def __iter__(self):
+        return (key for key, raw in zip(self.key_space.names, self.data) if raw >= 0)
+
+    def __len__(self):
+        return len(self.data) - self.data.count(-1)
+
+    def items(self):
+        names = self.names
+        return [(key, names[raw]) for key, raw in zip(self.key_space.names, self.data) if raw >= 0]
+
+    def __delitem__(self, key):
+        i = self.index[key]
+        if self.data[i] < 0:
+            raise KeyError(key)
+        if self.trail is not None:
+            self._log(i, key, _MISSING)
+        self.data[i] = -1
+
+    def _same_layout(self, other):
+        return self.key_space == other.key_space and self.value_space == other.value_space
+
+    def clone(self):
+        new = object.__new__(InternedFluentMap)
+        new.key_space = self.key_space
+        new.index = self.index
+        new.data = self.data[:]
+        new.trail = new.path = None
+        new.value_space = self.value_space
+        new.ids = self.ids
+        new.names = self.names
+        return new
+
+    def __deepcopy__(self, memo):
+        return self.clone()
+
+    def _reduce_args(self):
+        return (self.value_space,)
+
+
+def _fluent_map(cls, key_space, data, *args):
+    return cls(key_space, data, *args)
+
+
+class CompactState:
+    """
+    Base class of the state classes of Schemas (see Schema): a state whose
+    variables live in __slots__ and whose fluents are FluentMaps.
+    """
+
+    __slots__ = ('__name__',)
+    schema = None
+
+    def __init__(self, name):
+        object.__setattr__(self, '__name__', name)
+
+    def __setattr__(self, name, value):
+        if name in self.schema.fluents and not isinstance(value, FluentMap):
+            value = self.schema.fluent(name, value.items())
+        object.__setattr__(self, name, value)
+
+    def variables(self):
+        """Return the (name, value) pairs of the variables that are set."""
+        pairs = []
+        for name in self.schema.names:
+            value = getattr(self, name, _MISSING)
+            if value is not _MISSING:
+                pairs.append((name, value))
+        return pairs
+
+    def clone(self):
+        """
+        Return a copy for an operator to modify: FluentMaps are copied,
+        static variables shared, other dicts copied on write and anything
+        else deep-copied, as copy_state does for a State.
+        """
+        new = object.__new__(type(self))
+        setvar = object.__setattr__
+        setvar(new, '__name__', self.__name__)
+        for name in self.schema.fluents:
+            val = getattr(self, name, None)
+            if val is not None:
+                setvar(new, name, val.clone())
+        for name in self.schema.variables:
+            val = getattr(self, name, _MISSING)
+            cls = type(val)
+            if cls is CowDict or cls is OwnedDict:
+                val = CowDict(val.base)
+            elif cls is dict:
+                val = CowDict(val)
+            elif not (val is _MISSING or cls is FrozenDict or cls is FrozenList or cls in _ATOMIC_TYPES):
+                val = copy.deepcopy(val)
+            if val is not _MISSING:
+                setvar(new, name, val)
+        return new
+
+    def __copy__(self):
+        new = object.__new__(type(self))
+        object.__setattr__(new, '__name__', self.__name__)
+        for name, val in self.variables():
+            object.__setattr__(new, name, val)
+        return new
+
+    def __deepcopy__(self, memo):
+        new = object.__new__(type(self))
+        object.__setattr__(new, '__name__', self.__name__)
+        for name, val in self.variables():
+            object.__setattr__(new, name, copy.deepcopy(val, memo))
+        return new
+
+    def __reduce__(self):
+        return _compact_state, (self.schema, self.__name__, self.variables())
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactState) or other.schema != self.schema:
+            return NotImplemented
+        return self.variables() == other.variables()
+
+    def __hash__(self):
+        # The interned fluents identify most states; equal states have equal ones
+        return hash(tuple(val.data.tobytes() for _, val in self.variables()
+                          if isinstance(val, InternedFluentMap)))
+
+    def __str__(self):
+        return to_string(self)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def _compact_state(schema, name, variables):
+    state = schema.state(name)
+    for var, value in variables:
+        setattr(state, var, value)
+    return state
+
+
+class Schema:
+    """
+    The layout of the compact states of a domain (see CompactState).
+    - spaces maps the name of each space to its list of names.
+    - fluents maps the name of each fluent to (key space, value space): the
+      value space is a space name, a tuple of space names (None is always
+      allowed too), or None if the values aren't names (numbers, frozensets).
+    - variables are the names of the other state variables, which are
+      copied as in a State: frozen ones shared, dicts copied on write.
+    schema.state(name) makes an empty state, schema.compact(state) converts
+    a State; assigning a dict to a fluent converts it to a FluentMap.
+    """
+
+    def __init__(self, name, spaces, fluents, variables=()):
+        self.name = name
+        self.spaces = {space: list(names) for space, names in spaces.items()}
+        self.fluents = dict(fluents)
+        self.variables = tuple(v for v in variables if v not in self.fluents)
+        self.names = tuple(self.fluents) + self.variables
+        self._spaces = {}
+        self._key_spaces = {}
+        self._value_spaces = {}
+        for fluent, (keys, values) in self.fluents.items():
+            self._key_spaces[fluent] = self._space(keys)
+            if values is not None:
+                self._value_spaces[fluent] = self._space(values, none=True)
+        self.state_class = type(f'{name}_state', (CompactState,),
+                                {'__slots__': self.names, 'schema': self})
+        with _schemas_lock:
+            _schemas.setdefault(_schema_signature(name, self.spaces, self.fluents, self.variables), self)
+
+    def _space(self, spaces, none=False):
+        spaces = (spaces,) if isinstance(spaces, str) else tuple(spaces)
+        key = (spaces, none)
+        space = self._spaces.get(key)
+        if space is None:
+            names = [None] if none else []
+            for name in spaces:
+                names.extend(self.spaces[name])
+            space = self._spaces[key] = _Space(names)
+        return space
+
+    def fluent(self, name, items=()):
+        """Return a FluentMap for the fluent name with the given items."""
+        value_space = self._value_spaces.get(name)
+        if value_space is None:
+            return FluentMap.from_items(self._key_spaces[name], items)
+        return InternedFluentMap.from_items(self._key_spaces[name], items, value_space)
+
+    def state(self, name):
+        """Return an empty state of this schema."""
+        return self.state_class(name)
+
+    def compact(self, state):
+        """Return a state of this schema with the variables of state, which
+        must all be fluents or variables of the schema."""
+        new = self.state(state.__name__)
+        for name, val in state_variables(state):
+            if name not in self.fluents and not is_static(val) and type(val) not in _ATOMIC_TYPES:
+                val = copy.deepcopy(val)
+            setattr(new, name, val)
+        return new
+
+    def __eq__(self, other):
+        return self is other or (type(other) is Schema and self.name == other.name and
+                                 self.spaces == other.spaces and self.fluents == other.fluents and
+                                 self.variables == other.variables)
+
+    def __hash__(self):
+        return hash((self.name, self.names))
+
+    def __reduce__(self):
+        return _interned_schema, (self.name, self.spaces, self.fluents, self.variables)
+
+
+# The first Schema made with each signature, so that unpickling a Schema (or
+# a compact state) in a process that already has an equal one reuses it and
+# its state class instead of making new ones
+_schemas = weakref.WeakValueDictionary()
+_schemas_lock = threading.Lock()
+
+
+def _schema_signature(name, spaces, fluents, variables):
+    def names(value):
+        return tuple(value) if isinstance(value, list) else value
+    return (name, tuple((space, tuple(space_names)) for space, space_names in spaces.items()),
+            tuple((fluent, tuple(names(s) for s in spec)) for fluent, spec in fluents.items()),
+            tuple(v for v in variables if v not in fluents))
+
+
+def _interned_schema(name, spaces, fluents, variables=()):
+    key = _schema_signature(name, spaces, fluents, variables)
+    with _schemas_lock:
+        schema = _schemas.get(key)
+    if schema is None:
+        schema = Schema(name, spaces, fluents, variables)
+        with _schemas_lock:
+            schema = _schemas.get(key, schema)
+    return schema
 
 
 ############################################################
-# The actual planner
+# Trails: undo logs for searching on a single mutable state
+#
+# A Trail can also keep a Zobrist-style hash of the dynamic part of the
+# state: the XOR of one hash per (container path, key, value) entry, with
+# the state's variables as the entries of a container whose path is None. Every
+# logged write and every undo updates it in O(1), so search nodes can be
+# looked up in a transposition table without traversing the state.
+
+_MISSING = object()
+_APPEND = object()
+_SNAPSHOT = object()
+_NESTED = object()
 
-def pyhop(state, tasks, verbose=0):
+
+def _zobrist(path, key, value):
+    """The hash contribution of the entry key: value of the container at path."""
+    if value is _MISSING:
+        return 0
+    if isinstance(value, (dict, CowDict, list)):
+        # Nested containers contribute their own entries
+        value = _NESTED
+    try:
+        return hash((path, key, value))
+    except TypeError:
+        return hash((path, key, repr(value)))
+
+
+def _zobrist_list(path, values):
+    h = 0
+    for i, value in enumerate(values):
+        h ^= _zobrist(path, i, value)
+    return h
+
+
+class Trail:
     """
-    Try to find a plan that accomplishes tasks in state. 
-    If successful, return the plan. Otherwise return False.
+    An undo log of the writes made to a state's containers during search.
+    Each entry is a (container, key, old value) triple; undo(mark) restores
+    the containers to what they were when mark() returned that mark.
+    If hashing is True, hash is kept equal to state_hash of the state.
     """
-    if verbose > 0:
-        print(f'\n** pyhop, verbose={verbose}: **\n   state = {state}\n   tasks = {tasks}')
-    result_list = seek_plan(state, tasks, [], 0, verbose)
-    if verbose > 0:
-        if not result_list:
-            print('** result =', result_list, '\n')
+
+    def __init__(self, hashing=False):
+        self.entries = []
+        self.hashing = hashing
+        self.hash = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def mark(self):
+        return len(self.entries)
+
+    def undo(self, mark):
+        entries = self.entries
+        while len(entries) > mark:
+            container, key, old = entries.pop()
+            container._restore(key, old)
+
+
+class TrailDict(dict):
+    """A dict that records each write in a Trail before making it."""
+
+    __slots__ = ('trail', 'path')
+
+    def __init__(self, items, trail, path=None):
+        dict.__init__(self, items)
+        self.trail = trail
+        self.path = path
+
+    def __setitem__(self, key, value):
+        trail = self.trail
+        old = dict.get(self, key, _MISSING)
+        trail.entries.append((self, key, old))
+        if trail.hashing:
+            trail.hash ^= _zobrist(self.path, key, old) ^ _zobrist(self.path, key, value)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        trail = self.trail
+        old = dict.__getitem__(self, key)
+        trail.entries.append((self, key, old))
+        if trail.hashing:
+            trail.hash ^= _zobrist(self.path, key, old)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            self.__delitem__(key)
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key = next(reversed(self))
+        value = dict.__getitem__(self, key)
+        self.__delitem__(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self.__setitem__(key, default)
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self.__setitem__(key, value)
+
+    def clear(self):
+        for key in list(self):
+            self.__delitem__(key)
+
+    def _restore(self, key, old):
+        trail = self.trail
+        if trail.hashing:
+            trail.hash ^= (_zobrist(self.path, key, dict.get(self, key, _MISSING)) ^
+                           _zobrist(self.path, key, old))
+        if old is _MISSING:
+            dict.__delitem__(self, key)
         else:
-            print('** result =', result_list[0], '\n')
-            print('** final state =')
-            print_state(result_list[1])
-            print()
-    return result_list if result_list else []
+            dict.__setitem__(self, key, old)
+
+    def __deepcopy__(self, memo):
+        return {copy.deepcopy(k, memo): copy.deepcopy(v, memo) for k, v in dict.items(self)}
 
 
-def seek_plan(state, tasks, plan, depth, verbose=0):
+class TrailList(list):
     """
-    Workhorse for pyhop. state and tasks are as in pyhop.
-    - plan is the current partial plan.
-    - depth is the recursion depth, for use in debugging
-    - verbose is whether to print debugging messages
+    A list that records each write in a Trail before making it.
+    Appends are logged in O(1); other writes log a snapshot of the list.
     """
-    if verbose > 1:
-        print(f'depth {depth} tasks {tasks}')
-    if not tasks:
-        if verbose > 2:
-            print(f'depth {depth} returns plan {plan}')
-        return [plan, state]
-    task1 = tasks[0]
-    if task1[0] in operators:
-        if verbose > 2:
-            print(f'depth {depth} action {task1}')
-        operator = operators[task1[0]]
-        newstate = operator(copy.deepcopy(state), *task1[1:])
-        if verbose > 2:
-            print(f'depth {depth} new state:')
-            print_state(newstate)
-        if newstate:
-            solution_list = seek_plan(newstate, tasks[1:], plan + [task1], depth + 1, verbose)
-            if solution_list:
+
+    __slots__ = ('trail', 'path')
+
+    def __init__(self, items, trail, path=None):
+        list.__init__(self, items)
+        self.trail = trail
+        self.path = path
+
+    def _save(self):
+        trail = self.trail
+        trail.entries.append((self, _SNAPSHOT, list(self)))
+        if trail.hashing:
+            # Take the old items out of the hash; _rehash puts the new ones in
+            trail.hash ^= _zobrist_list(self.path, self)
+
+    def _rehash(self):
+        if self.trail.hashing:
+            self.trail.hash ^= _zobrist_list(self.path, self)
+
+    def append(self, value):
+        trail = self.trail
+        trail.entries.append((self, _APPEND, None))
+        if trail.hashing:
+            trail.hash ^= _zobrist(self.path, len(self), value)
+        list.append(self, value)
+
+    def __setitem__(self, index, value):
+        self._save()
+        list.__setitem__(self, index, value)
+        self._rehash()
+
+    def __delitem__(self, index):
+        self._save()
+        list.__delitem__(self, index)
+        self._rehash()
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, n):
+        self._save()
+        list.__imul__(self, n)
+        self._rehash()
+        return self
+
+    def extend(self, values):
+        self._save()
+        list.extend(self, values)
+        self._rehash()
+
+    def insert(self, index, value):
+        self._save()
+        list.insert(self, index, value)
+        self._rehash()
+
+    def pop(self, *index):
+        self._save()
+        value = list.pop(self, *index)
+        self._rehash()
+        return value
+
+    def remove(self, value):
+        self._save()
+        try:
+            list.remove(self, value)
+        finally:
+            self._rehash()
+
+    def clear(self):
+        self._save()
+        list.clear(self)
+        self._rehash()
+
+    def sort(self, *args, **kwargs):
+        self._save()
+        list.sort(self, *args, **kwargs)
+        self._rehash()
+
+    def reverse(self):
+        self._save()
+        list.reverse(self)
+        self._rehash()
+
+    def _restore(self, key, old):
+        trail = self.trail
+        if key is _APPEND:
+            value = list.pop(self)
+            if trail.hashing:
+                trail.hash ^= _zobrist(self.path, len(self), value)
+        else:
+            if trail.hashing:
+                trail.hash ^= _zobrist_list(self.path, self) ^ _zobrist_list(self.path, old)
+            list.__setitem__(self, slice(None), old)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in list.__iter__(self)]
+
+
+def attach_trail(value, trail, path=None):
+    """
+    Return a copy of value in which every dict and list (at any depth) is
+    replaced by a TrailDict or TrailList that logs its writes in trail.
+    path names the container for hashing (nested ones get (path, key)).
+    Static (frozen) values are shared as they are.
+    """
+    if is_static(value):
+        return value
+    if isinstance(value, FluentMap):
+        value = value.clone()
+        value.trail = trail
+        value.path = path
+        return value
+    if isinstance(value, (dict, CowDict)):
+        return TrailDict(((k, attach_trail(v, trail, (path, k))) for k, v in value.items()), trail, path)
+    if isinstance(value, list):
+        return TrailList((attach_trail(v, trail, (path, i)) for i, v in enumerate(value)), trail, path)
+    return copy.deepcopy(value)
+
+
+def _hash_value(value, path):
+    if isinstance(value, (dict, CowDict, FluentMap)):
+        h = 0
+        for k, v in value.items():
+            h ^= _zobrist(path, k, v) ^ _hash_value(v, (path, k))
+        return h
+    if isinstance(value, list):
+        h = 0
+        for i, v in enumerate(value):
+            h ^= _zobrist(path, i, v) ^ _hash_value(v, (path, i))
+        return h
+    return 0
+
+
+def _variable_hash(name, value):
+    """The hash contribution of the state variable name bound to value."""
+    if name == '__name__' or is_static(value):
+        return 0
+    return _zobrist(None, name, value) ^ _hash_value(value, name)
+
+
+def state_hash(state):
+    """
+    Return the Zobrist hash of the dynamic (non-static) variables of state.
+    A hashing Trail keeps trail.hash equal to this without recomputing it.
+    """
+    h = 0
+    for name, val in state_variables(state):
+        h ^= _variable_hash(name, val)
+    return h
+
+
+# The methods of the classes of trailed states (see trailed_state): rebinding
+# a variable of the state is logged in the class's Trail, like a write to one
+# of its containers, and undone with them
+
+def _trailed_setattr(self, name, value):
+    trail = self._trail
+    old = getattr(self, name, _MISSING)
+    self._untrailed.__setattr__(self, name, value)
+    # The state's class may have converted value (e.g. to a FluentMap)
+    value = getattr(self, name)
+    if not _is_trailed(value, trail):
+        value = attach_trail(value, trail, name)
+        object.__setattr__(self, name, value)
+    trail.entries.append((self, name, old))
+    if trail.hashing:
+        trail.hash ^= _variable_hash(name, old) ^ _variable_hash(name, value)
+
+
+def _trailed_delattr(self, name):
+    trail = self._trail
+    old = getattr(self, name)
+    object.__delattr__(self, name)
+    trail.entries.append((self, name, old))
+    if trail.hashing:
+        trail.hash ^= _variable_hash(name, old)
+
+
+def _trailed_restore(self, name, old):
+    trail = self._trail
+    if trail.hashing:
+        trail.hash ^= _variable_hash(name, getattr(self, name, _MISSING)) ^ _variable_hash(name, old)
+    if old is _MISSING:
+        object.__delattr__(self, name)
+    else:
+        object.__setattr__(self, name, old)
+
+
+def _is_trailed(value, trail):
+    """Whether value already logs its writes in trail (or has nothing to log)."""
+    if isinstance(value, (TrailDict, TrailList, FluentMap)):
+        return value.trail is trail
+    return not isinstance(value, (dict, CowDict, list)) or is_static(value)
+
+
+def trailed_state(state, trail):
+    """
+    Return a working copy of state whose containers log their writes in
+    trail, and whose variables log their rebinding (state.x = ...) there too.
+    The copy is an instance of a subclass of state's class made for trail;
+    untrailed_copy(work) returns an ordinary copy of it.
+    """
+    work = copy.copy(state)
+    for name, val in state_variables(state):
+        setattr(work, name, attach_trail(val, trail, name))
+    cls = type(state)
+    namespace = {'_trail': trail, '_untrailed': cls, '__setattr__': _trailed_setattr,
+                 '__delattr__': _trailed_delattr, '_restore': _trailed_restore}
+    if isinstance(state, CompactState):
+        namespace['__slots__'] = ()
+    work.__class__ = type(cls.__name__, (cls,), namespace)
+    if trail.hashing:
+        trail.hash = state_hash(work)
+    return work
+
+
+def untrailed_copy(state):
+    """Return a deep copy of state, of its original class if it is a trailed state."""
+    new = copy.deepcopy(state)
+    cls = getattr(type(new), '_untrailed', None)
+    if cls is not None:
+        object.__setattr__(new, '__class__', cls)
+    return new
+
+
+class FailureTable:
+    """
+    A transposition table of search nodes known to fail: a set of
+    (state hash, agenda hash) keys bounded to size entries, evicting the
+    least recently used. hits counts the lookups that found a key.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.keys = OrderedDict()
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            self.hits += 1
+            return True
+        return False
+
+    def add(self, key):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.size:
+            self.keys.popitem(last=False)
+
+
+############################################################
+# Helper functions that may be useful in domain models
+
+def forall(seq, cond):
+    """Return True if cond(x) holds for all x in seq, otherwise False."""
+    return all(cond(x) for x in seq)
+
+
+def find_if(cond, seq):
+    """
+    Return the first element in seq such that cond(element) holds.
+    If no such element is found, return None.
+    """
+    return next((x for x in seq if cond(x)), None)
+
+
+############################################################
+# Commands to tell Pyhop what the operators and methods are
+#
+# A Domain owns a table of operators and a table of methods, so a program
+# can hold several domains and plan with any of them. The module-level
+# declare_operators, declare_methods, print_operators, print_methods and
+# pyhop work on default_domain, whose tables are the module's operators
+# and methods dicts.
+
+class Domain:
+    """
+    The operators and methods of a planning domain:
+    - operators: {operator name: function}
+    - methods: {task name: [method functions, in the order to try them]}
+    - costs: {operator name: cost}, used by plan_optimal; a cost is a
+      number or a function called like the operator, cost(state, *args),
+      on the state before the action. Operators without a cost cost 1.
+    - preconditions: {operator name: function}, used by validate_plan to
+      say why an action failed; the function is called like the operator
+      and returns a description of the first precondition that the state
+      violates, or None.
+    Declare everything before planning with the domain; the planner only
+    reads the tables, so any number of threads can plan with one domain.
+    """
+
+    def __init__(self, name='domain'):
+        self.name = name
+        self.operators = {}
+        self.methods = {}
+        self.costs = {}
+        self.preconditions = {}
+
+    def __repr__(self):
+        return f'<Domain {self.name}: {len(self.operators)} operators, {len(self.methods)} tasks>'
+
+    def declare_operators(self, *op_list):
+        """
+        Call this after defining the operators, to tell the domain what they are.
+        op_list must be a list of functions, not strings.
+        """
+        for op in op_list:
+            if not callable(op):
+                raise ValueError(f"Operator {op} is not callable")
+            self.operators[op.__name__] = op
+        return self.operators
+
+    def declare_methods(self, task_name, *method_list):
+        """
+        Call this once for each task, to tell the domain what the methods are.
+        task_name must be a string.
+        method_list must be a list of functions, not strings.
+        """
+        if not isinstance(task_name, str):
+            raise ValueError("Task name must be a string")
+        for method in method_list:
+            if not callable(method):
+                raise ValueError(f"Method {method} is not callable")
+        self.methods[task_name] = list(method_list)
+        return self.methods[task_name]
+
+    def declare_costs(self, **costs):
+        """
+        Tell the domain what its operators cost: declare_costs(op1=5,
+        op2=f, ...), where f(state, *args) returns the cost of the action
+        (op2, *args) in state. Costs must not be negative.
+        """
+        for name, cost in costs.items():
+            if not callable(cost) and not (isinstance(cost, (int, float)) and cost >= 0):
+                raise ValueError(f"Cost of {name} must be a non-negative number or a function")
+            self.costs[name] = cost
+        return self.costs
+
+    def declare_preconditions(self, **explainers):
+        """
+        Tell the domain how to explain the failures of its operators:
+        declare_preconditions(op1=f, ...), where f(state, *args) returns a
+        description of the precondition of (op1, *args) that state
+        violates, or None if it violates none.
+        """
+        for name, explain in explainers.items():
+            if not callable(explain):
+                raise ValueError(f"Precondition explainer of {name} is not callable")
+            self.preconditions[name] = explain
+        return self.preconditions
+
+    def action_cost(self, state, action):
+        """Return the cost of action (a task whose name is an operator) in state."""
+        cost = self.costs.get(action[0], 1)
+        if callable(cost):
+            cost = cost(state, *action[1:])
+            if cost < 0:
+                raise ValueError(f"Negative cost {cost} for action {action}")
+        return cost
+
+    def print_operators(self):
+        print_operators(self.operators)
+
+    def print_methods(self):
+        print_methods(self.methods)
+
+
+default_domain = Domain('default')
+operators = default_domain.operators
+methods = default_domain.methods
+
+
+def declare_operators(*op_list):
+    """
+    Call this after defining the operators, to tell Pyhop what they are.
+    op_list must be a list of functions, not strings.
+    """
+    return default_domain.declare_operators(*op_list)
+
+
+def declare_methods(task_name, *method_list):
+    """
+    Call this once for each task, to tell Pyhop what the methods are.
+    task_name must be a string.
+    method_list must be a list of functions, not strings.
+    """
+    return default_domain.declare_methods(task_name, *method_list)
+
+
+def declare_costs(**costs):
+    """
+    Tell Pyhop what the operators cost, for pyhop_optimize:
+    declare_costs(op1=5, op2=f, ...) where f(state, *args) returns the cost.
+    """
+    return default_domain.declare_costs(**costs)
+
+
+def declare_preconditions(**explainers):
+    """
+    Tell Pyhop how to explain why operators fail, for validate_plan:
+    declare_preconditions(op1=f, ...) where f(state, *args) describes the
+    violated precondition, or returns None.
+    """
+    return default_domain.declare_preconditions(**explainers)
+
+
+############################################################
+# Commands to find out what the operators and methods are
+
+def print_operators(olist=operators):
+    """Print out a list of available operators."""
+    print(f"{'OPERATORS: '}{', '.join(olist)}")
+
+
+def print_methods(mlist=methods):
+    """Print out a table of what the methods are for each task"""
+    max_task_length = max(len(task) for task in mlist) if mlist else 4
+    print(f"{'TASK':<{max_task_length}} | METHODS")
+    for task in mlist:
+        print(f"{task:<{max_task_length + 1}}{'| '}{', '.join(f.__name__ for f in mlist[task])}")
+
+
+############################################################
+# Statistics
+#
+# Passing a PlanStats object to pyhop (pyhop(state, tasks, stats=st)) makes
+# the planner count what it does and time where it spends it. Without one,
+# the only cost is an "is None" test per step.
+
+class PlanStats:
+    """
+    Counters and timings of one or more planner runs:
+    - nodes: search nodes expanded; max_depth: deepest node reached
+    - backtracks: nodes all of whose children failed; pruned: nodes skipped
+      because a FailureTable knew they fail
+    - operators: {operator name: [applications, failures]}
+    - methods: {method name: [attempts, successes]}, where a success is
+      the method returning subtasks rather than False
+    - copy_time, operator_time, method_time, total_time: seconds spent
+      copying states, in operators, in methods, and in the whole run
+    - peak_memory: the peak bytes allocated during the run, measured with
+      tracemalloc if track_memory is True (it slows the search), else None
+    """
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.nodes = 0
+        self.max_depth = 0
+        self.backtracks = 0
+        self.pruned = 0
+        self.operators = {}
+        self.methods = {}
+        self.copy_time = 0.0
+        self.operator_time = 0.0
+        self.method_time = 0.0
+        self.total_time = 0.0
+        self.peak_memory = None
+        self._started_tracemalloc = False
+
+    def start(self):
+        """Called by pyhop when a run starts."""
+        self._start_time = time.perf_counter()
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            tracemalloc.reset_peak()
+            self._base_memory = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        """Called by pyhop when a run ends."""
+        self.total_time += time.perf_counter() - self._start_time
+        if self.track_memory:
+            peak = tracemalloc.get_traced_memory()[1] - self._base_memory
+            self.peak_memory = max(peak, self.peak_memory or 0)
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def expand(self, depth):
+        self.nodes += 1
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def apply(self, operator, state, task, copy_first):
+        """Apply operator to state (copied first if copy_first), timing it."""
+        t0 = time.perf_counter()
+        if copy_first:
+            state = copy_state(state)
+        t1 = time.perf_counter()
+        newstate = operator(state, *task[1:])
+        t2 = time.perf_counter()
+        self.copy_time += t1 - t0
+        self.operator_time += t2 - t1
+        counts = self.operators.get(task[0])
+        if counts is None:
+            counts = self.operators[task[0]] = [0, 0]
+        counts[0 if newstate else 1] += 1
+        return newstate
+
+    def call_method(self, method, state, task):
+        """Call method on state and task, timing it."""
+        t0 = time.perf_counter()
+        subtasks = method(state, *task[1:])
+        self.method_time += time.perf_counter() - t0
+        counts = self.methods.get(method.__name__)
+        if counts is None:
+            counts = self.methods[method.__name__] = [0, 0]
+        counts[0] += 1
+        if subtasks is not False:
+            counts[1] += 1
+        return subtasks
+
+    def timed_copy(self, copier, state):
+        """Return copier(state), adding the time it takes to copy_time."""
+        t0 = time.perf_counter()
+        state = copier(state)
+        self.copy_time += time.perf_counter() - t0
+        return state
+
+    def as_dict(self):
+        return {name: val for name, val in vars(self).items() if not name.startswith('_')}
+
+    def __str__(self):
+        lines = [f'nodes {self.nodes}, max depth {self.max_depth}, '
+                 f'backtracks {self.backtracks}, pruned {self.pruned}',
+                 f'time {self.total_time:.6f}s: copying {self.copy_time:.6f}s, '
+                 f'operators {self.operator_time:.6f}s, methods {self.method_time:.6f}s']
+        if self.peak_memory is not None:
+            lines.append(f'peak memory {self.peak_memory} bytes')
+        if self.operators:
+            width = max(len(name) for name in self.operators)
+            lines.append(f"{'OPERATOR':<{width}} | APPLIED | FAILED")
+            for name, (applied, failed) in self.operators.items():
+                lines.append(f'{name:<{width}} | {applied:7} | {failed:6}')
+        if self.methods:
+            width = max(len(name) for name in self.methods)
+            lines.append(f"{'METHOD':<{width}} | TRIED | SUCCEEDED")
+            for name, (tried, succeeded) in self.methods.items():
+                lines.append(f'{name:<{width}} | {tried:5} | {succeeded:9}')
+        return '\n'.join(lines)
+
+
+############################################################
+# Tracing
+#
+# The planner reports what it does as trace events, calling each listener
+# as listener(event, fields) with fields a dict. When no listener is
+# attached the planner only pays for an "is None" test per event. Events:
+#
+#   'expand'          depth, tasks           a search node is reached
+#   'operator'        depth, action          an operator is about to be applied
+#   'operator_result' depth, action, state   the new state, or False on failure
+#   'decompose'       depth, task            methods are about to be tried
+#   'method'          depth, task, method, subtasks (False if not applicable)
+#   'backtrack'       depth                  every child of a node failed
+#   'pruned'          depth[, reason]        a node known to fail, deeper
+#                                            than a Budget's max_depth
+#                                            (reason 'max_depth') or as
+#                                            costly as the best plan
+#                                            (reason 'bound') was skipped
+#   'plan'            depth, plan[, cost]    a plan was found
+#   'debug'           message, ...           debugging messages from domains
+#
+# The state in 'operator_result' is live: copy it if you keep it.
+# Listeners added with add_trace_listener receive the events of every pyhop
+# call and the domains' debug events; pyhop's verbose argument adds a
+# VerbosePrinter for the duration of one call.
+
+_trace_listeners = []
+
+# True while some listener is attached; domains test it before building events
+tracing = False
+
+
+def add_trace_listener(listener):
+    """Attach listener(event, fields) to receive all trace events."""
+    global tracing
+    _trace_listeners.append(listener)
+    tracing = True
+    return listener
+
+
+def remove_trace_listener(listener):
+    """Detach a listener attached with add_trace_listener."""
+    global tracing
+    _trace_listeners.remove(listener)
+    tracing = bool(_trace_listeners)
+
+
+def trace_event(event, **fields):
+    """
+    Send an event to the attached listeners. Domains should only call it
+    when pyhop.tracing is True, so that untraced runs pay nothing:
+        if pyhop.tracing:
+            pyhop.trace_event('debug', message=...)
+    """
+    for listener in list(_trace_listeners):
+        listener(event, fields)
+
+
+def make_tracer(verbose=0):
+    """
+    Return the trace callable for one planner run: the attached listeners
+    plus a VerbosePrinter if verbose > 1, or None if there are none.
+    """
+    listeners = list(_trace_listeners)
+    if verbose > 1:
+        listeners.append(VerbosePrinter(verbose))
+    if not listeners:
+        return None
+    if len(listeners) == 1:
+        return listeners[0]
+
+    def trace(event, fields):
+        for listener in listeners:
+            listener(event, fields)
+    return trace
+
+
+class VerbosePrinter:
+    """A listener that prints the messages of pyhop's verbose levels 2 and 3."""
+
+    def __init__(self, verbose):
+        self.verbose = verbose
+
+    def __call__(self, event, fields):
+        depth = fields.get('depth')
+        if event == 'expand':
+            if self.verbose > 1:
+                print(f"depth {depth} tasks {fields['tasks']}")
+        elif self.verbose < 3:
+            return
+        elif event == 'operator':
+            print(f"depth {depth} action {fields['action']}")
+        elif event == 'operator_result':
+            print(f'depth {depth} new state:')
+            print_state(fields['state'])
+        elif event == 'decompose':
+            print(f"depth {depth} method instance {fields['task']}")
+        elif event == 'method':
+            print(f"depth {depth} new tasks: {fields['subtasks']}")
+        elif event == 'backtrack':
+            print(f'depth {depth} returns failure')
+        elif event == 'pruned':
+            if fields.get('reason') == 'max_depth':
+                print(f'depth {depth} too deep')
+            elif fields.get('reason') == 'bound':
+                print(f'depth {depth} costs too much')
+            else:
+                print(f'depth {depth} known failure')
+        elif event == 'plan':
+            print(f"depth {depth} returns plan {fields['plan']}")
+        elif event == 'debug':
+            print(f"DEBUG: {fields['message']}")
+
+
+def print_trace(event, fields):
+    """A listener that prints every event on one line."""
+    print(event, ' '.join(f'{name}={val}' for name, val in fields.items()))
+
+
+class JsonLinesSink:
+    """
+    A listener that writes each event as one JSON object per line,
+    {"event": ..., fields...}, to a file object or a path (opened for
+    appending). Lines are buffered and written buffer_size at a time;
+    call close() (or use it as a context manager) to flush the rest.
+    Unless include_state is True, the state in 'operator_result' events
+    is replaced by "ok": whether the operator succeeded.
+    events, if given, is a collection of the event names to keep.
+    """
+
+    def __init__(self, file, buffer_size=1000, include_state=False, events=None):
+        import json
+        self._dumps = json.JSONEncoder(default=self._default).encode
+        if isinstance(file, str):
+            self.file = open(file, 'a')
+            self._owns_file = True
+        else:
+            self.file = file
+            self._owns_file = False
+        self.buffer_size = buffer_size
+        self.include_state = include_state
+        self.events = None if events is None else frozenset(events)
+        self.lines = []
+
+    @staticmethod
+    def _items(obj):
+        # JSON keys must be strings: other keys (e.g. tuples) are repr'd
+        return {key if isinstance(key, str) else repr(key): val for key, val in obj.items()}
+
+    @classmethod
+    def _default(cls, obj):
+        if isinstance(obj, (dict, CowDict, FluentMap)):
+            return cls._items(obj)
+        if isinstance(obj, (set, frozenset)):
+            return sorted(obj, key=repr)
+        if isinstance(obj, (State, Goal, CompactState)):
+            # _items(...) so that non-string keys are repr'd
+            return {'__name__': obj.__name__,
+                    **{name: cls._items(val) if isinstance(val, (dict, CowDict, FluentMap)) else val
+                       for name, val in state_variables(obj)}}
+        return repr(obj)
+
+    def __call__(self, event, fields):
+        if self.events is not None and event not in self.events:
+            return
+        record = {'event': event}
+        record.update(fields)
+        if event == 'operator_result' and not self.include_state:
+            record['ok'] = bool(record.pop('state'))
+        elif event == 'method':
+            record['method'] = fields['method'].__name__
+        self.lines.append(self._dumps(record))
+        if len(self.lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.lines = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self._owns_file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+############################################################
+# Budgets
+#
+# A Budget bounds the work of one planner run: a wall-clock time limit or
+# deadline, a maximum number of nodes expanded, a maximum depth and a
+# cancellation token (any object with an is_set() method, such as a
+# threading.Event, set by another thread to stop the search). When the
+# time, the nodes or the token run out, seek_plan and seek_plan_iterative
+# raise SearchInterrupted; nodes deeper than max_depth are treated as
+# failures. pyhop and Planner.plan then return a BudgetExhausted, which is
+# false like [] but tells which limit was reached.
+
+class Budget:
+    """
+    Limits for a planner run; None means no limit:
+    - time_limit: seconds from the start of the run
+    - deadline: a time.monotonic() value by which the run must end
+    - max_nodes: search nodes expanded
+    - max_depth: depth of the search nodes expanded
+    - cancel: a token whose is_set() stops the search when it returns True
+    A Budget keeps the counters of the run it is used for, so give each
+    concurrent run its own Budget (they may share the cancel token).
+    After a run, exhausted is the reason it was stopped, or None.
+    """
+
+    def __init__(self, time_limit=None, max_nodes=None, max_depth=None, cancel=None, deadline=None):
+        self.time_limit = time_limit
+        self.deadline = deadline
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.cancel = cancel
+        self.nodes = 0
+        self.depth_cutoff = False
+        self.exhausted = None
+        self._start_time = None
+        self._deadline = None
+
+    def start(self):
+        """Called by the planner when a run starts."""
+        self.nodes = 0
+        self.depth_cutoff = False
+        self.exhausted = None
+        self._start_time = time.monotonic()
+        self._deadline = self.deadline
+        if self.time_limit is not None:
+            deadline = self._start_time + self.time_limit
+            if self._deadline is None or deadline < self._deadline:
+                self._deadline = deadline
+
+    def elapsed(self):
+        return time.monotonic() - self._start_time
+
+    def expand(self, depth):
+        """
+        Charge one search node at depth. Raise SearchInterrupted if the
+        budget has run out; return True if the node is too deep to expand.
+        """
+        self.nodes += 1
+        reason = None
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            reason = 'max_nodes'
+        elif self._deadline is not None and time.monotonic() > self._deadline:
+            reason = 'deadline'
+        elif self.cancel is not None and self.cancel.is_set():
+            reason = 'cancelled'
+        if reason is not None:
+            self.exhausted = reason
+            raise SearchInterrupted(reason)
+        if self.max_depth is not None and depth > self.max_depth:
+            self.depth_cutoff = True
+            return True
+        return False
+
+
+class SearchInterrupted(Exception):
+    """Raised by the search when its Budget runs out; reason says which limit."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class BudgetExhausted:
+    """
+    The result of a run that ended without a plan because of its Budget.
+    It is false, like the [] returned when there is no plan.
+    - reason: 'deadline', 'max_nodes', 'cancelled', or 'max_depth' if the
+      search failed but skipped nodes deeper than max_depth
+    - nodes: search nodes expanded; elapsed: seconds the run took
+    """
+
+    def __init__(self, reason, nodes, elapsed):
+        self.reason = reason
+        self.nodes = nodes
+        self.elapsed = elapsed
+
+    def __bool__(self):
+        return False
+
+    def __len__(self):
+        return 0
+
+    def __eq__(self, other):
+        return (isinstance(other, BudgetExhausted) and
+                (self.reason, self.nodes) == (other.reason, other.nodes))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'BudgetExhausted({self.reason!r}, nodes={self.nodes}, elapsed={self.elapsed:.6f})'
+
+
+############################################################
+# Plan caches
+#
+# A PlanCache keeps the results of Planner.plan in an SQLite file, so that
+# a problem solved before, by this or any other process, is answered
+# without searching. Problems are identified by a canonical digest of the
+# state, the tasks and the domain: _canonical encodes values by content,
+# with dict items and set elements sorted, so equal problems get the same
+# key in every process. Static variables are digested once per object and
+# remembered, since consecutive problems usually share the same graphs, and
+# so is the encoding of each dynamic variable while it holds the same
+# objects. A hit then costs little more than the SQLite query.
+
+# Types that JSON encodes by content, and tells apart, in every process
+_FLAT_TYPES = frozenset((str, int, float, bool, type(None)))
+_flat_encoder = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+
+def _flat_values(values):
+    """Whether the list values holds only _FLAT_TYPES values, or only tuples of them."""
+    types = set(map(type, values))
+    if types == {tuple}:
+        types = set(map(type, chain.from_iterable(values)))
+    return types <= _FLAT_TYPES
+
+
+def _flat_encoding(value):
+    """
+    (tag, data) that identify the dict value if its keys and values are
+    _FLAT_TYPES values or tuples of them (tag b'D'), or its values are
+    frozensets of them (tag b'F'); else None. data is the JSON of its items
+    sorted by key. Most state variables are such flat dicts, and encoding
+    them with the C JSON encoder is much faster than item by item.
+    """
+    keys = list(value.keys())
+    values = list(value.values())
+    tag = b'D'
+    try:
+        if not _flat_values(keys):
+            return None
+        if not _flat_values(values):
+            if not (set(map(type, values)) <= {frozenset, set} and
+                    _flat_values(list(chain.from_iterable(values)))):
+                return None
+            tag, values = b'F', [sorted(v) for v in values]
+        # Keys are unique, so this never compares values
+        return tag, _flat_encoder.encode(sorted(zip(keys, values))).encode()
+    except TypeError:
+        # Keys (or set elements) of types that can't be sorted together
+        return None
+
+
+def _canonical(value):
+    """A byte string that identifies value by its content."""
+    cls = type(value)
+    if cls is str:
+        tag, data = b's', value.encode('utf-8', 'surrogatepass')
+    elif cls is int or cls is float or cls is bool or value is None:
+        tag, data = b'n', repr(value).encode()
+    elif isinstance(value, (dict, CowDict, FluentMap)):
+        flat = _flat_encoding(value)
+        if flat is not None:
+            tag, data = flat
+        else:
+            # Keys are self-delimiting, so this sorts by key
+            tag, data = b'd', b''.join(sorted(_canonical(k) + _canonical(v) for k, v in value.items()))
+    elif isinstance(value, list):
+        tag, data = b'l', b''.join(_canonical(v) for v in value)
+    elif isinstance(value, tuple):
+        tag, data = b't', b''.join(_canonical(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        tag, data = b'e', b''.join(sorted(_canonical(v) for v in value))
+    elif isinstance(value, (State, Goal, CompactState)):
+        tag, data = b'o', b''.join(sorted(_canonical(name) + _canonical(val)
+                                          for name, val in state_variables(value)))
+    else:
+        tag, data = b'r', f'{cls.__qualname__}:{value!r}'.encode('utf-8', 'surrogatepass')
+    return b'%s%d:%s' % (tag, len(data), data)
+
+
+def _code_digest(code, h):
+    h.update(code.co_code)
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            _code_digest(const, h)
+        else:
+            h.update(_canonical(const))
+    h.update(_canonical(code.co_names))
+
+
+def domain_version(domain=None):
+    """
+    A digest of the names and code of the operators and methods of domain
+    (default_domain if None), for PlanCache. It changes when they change,
+    but not when a helper function they call does.
+    """
+    domain = default_domain if domain is None else domain
+    h = hashlib.sha256()
+    for table in (domain.operators, domain.methods):
+        for name in sorted(table):
+            h.update(_canonical(name))
+            for func in table[name] if isinstance(table[name], list) else [table[name]]:
+                h.update(_canonical(getattr(func, '__qualname__', '')))
+                code = getattr(func, '__code__', None)
+                if code is not None:
+                    _code_digest(code, h)
+    return h.hexdigest()
+
+
+# Digests remembered by the PlanCaches of this process, which all use them
+# under _digests_lock
+_domain_versions = {}
+_static_digests = OrderedDict()
+_dynamic_digests = {}
+_digests_lock = threading.Lock()
+
+
+def _domain_version(domain):
+    # Recomputed only if the domain's functions change
+    tables = (tuple(domain.operators.items()),
+              tuple((name, tuple(methods)) for name, methods in domain.methods.items()))
+    entry = _domain_versions.get(id(domain))
+    if entry is None or entry[0] != tables:
+        entry = _domain_versions[id(domain)] = (tables, domain_version(domain))
+    return entry[1]
+
+
+def _static_digest(value):
+    # Keyed by id, holding value so that the id isn't reused
+    entry = _static_digests.get(id(value))
+    if entry is None or entry[0] is not value:
+        entry = (value, hashlib.sha256(_canonical(value)).digest())
+        _static_digests[id(value)] = entry
+        if len(_static_digests) > 64:
+            _static_digests.popitem(last=False)
+    return entry[1]
+
+
+def _dynamic_digest(name, value):
+    # The encoding of the last value of each dynamic variable, reused while
+    # the variable holds the very same keys and values; those of a flat dict
+    # (see _flat_encoding) are immutable, so then the content is the same
+    # too, even if the dict was written in between
+    if isinstance(value, (dict, CowDict, FluentMap)):
+        keys = tuple(value.keys())
+        values = tuple(value.values())
+        entry = _dynamic_digests.get(name)
+        if (entry is not None and len(entry[0]) == len(keys) and
+                all(map(is_, entry[0], keys)) and all(map(is_, entry[1], values))):
+            return entry[2]
+        data = _canonical(value)
+        if data[:1] in (b'D', b'F'):
+            _dynamic_digests[name] = (keys, values, data)
+        return data
+    return _canonical(value)
+
+
+class _PlanFile:
+    """The connection to a plan cache file, with its lock and a running count of its rows."""
+
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(plans)')]
+        if columns and 'state' not in columns:
+            # A file from before final states were stored: start afresh
+            self.db.execute('DROP TABLE plans')
+        self.db.execute('CREATE TABLE IF NOT EXISTS plans '
+                        '(key TEXT PRIMARY KEY, plan BLOB, state BLOB, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS plans_used ON plans (used)')
+        self.lock = threading.Lock()
+        self.count = self.db.execute('SELECT COUNT(*) FROM plans').fetchone()[0]
+        self.added = 0
+        self.users = 0
+
+
+# The _PlanFile of each file used by a PlanCache of this process, by
+# (absolute path, pid): a forked child must open its own connection
+_plan_files = {}
+_plan_files_lock = threading.Lock()
+
+
+class PlanCache:
+    """
+    A persistent, size-bounded cache of plans in the SQLite file path
+    (':memory:' for one that lasts as long as the object). Pass it to
+    pyhop or Planner.plan as cache=... Each entry maps the key of a
+    problem to its plan and the dynamic variables of its final state, or
+    to "no plan".
+    - A hit rebuilds the final state from a copy of the given state (whose
+      static variables the key guarantees are the same) and the stored
+      dynamic variables, so its cost depends on the size of the dynamic
+      state and not on the length of the plan.
+    - verify: if True, a hit instead replays the plan's operators on a copy
+      of the state, which also checks that the plan still works; an entry
+      whose plan no longer applies is deleted and counts as a miss.
+    - max_entries bounds the file: storing more evicts the least recently
+      used entries. Each process keeps a running count of the rows, and only
+      counts the table again when that reaches max_entries or after adding
+      max_entries // 16 rows, so with several processes the file can exceed
+      max_entries by the rows the others added since.
+    - version: a string that must change whenever the domain does. If None,
+      domain_version(domain) is used, which misses changes to helpers.
+    Results of runs whose Budget stopped them or cut off nodes deeper than
+    max_depth are not stored. hits, misses and evictions count this
+    object's lookups and evictions. Several threads and processes can use
+    the same file at once; the PlanCaches of a process that use the same
+    file share one connection to it, so making one is cheap.
+    """
+
+    def __init__(self, path, max_entries=10000, version=None, verify=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.version = version
+        self.verify = verify
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Temporary databases can't be shared
+        self._file_key = None if path in ('', ':memory:') else (os.path.abspath(path), os.getpid())
+        with _plan_files_lock:
+            file = _plan_files.get(self._file_key) if self._file_key is not None else None
+            if file is None:
+                file = _PlanFile(path)
+                if self._file_key is not None:
+                    _plan_files[self._file_key] = file
+            file.users += 1
+        self._file = file
+        self._db = file.db
+        self._lock = file.lock
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM plans').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with _plan_files_lock:
+            file, self._file = self._file, None
+            if file is None:
+                return
+            file.users -= 1
+            if file.users == 0:
+                file.db.close()
+                if _plan_files.get(self._file_key) is file:
+                    del _plan_files[self._file_key]
+
+    def clear(self):
+        """Delete every entry."""
+        with self._lock:
+            self._db.execute('DELETE FROM plans')
+            self._file.count = 0
+
+    def key(self, state, tasks, domain=None):
+        """The key of the problem (state, tasks) in domain (default_domain if None)."""
+        version = self.version
+        with _digests_lock:
+            if version is None:
+                version = _domain_version(default_domain if domain is None else domain)
+            h = hashlib.sha256(_canonical(version))
+            for name, val in sorted(state_variables(state), key=lambda item: item[0]):
+                h.update(_canonical(name))
+                h.update(_static_digest(val) if is_static(val) else _dynamic_digest(name, val))
+        h.update(_canonical(tasks))
+        return h.hexdigest()
+
+    @staticmethod
+    def _replay(plan, state, domain):
+        operators = (default_domain if domain is None else domain).operators
+        final = copy_state(state)
+        for action in plan:
+            operator = operators.get(action[0])
+            final = operator(final, *action[1:]) if operator is not None else False
+            if not final:
+                return None
+        return detach_state(final)
+
+    @staticmethod
+    def _restore(variables, state):
+        final = copy_state(state)
+        for name, val in variables.items():
+            setattr(final, name, val)
+        return detach_state(final)
+
+    def lookup(self, key, state, domain=None):
+        """
+        Return [plan, final state] or [] if key is cached, or None on a miss.
+        The final state is rebuilt from state (see verify).
+        """
+        with self._lock:
+            row = self._db.execute('SELECT plan, state FROM plans WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._db.execute('UPDATE plans SET used = ? WHERE key = ?', (time.time(), key))
+        if row is not None:
+            if row[0] is None:
+                self.hits += 1
+                return []
+            plan = pickle.loads(row[0])
+            if self.verify:
+                final = self._replay(plan, state, domain)
+            else:
+                final = self._restore(pickle.loads(row[1]), state)
+            if final is not None:
+                self.hits += 1
+                return [plan, final]
+            with self._lock:
+                self._db.execute('DELETE FROM plans WHERE key = ?', (key,))
+                self._file.count -= 1
+        self.misses += 1
+        return None
+
+    def store(self, key, result):
+        """Remember result ([plan, final state] or []) under key."""
+        plan = variables = None
+        if result:
+            plan = pickle.dumps(result[0], pickle.HIGHEST_PROTOCOL)
+            # Static variables are not stored: a hit takes them from its state
+            variables = pickle.dumps({name: dict(val.items()) if isinstance(val, (CowDict, FluentMap)) else val
+                                      for name, val in state_variables(result[1]) if not is_static(val)},
+                                     pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock:
+            updated = self._db.execute('UPDATE plans SET plan = ?, state = ?, used = ? WHERE key = ?',
+                                       (plan, variables, now, key)).rowcount
+            if not updated:
+                self._db.execute('INSERT OR REPLACE INTO plans VALUES (?, ?, ?, ?)',
+                                 (key, plan, variables, now))
+                self._file.count += 1
+                self._file.added += 1
+            if self._file.count > self.max_entries or self._file.added > self.max_entries // 16:
+                # Count again: other processes may have added or evicted rows
+                self._file.count = self._db.execute('SELECT COUNT(*) FROM plans').fetchone()[0]
+                self._file.added = 0
+                excess = self._file.count - self.max_entries
+                if excess > 0:
+                    self._db.execute('DELETE FROM plans WHERE key IN '
+                                     '(SELECT key FROM plans ORDER BY used LIMIT ?)', (excess,))
+                    self.evictions += excess
+                    self._file.count -= excess
+
+    def get(self, state, tasks, domain=None):
+        """Return the cached result for (state, tasks), or None (see lookup)."""
+        return self.lookup(self.key(state, tasks, domain), state, domain)
+
+    def put(self, state, tasks, result, domain=None):
+        """Remember result for (state, tasks) (see store)."""
+        self.store(self.key(state, tasks, domain), result)
+
+    def __repr__(self):
+        return f'<PlanCache {self.path!r}: hits={self.hits} misses={self.misses} evictions={self.evictions}>'
+
+
+############################################################
+# The actual planner
+
+class Planner:
+    """
+    Plans with a Domain. The options are the defaults of every plan() call
+    (see pyhop for what they mean). A Planner keeps no state between calls
+    and each call builds its own trail, failure table and tracer, so one
+    Planner can serve plan() calls from many threads at once, as long as
+    each call gets its own state and stats.
+    """
+
+    def __init__(self, domain=None, verbose=0, in_place=False, iterative=False, memo_size=0):
+        self.domain = default_domain if domain is None else domain
+        self.verbose = verbose
+        self.in_place = in_place
+        self.iterative = iterative
+        self.memo_size = memo_size
+
+    def plan(self, state, tasks, stats=None, budget=None, cache=None, **options):
+        """
+        Try to find a plan that accomplishes tasks in state, as pyhop does.
+        options (verbose, in_place, iterative, memo_size) override the
+        Planner's defaults for this call. cache, if given, is a PlanCache
+        looked up before searching and filled in after.
+        """
+        unknown = set(options) - {'verbose', 'in_place', 'iterative', 'memo_size'}
+        if unknown:
+            raise TypeError(f"Unknown planner options: {', '.join(sorted(unknown))}")
+        verbose = options.get('verbose', self.verbose)
+        in_place = options.get('in_place', self.in_place)
+        iterative = options.get('iterative', self.iterative)
+        memo_size = options.get('memo_size', self.memo_size)
+        domain = self.domain
+        if stats is not None:
+            stats.start()
+        if verbose > 0:
+            print(f'\n** pyhop, verbose={verbose}: **\n   state = {state}\n   tasks = {tasks}')
+        trace = make_tracer(verbose)
+        failures = None
+        if memo_size > 0:
+            in_place = iterative = True
+            failures = FailureTable(memo_size)
+        if budget is not None:
+            budget.start()
+        try:
+            result_list = None
+            if cache is not None:
+                key = cache.key(state, tasks, domain)
+                result_list = cache.lookup(key, state, domain)
+            if result_list is None:
+                if in_place:
+                    trail = Trail(hashing=failures is not None)
+                    if stats is None:
+                        state = trailed_state(state, trail)
+                    else:
+                        state = stats.timed_copy(lambda s: trailed_state(s, trail), state)
+                else:
+                    trail = None
+                if iterative:
+                    result_list = seek_plan_iterative(state, tasks, 0, trail, failures, trace, stats, domain,
+                                                      budget)
+                else:
+                    result_list = seek_plan(state, tasks, [], 0, 0, trail, trace, stats, domain, budget)
+                if result_list and not in_place:
+                    detach_state(result_list[1])
+                elif not result_list and budget is not None and budget.depth_cutoff:
+                    result_list = BudgetExhausted('max_depth', budget.nodes, budget.elapsed())
+                if cache is not None and (budget is None or not budget.depth_cutoff):
+                    cache.store(key, result_list or [])
+        except SearchInterrupted as exc:
+            result_list = BudgetExhausted(exc.reason, budget.nodes, budget.elapsed())
+        finally:
+            if stats is not None:
+                stats.stop()
+        if verbose > 0:
+            if not result_list:
+                print('** result =', result_list, '\n')
+            else:
+                print('** result =', result_list[0], '\n')
+                print('** final state =')
+                print_state(result_list[1])
+                print()
+        if isinstance(result_list, BudgetExhausted):
+            return result_list
+        return result_list if result_list else []
+
+    def iter_plans(self, state, tasks, stats=None, budget=None, distinct=False, **options):
+        """
+        Generate [plan, final state] for each plan for tasks in state, first
+        the one plan() would return and then the next ones the same search
+        finds when it backtracks from there. Each plan costs only the search
+        since the previous one. The iterative planner is always used, so
+        the iterative option is ignored.
+        - stats and budget cover the whole enumeration. When the budget runs
+          out the generator just stops; budget.exhausted says why.
+        - distinct: if True, skip plans with the same actions as one already
+          generated (different decompositions can give the same plan).
+        """
+        unknown = set(options) - {'verbose', 'in_place', 'iterative', 'memo_size'}
+        if unknown:
+            raise TypeError(f"Unknown planner options: {', '.join(sorted(unknown))}")
+        verbose = options.get('verbose', self.verbose)
+        in_place = options.get('in_place', self.in_place)
+        memo_size = options.get('memo_size', self.memo_size)
+        if stats is not None:
+            stats.start()
+        if verbose > 0:
+            print(f'\n** pyhop_iter, verbose={verbose}: **\n   state = {state}\n   tasks = {tasks}')
+        trace = make_tracer(verbose)
+        failures = None
+        if memo_size > 0:
+            in_place = True
+            failures = FailureTable(memo_size)
+        if budget is not None:
+            budget.start()
+        seen = set() if distinct else None
+        try:
+            if in_place:
+                trail = Trail(hashing=failures is not None)
+                if stats is None:
+                    state = trailed_state(state, trail)
+                else:
+                    state = stats.timed_copy(lambda s: trailed_state(s, trail), state)
+            else:
+                trail = None
+            plans = seek_plans_iterative(state, tasks, 0, trail, failures, trace, stats, self.domain, budget)
+            for result_list in plans:
+                if seen is not None:
+                    actions = tuple(result_list[0])
+                    if actions in seen:
+                        continue
+                    seen.add(actions)
+                if not in_place:
+                    # The search goes on from the final state's ancestors
+                    result_list[1] = detach_state(copy.copy(result_list[1]))
+                if verbose > 0:
+                    print('** result =', result_list[0], '\n')
+                yield result_list
+        except SearchInterrupted:
+            pass
+        finally:
+            if stats is not None:
+                stats.stop()
+
+    def plan_optimal(self, state, tasks, stats=None, budget=None, cost=None, on_plan=None, verbose=None):
+        """
+        Search for the cheapest plan for tasks in state, with branch and
+        bound (see seek_plan_bnb), and return [plan, final state, cost],
+        [] if there is no plan, or a BudgetExhausted if the budget ran out
+        before any plan was found. If it ran out after, the best plan so
+        far is returned and budget.exhausted says why the search stopped.
+        cost(state, action) gives the cost of each action (by default the
+        domain's action_cost); on_plan(plan, cost) is called for each
+        cheaper plan found. The search is always in place: it backtracks
+        far more than plan does, and writes made by methods must be undone.
+        """
+        verbose = self.verbose if verbose is None else verbose
+        if stats is not None:
+            stats.start()
+        if verbose > 0:
+            print(f'\n** pyhop_optimize, verbose={verbose}: **\n   state = {state}\n   tasks = {tasks}')
+        trace = make_tracer(verbose)
+        if budget is not None:
+            budget.start()
+        try:
+            trail = Trail()
+            if stats is None:
+                state = trailed_state(state, trail)
+            else:
+                state = stats.timed_copy(lambda s: trailed_state(s, trail), state)
+            result_list = seek_plan_bnb(state, tasks, trail, trace, stats, self.domain, budget, cost, on_plan)
+            if not result_list and budget is not None and budget.depth_cutoff:
+                result_list = BudgetExhausted('max_depth', budget.nodes, budget.elapsed())
+        except SearchInterrupted as exc:
+            result_list = BudgetExhausted(exc.reason, budget.nodes, budget.elapsed())
+        finally:
+            if stats is not None:
+                stats.stop()
+        if verbose > 0:
+            if not result_list:
+                print('** result =', result_list, '\n')
+            else:
+                print('** result =', result_list[0], '\n')
+                print('** cost =', result_list[2], '\n')
+                print('** final state =')
+                print_state(result_list[1])
+                print()
+        if isinstance(result_list, BudgetExhausted):
+            return result_list
+        return result_list if result_list else []
+
+    def plan_parallel(self, state, tasks, levels=1, first_found=False, max_workers=None, mp_context=None):
+        """
+        Like plan, but search the alternatives of the first levels choice
+        points in worker processes (see pyhop_parallel and parallel_plan).
+        """
+        if self.verbose > 0:
+            print(f'\n** pyhop_parallel, verbose={self.verbose}: **\n   state = {state}\n   tasks = {tasks}')
+        result_list = parallel_plan(self, state, tasks, levels, first_found, max_workers, mp_context)
+        if self.verbose > 0:
+            if not result_list:
+                print('** result =', result_list, '\n')
+            else:
+                print('** result =', result_list[0], '\n')
+                print('** final state =')
+                print_state(result_list[1])
+                print()
+        return result_list if result_list else []
+
+
+def pyhop_optimize(state, tasks, verbose=0, stats=None, budget=None, cost=None, on_plan=None):
+    """
+    Like pyhop, but keep searching after the first plan and return the
+    cheapest one, as [plan, final state, cost]. Actions cost what
+    declare_costs says (1 if nothing was declared), or cost(state, action)
+    if cost is given. With a budget, e.g. Budget(time_limit=1.0), return
+    the cheapest plan found before the budget ran out (see
+    Planner.plan_optimal).
+    """
+    return Planner(default_domain, verbose).plan_optimal(state, tasks, stats, budget, cost, on_plan)
+
+
+def pyhop(state, tasks, verbose=0, in_place=False, iterative=False, memo_size=0, stats=None, budget=None,
+          cache=None):
+    """
+    Try to find a plan that accomplishes tasks in state, using the operators
+    and methods of default_domain.
+    If successful, return [plan, final state]. Otherwise return [].
+    If in_place is True, search on one trailed working copy of state
+    instead of copying the state before every operator.
+    If iterative is True, use seek_plan_iterative instead of the recursive
+    seek_plan; both return the same plans.
+    If memo_size > 0, remember up to memo_size failed (state, agenda) search
+    nodes and prune them when they are reached again; this implies in_place
+    and iterative, since it relies on the trail to hash states.
+    If stats is a PlanStats, the planner's counters and timings are added
+    to it.
+    If budget is a Budget, the search stops when it runs out and a
+    BudgetExhausted saying which limit was reached is returned instead of [].
+    If cache is a PlanCache, a problem found in it is answered without
+    searching, and the result of the search is stored in it otherwise.
+    """
+    return Planner(default_domain, verbose, in_place, iterative, memo_size).plan(state, tasks, stats, budget,
+                                                                                 cache)
+
+
+def pyhop_iter(state, tasks, verbose=0, in_place=False, memo_size=0, stats=None, budget=None,
+               distinct=False):
+    """
+    Like pyhop, but generate every plan for tasks in state, as
+    [plan, final state] lists, in the order a depth-first search finds
+    them: the first is the plan pyhop returns, and asking for the next one
+    resumes the search where it stopped. With distinct=True, plans with
+    the same actions as an earlier one are skipped. See Planner.iter_plans.
+    """
+    return Planner(default_domain, verbose, in_place, True, memo_size).iter_plans(
+        state, tasks, stats, budget, distinct)
+
+
+def seek_plan(state, tasks, plan, depth, verbose=0, trail=None, trace=None, stats=None, domain=None,
+              budget=None):
+    """
+    Workhorse for pyhop. state and tasks are as in pyhop.
+    - plan is the current partial plan.
+    - depth is the recursion depth, for use in debugging
+    - verbose is whether to print debugging messages
+      (ignored if trace is given)
+    - trail, if given, is the Trail of state: operators are applied to
+      state itself and their writes are undone when a branch fails
+    - trace, if given, is called as trace(event, fields) for each trace event
+    - stats, if given, is a PlanStats to count and time the search in
+    - domain is the Domain to plan with (default_domain if None)
+    - budget, if given, is a started Budget charged for each node
+    """
+    if domain is None:
+        domain = default_domain
+    if verbose > 1 and trace is None:
+        trace = make_tracer(verbose)
+    if budget is not None and budget.expand(depth):
+        if trace is not None:
+            trace('pruned', {'depth': depth, 'reason': 'max_depth'})
+        return False
+    if trace is not None:
+        trace('expand', {'depth': depth, 'tasks': tasks})
+    if stats is not None:
+        stats.expand(depth)
+    if not tasks:
+        if trace is not None:
+            trace('plan', {'depth': depth, 'plan': plan})
+        if trail is None:
+            return [plan, state]
+        if stats is None:
+            return [plan, untrailed_copy(state)]
+        return [plan, stats.timed_copy(untrailed_copy, state)]
+    task1 = tasks[0]
+    operator = domain.operators.get(task1[0])
+    if operator is not None:
+        if trace is not None:
+            trace('operator', {'depth': depth, 'action': task1})
+        if trail is not None:
+            mark = trail.mark()
+        if stats is not None:
+            newstate = stats.apply(operator, state, task1, trail is None)
+        elif trail is None:
+            newstate = operator(copy_state(state), *task1[1:])
+        else:
+            newstate = operator(state, *task1[1:])
+        if trace is not None:
+            trace('operator_result', {'depth': depth, 'action': task1, 'state': newstate})
+        if newstate:
+            solution_list = seek_plan(newstate, tasks[1:], plan + [task1], depth + 1, 0, trail, trace, stats,
+                                      domain, budget)
+            if solution_list:
                 return solution_list
-    if task1[0] in methods:
-        if verbose > 2:
-            print(f'depth {depth} method instance {task1}')
-        relevant = methods[task1[0]]
+        if trail is not None:
+            trail.undo(mark)
+    relevant = domain.methods.get(task1[0])
+    if relevant is not None:
+        if trace is not None:
+            trace('decompose', {'depth': depth, 'task': task1})
         for method in relevant:
-            subtasks = method(state, *task1[1:])
+            if trail is not None:
+                mark = trail.mark()
+            if stats is None:
+                subtasks = method(state, *task1[1:])
+            else:
+                subtasks = stats.call_method(method, state, task1)
             # Can't just say "if subtasks:", because that's wrong if subtasks == []
-            if verbose > 2:
-                print(f'depth {depth} new tasks: {subtasks}')
+            if trace is not None:
+                trace('method', {'depth': depth, 'task': task1, 'method': method, 'subtasks': subtasks})
             if subtasks is not False:
-                solution_list = seek_plan(state, subtasks + tasks[1:], plan, depth + 1, verbose)
+                solution_list = seek_plan(state, subtasks + tasks[1:], plan, depth + 1, 0, trail, trace, stats,
+                                          domain, budget)
                 if solution_list:
                     return solution_list
-    if verbose > 2:
-        print(f'depth {depth} returns failure')
+            if trail is not None:
+                trail.undo(mark)
+    if trace is not None:
+        trace('backtrack', {'depth': depth})
+    if stats is not None:
+        stats.backtracks += 1
     return False
+
+
+############################################################
+# The planner without recursion
+#
+# seek_plan_iterative does the same depth-first search as seek_plan, but it
+# keeps its choice points on an explicit stack, so plan length is not bounded
+# by Python's recursion limit. The task agenda and the partial plan are cons
+# lists (nested pairs) whose tails are shared between search nodes, so that
+# pushing subtasks or appending an action does not copy the whole list.
+
+def cons_list(items, tail=None):
+    """Return the cons list (items[0], (items[1], ... tail))."""
+    for item in reversed(items):
+        tail = (item, tail)
+    return tail
+
+
+def cons_to_list(cons):
+    """Return the elements of the cons list cons as a Python list."""
+    items = []
+    while cons is not None:
+        items.append(cons[0])
+        cons = cons[1]
+    return items
+
+
+def _push_hashes(tasks, hashes):
+    """Extend the cons list of agenda hashes with the hashes of tasks."""
+    for task in reversed(tasks):
+        hashes = (hash((task, hashes[0] if hashes else 0)), hashes)
+    return hashes
+
+
+def _expand(state, agenda, plan, hashes, depth, trail, trace, stats, domain):
+    """
+    Generate the children of the search node (state, agenda, plan) in the
+    order seek_plan tries them. When resumed after a child's subtree has
+    been searched, undo the child's writes to state before the next one.
+    hashes, if not None, is the cons list of hashes of the agenda's tails.
+    """
+    task1, rest = agenda
+    operator = domain.operators.get(task1[0])
+    if operator is not None:
+        if trace is not None:
+            trace('operator', {'depth': depth, 'action': task1})
+        if trail is not None:
+            mark = trail.mark()
+        if stats is not None:
+            newstate = stats.apply(operator, state, task1, trail is None)
+        elif trail is None:
+            newstate = operator(copy_state(state), *task1[1:])
+        else:
+            newstate = operator(state, *task1[1:])
+        if trace is not None:
+            trace('operator_result', {'depth': depth, 'action': task1, 'state': newstate})
+        if newstate:
+            yield newstate, rest, (task1, plan), hashes and hashes[1]
+        if trail is not None:
+            trail.undo(mark)
+    relevant = domain.methods.get(task1[0])
+    if relevant is not None:
+        if trace is not None:
+            trace('decompose', {'depth': depth, 'task': task1})
+        for method in relevant:
+            if trail is not None:
+                mark = trail.mark()
+            if stats is None:
+                subtasks = method(state, *task1[1:])
+            else:
+                subtasks = stats.call_method(method, state, task1)
+            if trace is not None:
+                trace('method', {'depth': depth, 'task': task1, 'method': method, 'subtasks': subtasks})
+            if subtasks is not False:
+                yield (state, cons_list(subtasks, rest), plan,
+                       hashes and _push_hashes(subtasks, hashes[1]))
+            if trail is not None:
+                trail.undo(mark)
+
+
+def seek_plan_iterative(state, tasks, verbose=0, trail=None, failures=None, trace=None, stats=None,
+                        domain=None, budget=None):
+    """
+    Non-recursive equivalent of
+    seek_plan(state, tasks, [], 0, verbose, trail, trace, stats, domain, budget).
+    Return [plan, final state] for the first plan found, or False.
+    The arguments are as in seek_plans_iterative.
+    """
+    plans = seek_plans_iterative(state, tasks, verbose, trail, failures, trace, stats, domain, budget)
+    try:
+        return next(plans, False)
+    finally:
+        plans.close()
+
+
+def seek_plans_iterative(state, tasks, verbose=0, trail=None, failures=None, trace=None, stats=None,
+                         domain=None, budget=None):
+    """
+    Generate [plan, final state] for every plan for tasks in state, in the
+    order seek_plan would find them if it went on after each one. The
+    search is resumed where it stopped each time the next plan is asked for.
+    failures, if given, is a FailureTable: nodes whose whole subtree fails
+    are added to it and skipped when they are reached again. It needs a
+    hashing trail, whose hash identifies the state of each node. Nodes
+    with a plan in their subtree are never added.
+    With a max_depth budget, the depth of a node is part of its key in
+    failures, since a node cut off by max_depth may succeed higher up.
+    """
+    if failures is not None and (trail is None or not trail.hashing):
+        raise ValueError("A FailureTable needs a hashing Trail")
+    if domain is None:
+        domain = default_domain
+    if verbose > 1 and trace is None:
+        trace = make_tracer(verbose)
+    stack = []
+    keys = []
+    agenda, plan = cons_list(tasks), None
+    hashes = _push_hashes(tasks, None) if failures is not None else None
+    depth_keys = budget is not None and budget.max_depth is not None
+    while True:
+        depth = len(stack)
+        if budget is not None and budget.expand(depth):
+            if trace is not None:
+                trace('pruned', {'depth': depth, 'reason': 'max_depth'})
+        else:
+            if trace is not None:
+                trace('expand', {'depth': depth, 'tasks': cons_to_list(agenda)})
+            if stats is not None:
+                stats.expand(depth)
+            if agenda is None:
+                actions = cons_to_list(plan)[::-1]
+                if trace is not None:
+                    trace('plan', {'depth': depth, 'plan': actions})
+                if trail is None:
+                    yield [actions, state]
+                elif stats is None:
+                    yield [actions, untrailed_copy(state)]
+                else:
+                    yield [actions, stats.timed_copy(untrailed_copy, state)]
+                if failures is not None:
+                    keys[:] = [None] * len(keys)
+            elif failures is None:
+                stack.append(_expand(state, agenda, plan, None, depth, trail, trace, stats, domain))
+            else:
+                key = (trail.hash, hashes[0], depth) if depth_keys else (trail.hash, hashes[0])
+                if key in failures:
+                    if trace is not None:
+                        trace('pruned', {'depth': depth})
+                    if stats is not None:
+                        stats.pruned += 1
+                else:
+                    stack.append(_expand(state, agenda, plan, hashes, depth, trail, trace, stats, domain))
+                    keys.append(key)
+        child = None
+        while stack:
+            child = next(stack[-1], None)
+            if child is not None:
+                break
+            stack.pop()
+            if failures is not None:
+                key = keys.pop()
+                if key is not None:
+                    failures.add(key)
+            if trace is not None:
+                trace('backtrack', {'depth': len(stack)})
+            if stats is not None:
+                stats.backtracks += 1
+        if child is None:
+            return
+        state, agenda, plan, hashes = child
+
+
+############################################################
+# Branch and bound
+#
+# seek_plan_bnb searches the same tree as seek_plan_iterative, in the same
+# order, but doesn't stop at the first plan. It keeps the cost of the
+# partial plan of each node (the sum of the costs of its actions, which
+# are never negative) and skips every node whose partial plan already
+# costs as much as the best plan found, so each plan it finds is cheaper
+# than the previous one, and the last one is the cheapest in the tree.
+
+def seek_plan_bnb(state, tasks, trail, trace=None, stats=None, domain=None, budget=None, cost=None,
+                  on_plan=None):
+    """
+    Branch-and-bound search for the cheapest plan for tasks in state, a
+    trailed state (see trailed_state) whose Trail is trail. Return
+    [plan, final state, cost], or False if there is no plan.
+    - cost(state, action) returns the cost of action in state, before the
+      action is applied; by default it is domain.action_cost
+    - on_plan(plan, cost), if given, is called for each cheaper plan found
+    - budget, if given, is a started Budget; when it runs out, the best
+      plan found so far is returned, or SearchInterrupted is raised if
+      there is none
+    The other arguments are as in seek_plan_iterative.
+    """
+    if domain is None:
+        domain = default_domain
+    if cost is None:
+        cost = domain.action_cost
+    operators = domain.operators
+    best = False
+    bound = float('inf')
+    stack = []
+    agenda, plan, spent = cons_list(tasks), None, 0
+    try:
+        while True:
+            depth = len(stack)
+            if budget is not None and budget.expand(depth):
+                if trace is not None:
+                    trace('pruned', {'depth': depth, 'reason': 'max_depth'})
+            elif spent >= bound:
+                if trace is not None:
+                    trace('pruned', {'depth': depth, 'reason': 'bound'})
+                if stats is not None:
+                    stats.pruned += 1
+            else:
+                if trace is not None:
+                    trace('expand', {'depth': depth, 'tasks': cons_to_list(agenda)})
+                if stats is not None:
+                    stats.expand(depth)
+                if agenda is None:
+                    plan_list = cons_to_list(plan)[::-1]
+                    if trace is not None:
+                        trace('plan', {'depth': depth, 'plan': plan_list, 'cost': spent})
+                    if stats is None:
+                        final = untrailed_copy(state)
+                    else:
+                        final = stats.timed_copy(untrailed_copy, state)
+                    best = [plan_list, final, spent]
+                    bound = spent
+                    if on_plan is not None:
+                        on_plan(plan_list, spent)
+                else:
+                    task1 = agenda[0]
+                    # The cost of the operator child, computed before the
+                    # operator changes the state
+                    step = cost(state, task1) if task1[0] in operators else 0
+                    stack.append((_expand(state, agenda, plan, None, depth, trail, trace, stats, domain),
+                                  plan, spent, step))
+            child = None
+            while stack:
+                children, parent_plan, parent_spent, step = stack[-1]
+                child = next(children, None)
+                if child is not None:
+                    state, agenda, plan, _ = child
+                    spent = parent_spent + step if plan is not parent_plan else parent_spent
+                    break
+                stack.pop()
+                if trace is not None:
+                    trace('backtrack', {'depth': len(stack)})
+                if stats is not None:
+                    stats.backtracks += 1
+            if child is None:
+                return best
+    except SearchInterrupted:
+        if best:
+            return best
+        raise
+
+
+############################################################
+# Plan validation
+#
+# validate_plan replays a plan on one copy-on-write copy of the state
+# (copy_state): operators mutate it directly, so each action costs what its
+# operator does, and only the dicts the plan writes get copied, once, on
+# their first write. validate_plans checks many plans against the same
+# initial state, sharing its static variables and unwritten dicts.
+
+class ValidationResult:
+    """
+    The outcome of replaying a plan:
+    - ok: whether every action applied (and check accepted the final state)
+    - index: the position of the first action that failed, len(plan) if
+      check rejected the final state, None if ok
+    - action: the action that failed, or None
+    - reason: why it failed: the domain's description of the violated
+      precondition, the exception the operator raised, or a generic text
+    - state: with keep_state, the final state if ok, else the state the
+      failing action was applied to (which an operator that raised may
+      have left half written); otherwise None
+    A ValidationResult is true if ok.
+    """
+
+    def __init__(self, ok, index=None, action=None, reason=None, state=None):
+        self.ok = ok
+        self.index = index
+        self.action = action
+        self.reason = reason
+        self.state = state
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        if self.ok:
+            return '<ValidationResult ok>'
+        return f'<ValidationResult failed at {self.index} {self.action}: {self.reason}>'
+
+
+def _replay(state, plan, domain, check, keep_state):
+    """Replay plan on state, a copy that the operators modify, continuing
+    after each action from the state its operator returns."""
+    operators = domain.operators
+    result = None
+    for index, action in enumerate(plan):
+        operator = operators.get(action[0])
+        if operator is None:
+            result = ValidationResult(False, index, action, f"{action[0]} is not an operator")
+            break
+        try:
+            applied = operator(state, *action[1:])
+        except Exception as exc:
+            result = ValidationResult(False, index, action, f"{action[0]} raised {exc!r}")
+            break
+        if not applied:
+            explain = domain.preconditions.get(action[0])
+            reason = explain(state, *action[1:]) if explain is not None else None
+            if reason is None:
+                reason = f"{action[0]} is not applicable"
+            result = ValidationResult(False, index, action, reason)
+            break
+        # Operators may return a new state instead of the one they were given
+        state = applied
+    else:
+        if check is not None and not check(state):
+            result = ValidationResult(False, len(plan), None, "the final state fails the check")
+        else:
+            result = ValidationResult(True)
+    if keep_state:
+        result.state = detach_state(state)
+    return result
+
+
+def validate_plans(state, plans, domain=None, check=None, keep_states=False):
+    """
+    Replay each plan of plans from state, with the operators of domain
+    (default_domain if None), and return one ValidationResult per plan.
+    check, if given, is called on the final state of each plan whose
+    actions all apply, and must return a true value to accept it. With
+    keep_states, each result carries its final (or failing) state. state
+    itself is never modified.
+    """
+    domain = default_domain if domain is None else domain
+    return [_replay(copy_state(state), plan, domain, check, keep_states) for plan in plans]
+
+
+def validate_plan(state, plan, domain=None, check=None, keep_state=False):
+    """Replay plan from state and return a ValidationResult (see validate_plans)."""
+    return validate_plans(state, [plan], domain, check, keep_state)[0]
+
+
+############################################################
+# Batch planning
+#
+# plan_batch solves independent problems in a ProcessPoolExecutor. Each
+# worker loads the domain once, when it starts, and then plans every
+# problem it is sent; only the problems and the results cross between
+# processes. A problem that raises is reported as a failed BatchResult and
+# the batch goes on. If a worker process dies, the pool breaks and every
+# problem submitted to it is lost; each worker records the problem it is
+# running in shared memory, so the batch can tell which problems were
+# running at the crash. If only one was, it fails; if several were, each is
+# run again alone, and fails only if it crashes that pool too. The other
+# problems are submitted again to a new pool.
+
+class BatchResult:
+    """
+    The outcome of one problem of a batch:
+    - index: the position of the problem in the batch
+    - result: [plan, final state] as returned by pyhop, [] if no plan
+      was found or planning failed, or a BudgetExhausted
+    - time: seconds the worker spent planning
+    - error: the formatted traceback if planning raised, else None
+    - stats: the problem's PlanStats if the batch collects stats, else None
+    """
+
+    def __init__(self, index, result, time, error=None, stats=None):
+        self.index = index
+        self.result = result
+        self.time = time
+        self.error = error
+        self.stats = stats
+
+    @property
+    def ok(self):
+        """True if a plan was found."""
+        return bool(self.result)
+
+    @property
+    def plan(self):
+        """The plan found, or None."""
+        return self.result[0] if self.result else None
+
+    def __repr__(self):
+        if self.error is not None:
+            outcome = 'error ' + self.error.strip().splitlines()[-1]
+        elif self.result:
+            outcome = f'plan of {len(self.result[0])} actions'
+        elif isinstance(self.result, BudgetExhausted):
+            outcome = f'budget exhausted ({self.result.reason})'
+        else:
+            outcome = 'no plan'
+        return f'<BatchResult {self.index}: {outcome} in {self.time:.6f}s>'
+
+
+def load_domain(domain):
+    """
+    Return the Domain described by domain: a Domain, None for default_domain,
+    or the name of a module to import, whose 'domain' attribute is used if
+    it has one and default_domain otherwise (for modules that declare their
+    operators and methods with the module-level functions).
+    """
+    if domain is None:
+        return default_domain
+    if isinstance(domain, str):
+        module = importlib.import_module(domain)
+        return getattr(module, 'domain', default_domain)
+    return domain
+
+
+_worker_planner = None
+# (shared array, slot of this worker) where _plan_in_worker records the
+# index of the problem it is running, -1 when it is idle
+_worker_slot = None
+
+
+def _init_batch_worker(domain, options, running=None, started=None):
+    global _worker_planner, _worker_slot, tracing
+    # Listeners inherited from a forked parent would write to its files
+    _trace_listeners.clear()
+    tracing = False
+    _worker_planner = Planner(load_domain(domain), **options)
+    if running is not None:
+        with started.get_lock():
+            _worker_slot = (running, started.value % len(running))
+            started.value += 1
+
+
+def _plan_in_worker(index, state, tasks, collect_stats, budget):
+    if _worker_slot is not None:
+        running, slot = _worker_slot
+        running[slot] = index
+    stats = PlanStats() if collect_stats else None
+    start = time.perf_counter()
+    try:
+        result = _worker_planner.plan(state, tasks, stats, budget)
+        error = None
+    except Exception:
+        result = []
+        error = traceback.format_exc()
+    finally:
+        if _worker_slot is not None:
+            running[slot] = -1
+    return BatchResult(index, result, time.perf_counter() - start, error, stats)
+
+
+def plan_batch(problems, domain=None, max_workers=None, ordered=True, stats=False,
+               max_pending=None, mp_context=None, budget=None, **options):
+    """
+    Solve each (state, tasks) pair of the iterable problems in a pool of
+    max_workers processes (os.cpu_count() by default) and yield one
+    BatchResult per problem: in the order of problems if ordered is True,
+    else as soon as each one completes.
+    - domain is a Domain, None for default_domain, or the name of a module
+      that defines it (see load_domain); each worker loads it once. Domains
+      are sent to the workers by pickling, which pickles operators and
+      methods by reference, so they must be defined at module level.
+    - options (verbose, in_place, iterative, memo_size) are the Planner's.
+    - stats: if True, each BatchResult gets the PlanStats of its problem.
+    - budget: a Budget applied to each problem separately (its time_limit
+      counts from the start of each problem); its cancel token, if any,
+      must be picklable. A problem that runs out of budget gets a
+      BatchResult whose result is the BudgetExhausted.
+    - A problem whose worker process dies (e.g. in a crash of a C extension)
+      gets a failed BatchResult; the other problems lost with the pool are
+      planned again in a new one.
+    - max_pending bounds the problems submitted but not yet yielded
+      (4 * max_workers by default), so problems is consumed lazily.
+    - mp_context is passed to ProcessPoolExecutor.
+    """
+    domain = default_domain if domain is None else domain
+    workers = max_workers or os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 4 * workers
+    if mp_context is None:
+        import multiprocessing
+        mp_context = multiprocessing.get_context()
+    # Kept for the whole batch: workers of a broken pool may still be
+    # starting, and unpickling them, after the pool is replaced
+    running = mp_context.Array('q', workers, lock=False)
+    started = mp_context.Value('i', 0)
+    problems = enumerate(problems)
+    exhausted = False
+    executor = None
+    pending = {}
+    finished = {}
+    # Problems lost in a broken pool: to submit again, and to run alone
+    retry = deque()
+    suspects = deque()
+    next_index = 0
+
+    def failed(index, exc):
+        error = ''.join(traceback.format_exception_only(type(exc), exc))
+        return BatchResult(index, [], 0.0, error)
+
+    try:
+        while True:
+            while True:
+                if suspects:
+                    item = None if pending else suspects.popleft()
+                elif retry:
+                    item = retry.popleft()
+                elif not exhausted and len(pending) + len(finished) < max_pending:
+                    item = next(problems, None)
+                    if item is None:
+                        exhausted = True
+                else:
+                    item = None
+                if item is None:
+                    break
+                index, (state, tasks) = item
+                if executor is None:
+                    running[:] = [-1] * workers
+                    executor = ProcessPoolExecutor(workers, mp_context, _init_batch_worker,
+                                                   (domain, options, running, started))
+                try:
+                    pending[executor.submit(_plan_in_worker, index, state, tasks, stats, budget)] = item
+                except BrokenProcessPool:
+                    # Broken by a crash that the pending futures will report
+                    # (or, if there are none, while it was idle)
+                    retry.appendleft(item)
+                    if not pending:
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        executor = None
+                    break
+            if not pending and not finished:
+                if executor is not None:
+                    # Let workers that are still starting finish unpickling
+                    # the shared memory before it is freed
+                    executor.shutdown()
+                    executor = None
+                return
+            if pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in done):
+                    # Every pending future fails with the pool
+                    done, _ = wait(pending)
+                    crashed = {index for index in running if index >= 0}
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    executor = None
+                else:
+                    crashed = None
+                for future in sorted(done, key=lambda future: pending[future][0]):
+                    item = pending.pop(future)
+                    index = item[0]
+                    exc = future.exception()
+                    if exc is None:
+                        finished[index] = future.result()
+                    elif not isinstance(exc, BrokenProcessPool):
+                        finished[index] = failed(index, exc)
+                    elif not crashed or crashed == {index}:
+                        # The problem that crashed the pool, or a pool that
+                        # broke before running any problem
+                        finished[index] = failed(index, exc)
+                    elif index in crashed:
+                        suspects.append(item)
+                    else:
+                        retry.append(item)
+            if ordered:
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+            else:
+                for index in list(finished):
+                    yield finished.pop(index)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+############################################################
+# Parallel search of alternative branches
+#
+# pyhop_parallel expands the search tree in this process down to its first
+# `levels` choice points (nodes with more than one child, such as a task
+# with several applicable methods), following nodes with a single child.
+# The nodes below them form a frontier, in the order a depth-first search
+# would reach them, and each is searched by a worker process. The first
+# frontier node (leftmost) whose search succeeds has the plan seek_plan
+# would return. Branches that can no longer matter are cancelled: futures
+# that have not started are dropped, and running searches poll a flag in
+# shared memory and stop.
+#
+# Methods must not modify the state they are given (the in_place mode
+# relies on this too): a worker searches a copy of its node's state, so
+# changes made by a method are not seen by the methods tried after it.
+
+class _BranchFlag:
+    """The cancel token of branch index: flags[index] in shared memory."""
+
+    def __init__(self, flags, index):
+        self.flags = flags
+        self.index = index
+
+    def is_set(self):
+        return bool(self.flags[self.index])
+
+
+_branch_flags = None
+
+
+def _init_branch_worker(domain, options, flags):
+    global _branch_flags
+    _init_batch_worker(domain, options)
+    _branch_flags = flags
+
+
+def _search_branch(index, state, tasks):
+    flag = _BranchFlag(_branch_flags, index)
+    if flag.is_set():
+        return None
+    return _worker_planner.plan(state, tasks, budget=Budget(cancel=flag))
+
+
+def _or_frontier(state, tasks, domain, levels):
+    """
+    Return the frontier below the first levels choice points of the search
+    for tasks in state, as a list of (state, agenda, plan) nodes in
+    depth-first order, where agenda and plan are cons lists as in
+    seek_plan_iterative (agenda None for a node that completes a plan).
+    Each node gets its own copy of the state.
+    """
+    frontier = []
+    stack = [(state, cons_list(tasks), None, levels)]
+    while stack:
+        state, agenda, plan, levels = stack.pop()
+        while agenda is not None and levels > 0:
+            # Copy each child before generating the next, which may change
+            # a state they share
+            children = [(copy.deepcopy(child_state), child_agenda, child_plan)
+                        for child_state, child_agenda, child_plan, _ in
+                        _expand(state, agenda, plan, None, 0, None, None, None, domain)]
+            if len(children) == 1:
+                state, agenda, plan = children[0]
+                continue
+            for child_state, child_agenda, child_plan in reversed(children):
+                stack.append((child_state, child_agenda, child_plan, levels - 1))
+            break
+        else:
+            frontier.append((state, agenda, plan))
+    return frontier
+
+
+def _leftmost(results, unresolved, first_found):
+    """
+    The answer of the frontier search so far: the plan to return, False if
+    every branch failed, or None if it depends on unresolved branches.
+    """
+    for index, result in enumerate(results):
+        if result:
+            return result
+        if index in unresolved and not first_found:
+            return None
+    return None if unresolved else False
+
+
+def parallel_plan(planner, state, tasks, levels=1, first_found=False, max_workers=None, mp_context=None):
+    """
+    Workhorse for pyhop_parallel and Planner.plan_parallel: search the
+    frontier below the first levels choice points of the search for tasks
+    in state in a pool of up to max_workers processes, with the domain and
+    options of planner. Return [plan, final state], or False.
+    If first_found is False, the plan is the leftmost one, the same that
+    seek_plan returns; else it is the first one any worker finds.
+    """
+    domain = planner.domain
+    frontier = _or_frontier(copy.deepcopy(state), tasks, domain, levels)
+    results = [None] * len(frontier)
+    unresolved = set()
+    for index, (node_state, agenda, plan) in enumerate(frontier):
+        if agenda is None:
+            results[index] = [cons_to_list(plan)[::-1], detach_state(node_state)]
+            # Nodes to the right of a complete plan can't give the answer
+            break
+        unresolved.add(index)
+    answer = _leftmost(results, unresolved, first_found)
+    if answer is not None:
+        return answer
+    options = {'verbose': 0, 'in_place': planner.in_place, 'iterative': True, 'memo_size': planner.memo_size}
+    if len(unresolved) == 1:
+        index = unresolved.pop()
+        node_state, agenda, plan = frontier[index]
+        suffix = Planner(domain, **options).plan(node_state, cons_to_list(agenda))
+        if suffix:
+            results[index] = [cons_to_list(plan)[::-1] + suffix[0], suffix[1]]
+        return _leftmost(results, unresolved, first_found)
+    if mp_context is None:
+        import multiprocessing
+        mp_context = multiprocessing.get_context()
+    flags = mp_context.Array('b', len(frontier), lock=False)
+    workers = min(max_workers or os.cpu_count() or 1, len(unresolved))
+    executor = ProcessPoolExecutor(workers, mp_context, _init_branch_worker, (domain, options, flags))
+    try:
+        pending = {}
+        for index in sorted(unresolved):
+            node_state, agenda, plan = frontier[index]
+            pending[executor.submit(_search_branch, index, node_state, cons_to_list(agenda))] = index
+        while True:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in pending:
+                    # Cancelled by a plan found in another future of done
+                    continue
+                index = pending.pop(future)
+                unresolved.discard(index)
+                suffix = future.result()
+                if suffix:
+                    results[index] = [cons_to_list(frontier[index][2])[::-1] + suffix[0], suffix[1]]
+                    # Cancel the branches that can no longer give the answer
+                    for other, i in list(pending.items()):
+                        if first_found or i > index:
+                            flags[i] = 1
+                            other.cancel()
+                            del pending[other]
+                            unresolved.discard(i)
+            answer = _leftmost(results, unresolved, first_found)
+            if answer is not None:
+                return answer
+    finally:
+        for i in range(len(flags)):
+            flags[i] = 1
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pyhop_parallel(state, tasks, verbose=0, levels=1, first_found=False, max_workers=None,
+                   mp_context=None, in_place=False, memo_size=0):
+    """
+    Like pyhop, but search the alternatives of the first levels choice
+    points of the search in parallel, in up to max_workers processes.
+    If first_found is False (the default), return the same plan pyhop
+    returns, as soon as every branch to its left has failed; otherwise
+    return the first plan found by any branch. Branches whose result is
+    no longer needed are cancelled. in_place and memo_size are used by the
+    workers' searches, which are always iterative.
+    """
+    planner = Planner(default_domain, verbose, in_place, True, memo_size)
+    return planner.plan_parallel(state, tasks, levels, first_found, max_workers, mp_context)
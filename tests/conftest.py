@@ -0,0 +1,36 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import pyhop
+import transportation_domain  # noqa: F401 (declares the operators and methods)
+import transportation_problems
+
+
+def line_problem(length, driver_goal=True):
+    """A problem on a line of length cities joined by walking paths only, with
+    one driver at C0 who must walk to the last city."""
+    cities = [f'C{i}' for i in range(length)]
+    data = {
+        'state': {
+            'locations': cities,
+            'walking_paths': {city: [cities[j] for j in (i - 1, i + 1) if 0 <= j < length]
+                              for i, city in enumerate(cities)},
+            'driving_paths': {city: [] for city in cities},
+            'driver_loc': {'D1': 'C0'},
+            'driver_money': {'D1': 0},
+            'truck_loc': {'T1': 'C0'},
+            'package_loc': {},
+        },
+        'goal': {'driver_goals': {'D1': cities[-1]} if driver_goal else {}},
+    }
+    return transportation_problems.build_problem(data)
+
+
+@pytest.fixture
+def demo():
+    return transportation_problems.demo_problem()
+
@@ -0,0 +1,26 @@
+import pyhop
+import transportation_domain
+
+from conftest import line_problem
+
+
+def plan(state, goal, **options):
+    return pyhop.pyhop(state, [('achieve_goals', goal)], **options)
+
+
+def test_location_indexes_only_keep_occupied_locations():
+    state, goal = line_problem(200)
+    for options in ({}, {'iterative': True}, {'iterative': True, 'in_place': True}):
+        result = plan(state, goal, **options)
+        assert len(result[0]) == 199
+        final = result[1]
+        assert dict(final.drivers_at.items()) == {'C199': frozenset({'D1'})}
+        assert dict(final.trucks_at.items()) == {'C0': frozenset({'T1'})}
+
+
+def test_indexes_match_a_rebuild_after_planning(demo):
+    state, goal = demo
+    final = plan(state, goal, iterative=True)[1]
+    rebuilt = transportation_domain.add_reverse_indexes(pyhop.detach_state(pyhop.copy_state(final)))
+    for name in ('drivers_at', 'trucks_at', 'driver_truck', 'truck_packages'):
+        assert dict(getattr(final, name).items()) == dict(getattr(rebuilt, name).items())
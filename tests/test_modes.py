@@ -0,0 +1,89 @@
+import pytest
+
+import pyhop
+import transportation_benchmark
+import transportation_decomposition
+import transportation_domain
+import transportation_problems
+import transportation_repair
+
+DYNAMIC = ('driver_loc', 'driver_money', 'truck_loc', 'truck_driver', 'package_loc', 'unmet_goals')
+
+
+@pytest.fixture(params=['demo', 'generated'])
+def problem(request):
+    if request.param == 'demo':
+        state, goal = transportation_problems.demo_problem()
+    else:
+        state, goal = transportation_benchmark.generate_problem(12, 16, 4, 3, 10, driving_density=0.3,
+                                                                driver_goals=2, truck_goals=1, seed=3)
+    tasks = [('achieve_goals', goal)]
+    return state, goal, tasks, pyhop.pyhop(state, tasks)
+
+
+def dynamic(state):
+    return {name: dict(getattr(state, name).items()) for name in DYNAMIC}
+
+
+def solves(state, goal, plan):
+    initial = transportation_domain.add_goal_agenda(pyhop.copy_state(state), goal)
+    return bool(pyhop.validate_plan(initial, plan, check=lambda s: not s.unmet_goals))
+
+
+def same_result(result, baseline):
+    return result[0] == baseline[0] and dynamic(result[1]) == dynamic(baseline[1])
+
+
+@pytest.mark.parametrize('options', [
+    {'iterative': True},
+    {'in_place': True},
+    {'in_place': True, 'iterative': True},
+    {'memo_size': 1000},
+])
+def test_planner_modes_match_pyhop(problem, options):
+    state, goal, tasks, baseline = problem
+    assert baseline and solves(state, goal, baseline[0])
+    assert same_result(pyhop.pyhop(state, tasks, **options), baseline)
+
+
+def test_compact_state_matches_pyhop(problem):
+    state, goal, tasks, baseline = problem
+    compact = transportation_domain.compact_state(state)
+    for options in ({'iterative': True}, {'memo_size': 1000}):
+        assert same_result(pyhop.pyhop(compact, tasks, **options), baseline)
+
+
+def test_first_of_pyhop_iter_matches_pyhop(problem):
+    state, goal, tasks, baseline = problem
+    assert same_result(next(pyhop.pyhop_iter(state, tasks)), baseline)
+
+
+def test_parallel_modes_match_pyhop(problem):
+    state, goal, tasks, baseline = problem
+    assert same_result(pyhop.pyhop_parallel(state, tasks, max_workers=2), baseline)
+    batch = list(pyhop.plan_batch([(state, tasks)] * 2, max_workers=2, iterative=True))
+    assert all(same_result(result.result, baseline) for result in batch)
+
+
+def test_cache_hit_matches_pyhop(problem, tmp_path):
+    state, goal, tasks, baseline = problem
+    with pyhop.PlanCache(str(tmp_path / 'plans.db')) as cache:
+        for _ in range(2):
+            assert same_result(pyhop.pyhop(state, tasks, iterative=True, cache=cache), baseline)
+        assert cache.hits == 1
+
+
+def test_validate_plan_reaches_the_final_state(problem):
+    state, goal, tasks, baseline = problem
+    initial = transportation_domain.add_goal_agenda(pyhop.copy_state(state), goal)
+    checked = pyhop.validate_plan(initial, baseline[0], keep_state=True)
+    assert checked and dynamic(checked.state) == dynamic(baseline[1])
+
+
+def test_decomposed_and_repaired_plans_solve_the_problem(problem):
+    state, goal, tasks, baseline = problem
+    decomposed = transportation_decomposition.plan_decomposed(state, goal, max_workers=1, iterative=True)
+    assert solves(state, goal, decomposed[0])
+    executed = len(baseline[0]) // 2
+    repaired = transportation_repair.repair_plan(state, goal, baseline[0], executed, iterative=True)
+    assert solves(state, goal, baseline[0][:executed] + repaired[0])
@@ -0,0 +1,54 @@
+import hashlib
+import os
+import tempfile
+
+import pytest
+
+import pyhop
+import transportation_problems
+
+
+@pytest.fixture
+def problem_file(tmp_path, demo):
+    path = tmp_path / 'demo.json'
+    transportation_problems.save_problem(path, *demo)
+    return path
+
+
+def plan_of(problem):
+    state, goal = problem
+    return pyhop.pyhop(state, [('achieve_goals', goal)], iterative=True)[0]
+
+
+def cache_file(path):
+    content = path.read_bytes() + f'#{transportation_problems.CACHE_VERSION}'.encode()
+    return transportation_problems.cache_path(str(path), hashlib.sha256(content).hexdigest())
+
+
+@pytest.mark.parametrize('stale', [b'cno_such_module\nThing\n.', b'ctransportation_problems\nNoSuchThing\n.',
+                                   b'not a pickle', b''])
+def test_stale_cache_is_rebuilt(problem_file, demo, stale):
+    with open(cache_file(problem_file), 'wb') as f:
+        f.write(stale)
+    assert plan_of(transportation_problems.load_problem(problem_file)) == plan_of(demo)
+    # The rebuilt problem replaced the stale cache
+    assert plan_of(transportation_problems.load_problem(problem_file)) == plan_of(demo)
+    with open(cache_file(problem_file), 'rb') as f:
+        assert f.read() != stale
+
+
+def test_missing_cache_dir(problem_file, demo, tmp_path):
+    missing = tmp_path / 'missing'
+    problem = transportation_problems.load_problem(problem_file, cache_dir=str(missing))
+    assert plan_of(problem) == plan_of(demo)
+    assert not missing.exists()
+
+
+def test_unwritable_cache_dir(problem_file, demo, monkeypatch):
+    def mkstemp(*args, **kwargs):
+        raise PermissionError('read-only')
+
+    monkeypatch.setattr(tempfile, 'mkstemp', mkstemp)
+    problem = transportation_problems.load_problem(problem_file)
+    assert plan_of(problem) == plan_of(demo)
+    assert not os.path.exists(cache_file(problem_file))
@@ -0,0 +1,128 @@
+import os
+
+import pyhop
+
+
+def spending_domain():
+    """A domain whose first method for 'buy' spends money and then fails, so
+    the search must give the money back before trying the second one."""
+    domain = pyhop.Domain('spending')
+
+    def spend(state, amount):
+        if state.money >= amount:
+            state.money = state.money - amount
+            return state
+        return False
+
+    def fail(state):
+        return False
+
+    def buy_dear(state):
+        return [('spend', 5), ('fail',)]
+
+    def buy_cheap(state):
+        return [('spend', 3), ('spend', 3)]
+
+    domain.declare_operators(spend, fail)
+    domain.declare_methods('buy', buy_dear, buy_cheap)
+    return domain
+
+
+def test_backtracking_undoes_rebound_variables():
+    domain = spending_domain()
+    state = pyhop.State('wallet')
+    state.money = 7
+    expected = [('spend', 3), ('spend', 3)]
+    for options in ({}, {'iterative': True}, {'in_place': True}, {'in_place': True, 'iterative': True},
+                    {'memo_size': 10}):
+        plan, final = pyhop.Planner(domain, **options).plan(state, [('buy',)])
+        assert plan == expected, options
+        assert final.money == 1 and type(final) is pyhop.State
+    plan, final, cost = pyhop.Planner(domain).plan_optimal(state, [('buy',)])
+    assert plan == expected and final.money == 1 and type(final) is pyhop.State
+    assert state.money == 7
+
+
+def test_trail_hash_follows_rebinding_and_undo():
+    state = pyhop.State('s')
+    state.a = 1
+    state.d = {'k': 1}
+    trail = pyhop.Trail(hashing=True)
+    work = pyhop.trailed_state(state, trail)
+    start = trail.hash
+    mark = trail.mark()
+    work.a = 2
+    work.b = [1]
+    work.b.append(2)
+    work.d = {'z': 3}
+    work.d['y'] = 4
+    del work.a
+    assert trail.hash == pyhop.state_hash(work) != start
+    trail.undo(mark)
+    assert trail.hash == pyhop.state_hash(work) == start
+    assert pyhop.state_variables(work) == [('d', {'k': 1}), ('a', 1)]
+
+
+def crash_if(state, doomed):
+    if doomed:
+        os._exit(1)
+    state.done = True
+    return state
+
+
+crashing_domain = pyhop.Domain('crashing')
+crashing_domain.declare_operators(crash_if)
+
+
+def test_batch_fails_only_the_problem_that_crashed_its_worker():
+    state = pyhop.State('s')
+    problems = [(state, [('crash_if', i == 5)]) for i in range(12)]
+    for workers in (1, 3):
+        results = list(pyhop.plan_batch(problems, crashing_domain, max_workers=workers))
+        assert [r.index for r in results] == list(range(12))
+        assert [r.ok for r in results] == [i != 5 for i in range(12)]
+        assert 'BrokenProcessPool' in results[5].error
+
+
+def cache_key(**variables):
+    state = pyhop.State('s')
+    for name, value in variables.items():
+        setattr(state, name, value)
+    with pyhop.PlanCache(':memory:', version='v') as cache:
+        return cache.key(state, [('task',)])
+
+
+def test_plan_cache_keys_identify_states_by_content():
+    assert cache_key(loc={'a': 'x', 'b': 'y'}) == cache_key(loc={'b': 'y', 'a': 'x'})
+    assert cache_key(at={'x': frozenset({'a', 'b'})}) == cache_key(at={'x': frozenset({'b', 'a'})})
+    keys = {cache_key(loc={'a': value}) for value in (1, '1', True, None, 1.5, ('x',), frozenset({'x'}), ['x'])}
+    assert len(keys) == 8
+    assert cache_key(loc={('a', 1): 'x'}) != cache_key(loc={('a', '1'): 'x'})
+
+
+def test_plan_cache_key_follows_writes_to_the_same_dict():
+    state = pyhop.State('s')
+    state.loc = {'a': 'x', 'b': 'y'}
+    with pyhop.PlanCache(':memory:', version='v') as cache:
+        first = cache.key(state, [('task',)])
+        assert cache.key(state, [('task',)]) == first
+        state.loc['a'] = 'z'
+        assert cache.key(state, [('task',)]) != first
+        state.loc['a'] = 'x'
+        assert cache.key(state, [('task',)]) == first
+
+
+def test_plan_caches_of_a_file_share_its_connection(tmp_path, demo):
+    state, goal = demo
+    tasks = [('achieve_goals', goal)]
+    path = str(tmp_path / 'plans.db')
+    first = pyhop.PlanCache(path)
+    second = pyhop.PlanCache(path)
+    assert first._db is second._db
+    plan = pyhop.pyhop(state, tasks, iterative=True, cache=first)
+    first.close()
+    assert pyhop.pyhop(state, tasks, iterative=True, cache=second)[0] == plan[0]
+    assert second.hits == 1
+    second.close()
+    with pyhop.PlanCache(path) as third:
+        assert len(third) == 1
@@ -0,0 +1,121 @@
+import random
+
+import pyhop
+import transportation_routing
+
+
+def random_graph(n, seed, weighted=True):
+    """A connected graph of n nodes (a random tree, both ways) plus n random
+    one-way edges, with random weights if weighted."""
+    rng = random.Random(seed)
+    nodes = [f'N{i}' for i in range(n)]
+    paths = {node: [] for node in nodes}
+    distances = {node: {} for node in nodes}
+
+    def add(a, b):
+        if a != b and b not in paths[a]:
+            paths[a].append(b)
+            distances[a][b] = rng.randint(1, 100)
+
+    for i in range(1, n):
+        j = rng.randrange(i)
+        add(nodes[i], nodes[j])
+        add(nodes[j], nodes[i])
+    for _ in range(n):
+        add(*rng.sample(nodes, 2))
+    return nodes, paths, distances if weighted else None
+
+
+def test_distance_matrix_matches_route_indexes():
+    for weighted in (True, False):
+        nodes, paths, distances = random_graph(120, seed=1, weighted=weighted)
+        matrix = transportation_routing.DistanceMatrix(paths, distances)
+        if weighted:
+            index = transportation_routing.WeightedRouteIndex(paths, distances)
+        else:
+            index = transportation_routing.RouteIndex(paths)
+        rng = random.Random(2)
+        for _ in range(300):
+            start, end = rng.choice(nodes), rng.choice(nodes)
+            if weighted:
+                expected = index.distance(start, end)
+            else:
+                path = index.path(start, end)
+                expected = None if path is None else len(path) - 1
+            assert matrix.distance(start, end) == expected
+
+
+def test_nearest_picks_the_first_closest_location():
+    nodes, paths, distances = random_graph(80, seed=3)
+    matrix = transportation_routing.DistanceMatrix(paths, distances)
+    rng = random.Random(4)
+    locations = [rng.choice(nodes) for _ in range(20)] + ['nowhere']
+    for target in nodes:
+        found = [matrix.distance(loc, target) for loc in locations]
+        reachable = [d for d in found if d is not None]
+        expected = found.index(min(reachable)) if reachable else None
+        assert matrix.nearest(locations, target) == expected
+    assert matrix.nearest([], nodes[0]) is None
+    assert matrix.nearest(nodes, 'nowhere') is None
+
+
+def test_distance_matrix_keeps_at_most_max_rows():
+    nodes, paths, distances = random_graph(50, seed=5)
+    matrix = transportation_routing.DistanceMatrix(paths, distances, max_rows=4)
+    for target in nodes:
+        matrix.row(target)
+    assert len(matrix.rows) == 4
+
+
+def test_weighted_route_index_keeps_at_most_max_routes():
+    nodes, paths, distances = random_graph(50, seed=6)
+    index = transportation_routing.WeightedRouteIndex(paths, distances, max_routes=8)
+    fresh = transportation_routing.WeightedRouteIndex(paths, distances)
+    for end in nodes:
+        assert index.route(nodes[0], end) == fresh.route(nodes[0], end)
+    assert len(index.routes) == 8
+    # Forgotten routes are searched again
+    assert index.route(nodes[0], nodes[1]) == fresh.route(nodes[0], nodes[1])
+
+
+def test_distance_without_a_cached_row_agrees_with_the_row():
+    nodes, paths, distances = random_graph(100, seed=6)
+    matrix = transportation_routing.DistanceMatrix(paths, distances)
+    rng = random.Random(7)
+    pairs = [(rng.choice(nodes), rng.choice(nodes)) for _ in range(200)]
+    searched = [matrix.distance(start, end) for start, end in pairs]
+    assert len(matrix.rows) == 0
+    for (start, end), d in zip(pairs, searched):
+        row = matrix.row(end)
+        assert d == (None if row[matrix.ids[start]] == float('inf') else row[matrix.ids[start]])
+
+
+def test_carried_rows_match_a_fresh_matrix_after_a_change():
+    nodes, paths, distances = random_graph(150, seed=8)
+    paths = pyhop.freeze(paths)
+    distances = pyhop.freeze(distances)
+    rng = random.Random(9)
+    total = 0
+    for change in ('remove', 'lengthen', 'add'):
+        matrix = transportation_routing.distance_matrix(paths, distances)
+        for target in nodes:
+            matrix.row(target)
+        new_paths = {node: list(neighbors) for node, neighbors in paths.items()}
+        new_distances = {node: dict(weights) for node, weights in distances.items()}
+        a = rng.choice([node for node in nodes if new_paths[node]])
+        if change == 'remove':
+            del new_distances[a][new_paths[a].pop()]
+        elif change == 'lengthen':
+            new_distances[a][new_paths[a][0]] += 50
+        else:
+            b = next(node for node in nodes if node != a and node not in new_paths[a])
+            new_paths[a].append(b)
+            new_distances[a][b] = 30
+        new_paths = pyhop.freeze(new_paths)
+        new_distances = pyhop.freeze(new_distances)
+        total += transportation_routing.carry_distance_rows(paths, distances, new_paths, new_distances)
+        patched = transportation_routing.distance_matrix(new_paths, new_distances)
+        fresh = transportation_routing.DistanceMatrix(new_paths, new_distances)
+        for target in nodes:
+            assert patched.row(target) == fresh.row(target)
+    assert total > 0
@@ -0,0 +1,206 @@
+"""
+Banco de pruebas del dominio de transporte.
+Genera problemas aleatorios (pero resolubles) de tamaño configurable, los
+resuelve con pyhop varias veces y mide el tiempo, los nodos expandidos, la
+longitud del plan y el pico de memoria, para detectar regresiones a medida
+que crecen los problemas.
+
+Uso:
+    python transportation_benchmark.py                 # batería por defecto
+    python transportation_benchmark.py --size 20 30 10 8 100 --repeat 5
+    python transportation_benchmark.py --json resultados.json
+"""
+
+import argparse
+import json
+import math
+import random
+import statistics
+import time
+
+import pyhop
+import transportation_domain
+
+# Batería por defecto: (ciudades, conectores, conductores, camiones, paquetes)
+DEFAULT_SIZES = [
+    (6, 8, 6, 4, 6),
+    (10, 15, 8, 6, 20),
+    (20, 30, 12, 10, 50),
+    (40, 60, 20, 16, 100),
+    (60, 90, 30, 24, 200),
+]
+
+
+def generate_problem(cities, connectors, drivers, trucks, packages,
+                     driving_density=1.0, driver_goals=0, truck_goals=0, seed=None):
+    """Generar un estado y un objetivo aleatorios.
+    - cities: número de ciudades; la red de conducción entre ellas es conexa
+      (un árbol aleatorio más cada otro par con probabilidad driving_density)
+      y cada tramo tiene la distancia euclídea entre las ciudades.
+    - connectors: número de puntos de conexión peatonal; cada uno une dos
+      ciudades, y los primeros cities - 1 forman un árbol, así que la red
+      peatonal también es conexa.
+    - drivers, trucks, packages: tamaño de la flota y número de paquetes,
+      situados en ciudades al azar; cada paquete tiene una ciudad destino.
+    - driver_goals, truck_goals: cuántos conductores y camiones tienen
+      también una ciudad destino.
+    Como ambas redes son conexas y hay al menos un conductor y un camión,
+    todos los objetivos son alcanzables. Aun así, algunos métodos del dominio
+    llevan el camión hasta el paquete en un solo tramo, por eso la red de
+    conducción es completa por defecto (driving_density=1.0); ver también
+    solvable_problem."""
+    if cities < 1 or drivers < 1 or trucks < 1:
+        raise ValueError("Hace falta al menos una ciudad, un conductor y un camión")
+    if not cities - 1 <= connectors <= cities * (cities - 1) // 2:
+        raise ValueError(f"Con {cities} ciudades hacen falta entre {cities - 1} y "
+                         f"{cities * (cities - 1) // 2} conectores")
+    rng = random.Random(seed)
+    names = [f'C{i}' for i in range(cities)]
+    coords = {city: (rng.uniform(0, 1000), rng.uniform(0, 1000)) for city in names}
+
+    def distance(a, b):
+        return max(1, round(math.dist(coords[a], coords[b])))
+
+    def random_tree():
+        order = names[:]
+        rng.shuffle(order)
+        return [(order[i], order[rng.randrange(i)]) for i in range(1, len(order))]
+
+    # Red de conducción: árbol aleatorio más pares extra
+    driving_edges = set(frozenset(edge) for edge in random_tree())
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            if rng.random() < driving_density:
+                driving_edges.add(frozenset((a, b)))
+    driving_paths = {city: [] for city in names}
+    driving_distances = {city: {} for city in names}
+    for a, b in sorted(tuple(sorted(edge)) for edge in driving_edges):
+        driving_paths[a].append(b)
+        driving_paths[b].append(a)
+        driving_distances[a][b] = driving_distances[b][a] = distance(a, b)
+
+    # Red peatonal: un punto de conexión por par de ciudades unidas
+    walking_pairs = [tuple(sorted(edge)) for edge in random_tree()]
+    used = set(walking_pairs)
+    all_pairs = [(a, b) for i, a in enumerate(names) for b in names[i + 1:]]
+    rng.shuffle(all_pairs)
+    for pair in all_pairs:
+        if len(walking_pairs) >= connectors:
+            break
+        if pair not in used:
+            used.add(pair)
+            walking_pairs.append(pair)
+    walking_paths = {city: [] for city in names}
+    for a, b in walking_pairs:
+        connector = f'Path_{a}_{b}'
+        walking_paths[a].append(connector)
+        walking_paths[b].append(connector)
+        walking_paths[connector] = [a, b]
+
+    state = pyhop.State('state')
+    state.locations = names + [f'Path_{a}_{b}' for a, b in walking_pairs]
+    state.walking_paths = walking_paths
+    state.driving_paths = driving_paths
+    state.driving_distances = driving_distances
+    state.drivers = [f'D{i + 1}' for i in range(drivers)]
+    state.driver_loc = {d: rng.choice(names) for d in state.drivers}
+    state.driver_money = {d: rng.randint(10, 30) for d in state.drivers}
+    state.trucks = [f'T{i + 1}' for i in range(trucks)]
+    state.truck_loc = {t: rng.choice(names) for t in state.trucks}
+    state.truck_driver = {t: None for t in state.trucks}
+    state.packages = [f'P{i + 1}' for i in range(packages)]
+    state.package_loc = {p: rng.choice(names) for p in state.packages}
+    pyhop.declare_static(state, 'locations', 'walking_paths', 'driving_paths',
+                         'driving_distances', 'drivers', 'trucks', 'packages')
+    transportation_domain.add_reverse_indexes(state)
+
+    goal = pyhop.Goal('goal')
+    goal.package_goals = {p: rng.choice(names) for p in state.packages}
+    goal.driver_goals = {d: rng.choice(names) for d in rng.sample(state.drivers, min(driver_goals, drivers))}
+    goal.truck_goals = {t: rng.choice(names) for t in rng.sample(state.trucks, min(truck_goals, trucks))}
+    transportation_domain.add_goal_agenda(state, goal)
+    return state, goal
+
+
+def solvable_problem(size, seed=0, max_tries=100, **options):
+    """Generar problemas de tamaño size (tupla de generate_problem) con las
+    semillas seed, seed + 1, ... hasta que pyhop(**options) encuentre un
+    plan, y devolver (state, goal, semilla usada). Las estrategias del
+    dominio no son completas, así que no basta con que sea alcanzable."""
+    for k in range(max_tries):
+        state, goal = generate_problem(*size, seed=seed + k)
+        if pyhop.pyhop(state, [('achieve_goals', goal)], **options):
+            return state, goal, seed + k
+    raise ValueError(f"Ningún problema de tamaño {size} resuelto en {max_tries} intentos")
+
+
+def run_benchmark(size, repeat=3, seed=0, **options):
+    """Resolver un problema resoluble de tamaño size (ver solvable_problem)
+    repeat veces con pyhop(**options) y devolver un diccionario con los
+    tiempos (mínimo y mediana), nodos expandidos, longitud del plan y pico
+    de memoria. El pico se mide en una ejecución aparte, porque tracemalloc
+    ralentiza la búsqueda. Si el plan encontrado deja objetivos sin cumplir
+    en su estado final se lanza RuntimeError."""
+    state, goal, seed = solvable_problem(size, seed, **options)
+    tasks = [('achieve_goals', goal)]
+    times = []
+    stats = None
+    result = []
+    for _ in range(repeat):
+        stats = pyhop.PlanStats()
+        start = time.perf_counter()
+        result = pyhop.pyhop(state, tasks, stats=stats, **options)
+        times.append(time.perf_counter() - start)
+    if result and result[1].unmet_goals:
+        raise RuntimeError(f"El plan del problema de tamaño {size} (semilla {seed}) deja sin cumplir "
+                           f"{sorted(result[1].unmet_goals)}")
+    memory = pyhop.PlanStats(track_memory=True)
+    pyhop.pyhop(state, tasks, stats=memory, **options)
+    return {
+        'size': dict(zip(('cities', 'connectors', 'drivers', 'trucks', 'packages'), size)),
+        'seed': seed,
+        'solved': bool(result),
+        'min_time': min(times),
+        'median_time': statistics.median(times),
+        'nodes': stats.nodes,
+        'backtracks': stats.backtracks,
+        'plan_length': len(result[0]) if result else None,
+        'peak_memory': memory.peak_memory,
+    }
+
+
+def print_results(results):
+    """Imprimir una tabla con los resultados de run_benchmark."""
+    print(f"{'SIZE':<22} | {'SOLVED':<6} | {'MIN S':>9} | {'MEDIAN S':>9} | "
+          f"{'NODES':>8} | {'PLAN':>6} | {'PEAK KB':>9}")
+    for r in results:
+        size = '/'.join(str(n) for n in r['size'].values())
+        plan = r['plan_length'] if r['plan_length'] is not None else '-'
+        print(f"{size:<22} | {str(r['solved']):<6} | {r['min_time']:9.4f} | {r['median_time']:9.4f} | "
+              f"{r['nodes']:8} | {plan:>6} | {r['peak_memory'] / 1024:9.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', nargs=5, type=int, action='append',
+                        metavar=('CITIES', 'CONNECTORS', 'DRIVERS', 'TRUCKS', 'PACKAGES'),
+                        help='tamaño de un problema (se puede repetir); por defecto, la batería estándar')
+    parser.add_argument('--repeat', type=int, default=3, help='ejecuciones cronometradas por problema')
+    parser.add_argument('--seed', type=int, default=0, help='semilla del generador')
+    parser.add_argument('--recursive', action='store_true',
+                        help='usar el seek_plan recursivo en lugar del iterativo')
+    parser.add_argument('--in-place', action='store_true', help='buscar sobre un estado con trail')
+    parser.add_argument('--memo-size', type=int, default=0, help='tamaño de la tabla de fallos')
+    parser.add_argument('--json', metavar='FILE', help='guardar también los resultados en FILE')
+    args = parser.parse_args(argv)
+    options = {'iterative': not args.recursive, 'in_place': args.in_place, 'memo_size': args.memo_size}
+    results = [run_benchmark(tuple(size), args.repeat, args.seed, **options)
+               for size in (args.size or DEFAULT_SIZES)]
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'options': options, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
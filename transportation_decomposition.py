@@ -0,0 +1,206 @@
+"""
+Descomposición de problemas de transporte en subproblemas independientes.
+En un problema grande muchos objetivos de paquetes tocan regiones y
+recursos disjuntos, pero achieve_goals los resuelve uno tras otro en una
+única búsqueda. plan_decomposed reparte los objetivos en grupos que no
+comparten camiones ni conductores, resuelve cada grupo en su propio proceso
+con pyhop.plan_batch y concatena los subplanes.
+
+Los grupos se forman así:
+- Dos objetos en regiones distintas (componentes conexas de la unión de las
+  redes peatonal y de conducción) nunca interactúan.
+- Dentro de cada región, cada paquete va con el camión que lo lleva o con
+  el camión más cercano, y cada camión forma un grupo con sus paquetes.
+- Cada grupo recibe el conductor del camión o el conductor libre más
+  cercano; si no quedan conductores, el camión se une a otro grupo de su
+  región.
+- Los objetivos de conductores y camiones van con el grupo que los usa, o
+  forman un grupo propio si nadie los usa.
+
+Como los grupos no comparten objetos, los subplanes se pueden ejecutar uno
+detrás de otro. Aun así el plan combinado se comprueba sobre el estado
+completo, y si algún grupo no tiene plan o la comprobación falla, se
+planifica el problema entero de una vez.
+"""
+
+import contextlib
+import copy
+
+import pyhop
+import transportation_domain
+import transportation_routing
+
+
+class GoalCluster:
+    """Grupo de objetivos que se planifica por separado, con los conductores,
+    camiones y paquetes que puede usar y su objetivo (un pyhop.Goal)."""
+
+    def __init__(self, drivers, trucks, packages, goal):
+        self.drivers = drivers
+        self.trucks = trucks
+        self.packages = packages
+        self.goal = goal
+
+    def __repr__(self):
+        return (f"GoalCluster(drivers={self.drivers}, trucks={self.trucks}, "
+                f"packages={self.packages})")
+
+
+def partition_goals(state, goal):
+    """Repartir los objetivos de goal en una lista de GoalCluster que no
+    comparten conductores, camiones ni paquetes (ver el docstring del
+    módulo). Los objetivos ya cumplidos de objetos que ningún grupo usa no
+    van a ningún grupo. Si algún paquete no tiene ningún camión que llegue
+    hasta él, devuelve un único grupo con todo el problema."""
+    regions = transportation_routing.components(state.walking_paths, state.driving_paths)
+    driving = transportation_routing.state_distance_matrix(state, 'driving')
+    walking = transportation_routing.state_distance_matrix(state, 'walking')
+
+    def region_of(loc):
+        region = regions.of(loc)
+        return loc if region is None else region
+
+    # Paquetes: con su camión o con el camión más cercano de su región
+    trucks_by_region = {}
+    for truck, loc in state.truck_loc.items():
+        trucks_by_region.setdefault(region_of(loc), []).append(truck)
+    packages_of = {}
+    for package, target in goal.package_goals.items():
+        loc = state.package_loc[package]
+        if loc == target:
+            continue
+        if loc in state.truck_loc:
+            truck = loc
+        else:
+            trucks = trucks_by_region.get(region_of(loc), [])
+            i = driving.nearest([state.truck_loc[t] for t in trucks], loc)
+            if i is None:
+                # Ningún camión llega al paquete: no hay nada que repartir
+                return [GoalCluster(list(state.driver_loc), list(state.truck_loc),
+                                    list(goal.package_goals), goal)]
+            truck = trucks[i]
+        packages_of.setdefault(truck, []).append(package)
+    for truck, target in goal.truck_goals.items():
+        if state.truck_loc[truck] != target:
+            packages_of.setdefault(truck, [])
+
+    # Conductores: primero los camiones con más paquetes
+    clusters = {}
+    orphans = []
+    free = [d for d, truck in state.driver_truck.items() if truck is None]
+    for truck in sorted(packages_of, key=lambda t: -len(packages_of[t])):
+        driver = state.truck_driver[truck]
+        if driver is None:
+            i = walking.nearest([state.driver_loc[d] for d in free], state.truck_loc[truck])
+            if i is not None:
+                driver = free.pop(i)
+        if driver is None:
+            orphans.append(truck)
+        else:
+            clusters[truck] = ([driver], [truck], packages_of[truck])
+    # Los camiones sin conductor se unen a un grupo de su región que lo tenga
+    for truck in orphans:
+        r = region_of(state.truck_loc[truck])
+        key = next((k for k, c in clusters.items()
+                    if c[0] and region_of(state.truck_loc[k]) == r), truck)
+        cluster = clusters.setdefault(key, ([], [], []))
+        cluster[1].append(truck)
+        cluster[2].extend(packages_of[truck])
+
+    # Objetivos de conductores que ningún grupo usa: un grupo propio, con
+    # el camión en el que vayan
+    cluster_of = {}
+    for key, (drivers, trucks, _) in clusters.items():
+        cluster_of.update((obj, key) for obj in drivers + trucks)
+    for driver, target in goal.driver_goals.items():
+        if driver not in cluster_of and state.driver_loc[driver] != target:
+            truck = state.driver_truck[driver]
+            key = ('driver', driver)
+            clusters[key] = ([driver], [] if truck is None else [truck], [])
+            cluster_of[driver] = key
+            if truck is not None:
+                cluster_of[truck] = key
+
+    result = []
+    for key, (drivers, trucks, packages) in clusters.items():
+        sub = pyhop.Goal(f'{goal.__name__}_{len(result) + 1}')
+        sub.package_goals = {p: goal.package_goals[p] for p in packages}
+        sub.driver_goals = {d: t for d, t in goal.driver_goals.items() if cluster_of.get(d) == key}
+        sub.truck_goals = {t: g for t, g in goal.truck_goals.items() if cluster_of.get(t) == key}
+        result.append(GoalCluster(drivers, trucks, packages, sub))
+    return result
+
+
+def subproblem(state, cluster):
+    """Estado reducido a los conductores, camiones y paquetes del grupo (más
+    los paquetes que ya van en sus camiones), con sus índices inversos y su
+    agenda de objetivos, en el orden de la de state si la tiene. Las
+    variables estáticas se comparten con state."""
+    drivers = cluster.drivers
+    trucks = cluster.trucks
+    packages = list(cluster.packages)
+    packages += [p for t in trucks for p in state.truck_packages[t] if p not in packages]
+    sub = pyhop.State(state.__name__)
+    for name, value in pyhop.state_variables(state):
+        if name in ('drivers_at', 'trucks_at', 'driver_truck', 'truck_packages', 'driver_rank',
+                    'truck_rank', 'goal_targets', 'goal_order', 'unmet_goals', 'unreachable_goals'):
+            continue
+        if name in ('driver_loc', 'driver_money'):
+            value = {d: value[d] for d in drivers}
+        elif name in ('truck_loc', 'truck_driver'):
+            value = {t: value[t] for t in trucks}
+        elif name == 'package_loc':
+            value = {p: value[p] for p in packages}
+        elif name == 'drivers':
+            value = pyhop.freeze(list(drivers))
+        elif name == 'trucks':
+            value = pyhop.freeze(list(trucks))
+        elif name == 'packages':
+            value = pyhop.freeze(packages)
+        setattr(sub, name, value)
+    transportation_domain.add_reverse_indexes(sub)
+    transportation_domain.add_goal_agenda(sub, cluster.goal, getattr(state, 'goal_order', None))
+    return sub
+
+
+def plan_decomposed(state, goal, max_workers=None, mp_context=None, budget=None, **options):
+    """
+    Resolver ('achieve_goals', goal) en state planificando por separado los
+    grupos de partition_goals y devolver [plan, estado final] como
+    pyhop.pyhop, o [] si no hay plan.
+    - Con un solo grupo, o con max_workers=1, los grupos se resuelven en
+      este proceso; si no, con pyhop.plan_batch en max_workers procesos.
+    - budget (un pyhop.Budget) se aplica a cada grupo y también a la
+      planificación conjunta si hace falta.
+    - options (in_place, iterative, memo_size) se pasan a pyhop.
+    Si algún grupo no tiene plan, o el plan combinado no es aplicable sobre
+    state o deja objetivos sin cumplir, se planifica el problema entero con pyhop.pyhop.
+    """
+    tasks = [('achieve_goals', goal)]
+    clusters = partition_goals(state, goal)
+    if len(clusters) > 1:
+        problems = [(subproblem(state, c), [('achieve_goals', c.goal)]) for c in clusters]
+        if max_workers == 1:
+            results = [pyhop.pyhop(s, t, budget=budget, **options) for s, t in problems]
+        else:
+            results = [None] * len(problems)
+            batches = pyhop.plan_batch(problems, 'transportation_domain', max_workers,
+                                       ordered=False, mp_context=mp_context, budget=budget,
+                                       **options)
+            # Cerrar el generador al salir cierra el pool y cancela los grupos pendientes
+            with contextlib.closing(batches):
+                for batch in batches:
+                    results[batch.index] = batch.result
+                    if not batch.ok:
+                        break
+        if all(results):
+            plan = [action for result in results for action in result[0]]
+            initial = transportation_domain.add_goal_agenda(copy.copy(state), goal)
+            checked = pyhop.validate_plan(initial, plan, check=lambda s: not s.unmet_goals,
+                                          keep_state=True)
+            if checked:
+                return [plan, checked.state]
+        if pyhop.tracing:
+            pyhop.trace_event('debug', message="Los grupos no se pudieron combinar; "
+                                               "planificando el problema entero")
+    return pyhop.pyhop(state, tasks, budget=budget, **options)
@@ -1,9 +1,30 @@
 """
 Dominio de transporte para el planificador pyhop.
 Este dominio modela camiones, conductores y paquetes que necesitan ser transportados entre ciudades.
+
+Además de driver_loc, truck_loc, truck_driver y package_loc, el estado lleva
+índices inversos (drivers_at, trucks_at, driver_truck, truck_packages) que
+los operadores mantienen al día y que los métodos consultan en O(1) en lugar
+de recorrer toda la flota. Llamar a add_reverse_indexes(state) después de
+rellenar esas variables en un estado nuevo.
+
+achieve_goals recorre una agenda de objetivos en orden de prioridad cuyos
+objetivos pendientes (unmet_goals) mantienen los operadores; llamar a
+add_goal_agenda(state, goal) antes de planificar. add_goal_agenda también
+comprueba con check_reachability que ningún objetivo sea imposible, y si
+alguno lo es achieve_goals falla enseguida en lugar de agotar la búsqueda.
+
+Cuando hace falta traer un conductor o un camión de otra ubicación, los
+primeros métodos de cada tarea eligen el conductor libre o el camión más
+cercano según las matrices de distancias de transportation_routing; los
+métodos que toman el primero de la flota quedan como alternativa.
+
+Importar el módulo solo declara el dominio; los problemas (y el de ejemplo)
+se construyen y se cargan con transportation_problems.
 """
 
 import pyhop
+import transportation_routing
 
 # Funciones auxiliares
 def can_walk(state, location1, location2):
@@ -19,13 +40,323 @@ def bus_cost(location1, location2):
     # Modelo de coste simple: coste fijo de 5 unidades
     return 5
 
+# Costes de las acciones para pyhop.pyhop_optimize, en las mismas unidades
+# que bus_cost: caminar un tramo cuesta más que el autobús (pero no gasta
+# dinero del conductor), conducir cuesta por kilómetro si el estado tiene
+# driving_distances (si no, un tanto por tramo), y cargar o descargar cuesta 1
+WALKING_COST = 8
+DRIVING_COST_PER_KM = 0.05
+DRIVING_COST_PER_HOP = 20
+HANDLING_COST = 1
+
+def take_bus_cost(state, driver, location1, location2):
+    """Coste de la acción take_bus."""
+    return bus_cost(location1, location2)
+
+def drive_truck_cost(state, driver, truck, location1, location2):
+    """Coste de la acción drive_truck: proporcional a la distancia del tramo."""
+    distances = getattr(state, 'driving_distances', None)
+    if distances is not None and location2 in distances.get(location1, {}):
+        return distances[location1][location2] * DRIVING_COST_PER_KM
+    return DRIVING_COST_PER_HOP
+
+# Índices inversos
+
+GRAPH_VARIABLES = ('walking_paths', 'driving_paths', 'walking_distances', 'driving_distances')
+
+def add_reverse_indexes(state):
+    """Construir los índices inversos del estado a partir de driver_loc,
+    truck_loc, truck_driver y package_loc. Los conjuntos son frozensets que
+    los operadores sustituyen en lugar de modificar, y el orden de la flota
+    se guarda en driver_rank y truck_rank para elegir de forma determinista.
+    Los grafos y sus distancias, que ningún operador escribe, se declaran
+    estáticos si no lo estaban, para que transportation_routing reconozca
+    sus índices por referencia en lugar de compararlos con su copia."""
+    pyhop.declare_static(state, *(name for name in GRAPH_VARIABLES if hasattr(state, name)))
+    state.driver_rank = pyhop.freeze({d: i for i, d in enumerate(state.driver_loc)})
+    state.truck_rank = pyhop.freeze({t: i for i, t in enumerate(state.truck_loc)})
+    drivers_at = {}
+    for driver, loc in state.driver_loc.items():
+        drivers_at[loc] = drivers_at.get(loc, frozenset()) | {driver}
+    trucks_at = {}
+    for truck, loc in state.truck_loc.items():
+        trucks_at[loc] = trucks_at.get(loc, frozenset()) | {truck}
+    driver_truck = {driver: None for driver in state.driver_loc}
+    for truck, driver in state.truck_driver.items():
+        if driver is not None:
+            driver_truck[driver] = truck
+    truck_packages = {truck: frozenset() for truck in state.truck_loc}
+    for package, loc in state.package_loc.items():
+        if loc in truck_packages:
+            truck_packages[loc] = truck_packages[loc] | {package}
+    state.drivers_at = drivers_at
+    state.trucks_at = trucks_at
+    state.driver_truck = driver_truck
+    state.truck_packages = truck_packages
+    return state
+
+# Estados compactos
+
+COMPACT_FLUENTS = {
+    'driver_loc': ('driver', 'location'),
+    'driver_money': ('driver', None),
+    'truck_loc': ('truck', 'location'),
+    'truck_driver': ('truck', 'driver'),
+    'package_loc': ('package', ('location', 'truck')),
+    'drivers_at': ('location', None),
+    'trucks_at': ('location', None),
+    'driver_truck': ('driver', 'truck'),
+    'truck_packages': ('truck', None),
+}
+
+def compact_state(state):
+    """Versión compacta de state (ver pyhop.Schema): las ubicaciones de
+    conductores, camiones y paquetes y los índices inversos se guardan en
+    arrays indexados por identificadores enteros de los nombres de
+    state.drivers, state.trucks, state.packages y state.locations. Los
+    operadores y métodos funcionan igual sobre ella; sale a cuenta con
+    flotas grandes, donde cada copia del estado es mucho más barata."""
+    spaces = {'driver': state.drivers, 'truck': state.trucks,
+              'package': state.packages, 'location': state.locations}
+    variables = [name for name, _ in pyhop.state_variables(state)]
+    variables += [name for name in ('driver_rank', 'truck_rank', 'goal_targets', 'goal_order',
+                                    'unmet_goals', 'unreachable_goals') if name not in variables]
+    schema = pyhop.Schema('transport', spaces, COMPACT_FLUENTS, variables)
+    return schema.compact(state)
+
+def _move_in_index(index, item, old, new):
+    """Mover item del conjunto index[old] al conjunto index[new]. Las
+    ubicaciones que se quedan vacías se borran del índice, para que su
+    tamaño (y lo que cuesta copiarlo) dependa de la flota y no de las
+    ubicaciones visitadas; una clave que falta equivale a un conjunto vacío."""
+    if old != new:
+        rest = index[old] - {item}
+        if rest:
+            index[old] = rest
+        else:
+            del index[old]
+        index[new] = index.get(new, frozenset()) | {item}
+
+def set_driver_loc(state, driver, location):
+    """Cambiar la ubicación del conductor manteniendo drivers_at y la agenda
+    de objetivos."""
+    _move_in_index(state.drivers_at, driver, state.driver_loc[driver], location)
+    state.driver_loc[driver] = location
+    _track_goal(state, 'driver', driver, location)
+
+def set_truck_loc(state, truck, location):
+    """Cambiar la ubicación del camión manteniendo trucks_at y la agenda de
+    objetivos."""
+    _move_in_index(state.trucks_at, truck, state.truck_loc[truck], location)
+    state.truck_loc[truck] = location
+    _track_goal(state, 'truck', truck, location)
+
+def set_truck_driver(state, truck, driver):
+    """Cambiar el conductor del camión manteniendo driver_truck."""
+    old = state.truck_driver[truck]
+    if old is not None:
+        state.driver_truck[old] = None
+    if driver is not None:
+        state.driver_truck[driver] = truck
+    state.truck_driver[truck] = driver
+
+def set_package_loc(state, package, location):
+    """Cambiar la ubicación (o camión) del paquete manteniendo truck_packages
+    y la agenda de objetivos."""
+    old = state.package_loc[package]
+    if old in state.truck_packages:
+        state.truck_packages[old] = state.truck_packages[old] - {package}
+    if location in state.truck_packages:
+        state.truck_packages[location] = state.truck_packages[location] | {package}
+    state.package_loc[package] = location
+    _track_goal(state, 'package', package, location)
+
+def first_driver_at(state, location):
+    """Primer conductor (en el orden de driver_loc) en la ubicación, o None."""
+    drivers = state.drivers_at.get(location)
+    return min(drivers, key=state.driver_rank.__getitem__) if drivers else None
+
+def first_truck_at(state, location):
+    """Primer camión (en el orden de truck_loc) en la ubicación, o None."""
+    trucks = state.trucks_at.get(location)
+    return min(trucks, key=state.truck_rank.__getitem__) if trucks else None
+
+def nearest_free_driver(state, location):
+    """Conductor que no está en ningún camión más cercano a la ubicación
+    (por la red peatonal, que es la que usa move_driver), o None."""
+    drivers = [d for d, truck in state.driver_truck.items() if truck is None]
+    matrix = transportation_routing.state_distance_matrix(state, 'walking')
+    i = matrix.nearest([state.driver_loc[d] for d in drivers], location)
+    return None if i is None else drivers[i]
+
+def nearest_truck(state, location):
+    """Camión más cercano a la ubicación por la red de conducción, o None."""
+    trucks = list(state.truck_loc)
+    matrix = transportation_routing.state_distance_matrix(state, 'driving')
+    i = matrix.nearest([state.truck_loc[t] for t in trucks], location)
+    return None if i is None else trucks[i]
+
+# Agenda de objetivos
+
+GOAL_TASKS = {'package': 'deliver_package', 'truck': 'move_truck', 'driver': 'move_driver'}
+
+def _goal_items(goal):
+    """Pares ((tipo, objeto), destino) del objetivo, en el orden de
+    achieve_goals: paquetes, camiones y conductores."""
+    for kind, goals in (('package', goal.package_goals), ('truck', goal.truck_goals),
+                        ('driver', goal.driver_goals)):
+        for item, target in goals.items():
+            yield (kind, item), target
+
+def _current_loc(state, kind, item):
+    """Ubicación actual del objeto; la de su camión si es un paquete cargado."""
+    if kind == 'package':
+        loc = state.package_loc[item]
+        return state.truck_loc.get(loc, loc)
+    return state.driver_loc[item] if kind == 'driver' else state.truck_loc[item]
+
+def add_goal_agenda(state, goal, order=None):
+    """Preparar la agenda de objetivos de goal para achieve_goals.
+    - goal_targets: destino de cada objetivo, con claves (tipo, objeto).
+    - goal_order: los objetivos en orden de prioridad; primero los paquetes,
+      luego los camiones y al final los conductores (mover un camión se
+      lleva a los conductores que necesita), y dentro de cada tipo del
+      más lejano a su destino al más cercano (por la red de conducción, o
+      la peatonal para los conductores), que en los problemas del banco de
+      pruebas da planes algo más baratos que el orden del objetivo. Los
+      inalcanzables van primero, para que la búsqueda falle cuanto antes.
+    - unmet_goals: los objetivos no cumplidos, como diccionario con valores
+      None. set_driver_loc, set_truck_loc y set_package_loc lo mantienen al
+      día a partir de los efectos de los operadores, así que se copia o se
+      deshace con el resto del estado al retroceder.
+    - unreachable_goals: los objetivos imposibles según check_reachability,
+      con su explicación. Si hay alguno, achieve_goals falla sin buscar.
+    Todas menos unmet_goals son estáticas y se comparten entre las copias.
+    order, si se da, es un orden de prioridad ya calculado (por ejemplo el
+    goal_order de una versión anterior del estado) que se usa en lugar de
+    las distancias; los objetivos que no aparecen en él van al final."""
+    unreachable = check_reachability(state, goal)
+    kinds = list(GOAL_TASKS)
+    if order is None:
+        # Una consulta punto a punto por objetivo (ver DistanceMatrix.distance),
+        # sin calcular filas enteras de las matrices
+        driving = transportation_routing.state_distance_matrix(state, 'driving')
+        walking = transportation_routing.state_distance_matrix(state, 'walking')
+        rank = None
+    else:
+        rank = {key: i for i, key in enumerate(order)}
+    targets = {}
+    priority = {}
+    for i, (key, target) in enumerate(_goal_items(goal)):
+        kind, item = key
+        targets[key] = target
+        if rank is not None:
+            priority[key] = (key not in unreachable, rank.get(key, len(rank)), i)
+            continue
+        matrix = walking if kind == 'driver' else driving
+        d = None if key in unreachable else matrix.distance(_current_loc(state, kind, item), target)
+        priority[key] = (kinds.index(kind), -(float('inf') if d is None else d), i)
+    state.goal_targets = pyhop.freeze(targets)
+    state.goal_order = pyhop.freeze(sorted(targets, key=priority.__getitem__))
+    state.unmet_goals = {key: None for key in state.goal_order
+                         if key in unreachable or _goal_loc(state, key) != targets[key]}
+    state.unreachable_goals = pyhop.freeze(unreachable)
+    return state
+
+def _goal_loc(state, key):
+    """Valor que debe coincidir con el destino del objetivo key."""
+    kind, item = key
+    if kind == 'package':
+        return state.package_loc[item]
+    return state.driver_loc[item] if kind == 'driver' else state.truck_loc[item]
+
+def _track_goal(state, kind, item, location):
+    """Actualizar unmet_goals después de mover item (de tipo kind) a location."""
+    targets = getattr(state, 'goal_targets', None)
+    if targets is None:
+        return
+    key = (kind, item)
+    target = targets.get(key)
+    if target is None:
+        return
+    unmet = state.unmet_goals
+    if location == target:
+        if key in unmet:
+            del unmet[key]
+    elif key not in unmet:
+        unmet[key] = None
+
+# Alcanzabilidad
+
+def check_reachability(state, goal):
+    """
+    Comprobar, antes de buscar, que cada objetivo de goal se puede cumplir
+    y devolver un diccionario {(tipo, objeto): explicación} con los que no.
+    Usa las componentes conexas de las redes (transportation_routing.
+    components), así que solo descarta objetivos imposibles; que no descarte
+    ninguno no garantiza que haya plan.
+    - Un camión solo se mueve dentro de su componente de conducción, y solo
+      si algún conductor puede llegar hasta él.
+    - Un paquete necesita que su destino esté en la componente de conducción
+      de su ubicación, que haya un camión en ella y un conductor que llegue.
+    - Un conductor llega a su componente peatonal y, subido a un camión, a
+      la componente de conducción de ese camión; la zona de un conductor es
+      la unión de las componentes que puede recorrer así.
+    """
+    walking = transportation_routing.components(state.walking_paths)
+    driving = transportation_routing.components(state.driving_paths)
+    with_trucks = {driving.of(loc) for loc in state.truck_loc.values()}
+    with_trucks.discard(None)
+
+    # Zonas: componentes peatonales unidas por las de conducción con camiones
+    parent = {}
+
+    def find(node):
+        while parent.get(node, node) != node:
+            node = parent[node]
+        return node
+
+    for loc, component in driving.component.items():
+        if component in with_trucks and walking.of(loc) is not None:
+            parent[find(('walking', walking.of(loc)))] = find(('driving', component))
+
+    def zone(loc):
+        if walking.of(loc) is not None:
+            return find(('walking', walking.of(loc)))
+        if driving.of(loc) in with_trucks:
+            return find(('driving', driving.of(loc)))
+        return ('location', loc)
+
+    driver_zones = {zone(loc) for loc in state.driver_loc.values()}
+    names = {'package': state.package_loc, 'driver': state.driver_loc, 'truck': state.truck_loc}
+    labels = {'package': 'el paquete', 'driver': 'el conductor', 'truck': 'el camión'}
+    unreachable = {}
+    for key, target in _goal_items(goal):
+        kind, item = key
+        if item not in names[kind]:
+            unreachable[key] = f"no existe {labels[kind]} {item}"
+            continue
+        if _goal_loc(state, key) == target:
+            continue
+        loc = _current_loc(state, kind, item)
+        if kind == 'driver':
+            if zone(loc) != zone(target):
+                unreachable[key] = f"{item} no puede ir de {loc} a {target} ni andando ni en camión"
+        elif not driving.same(loc, target):
+            unreachable[key] = f"no hay carretera entre {loc} y {target} para llevar {labels[kind]} {item}"
+        elif driving.of(loc) not in with_trucks:
+            unreachable[key] = f"ningún camión puede llegar a {loc} para llevar {labels[kind]} {item}"
+        elif zone(loc) not in driver_zones:
+            unreachable[key] = f"ningún conductor puede llegar a {loc} para llevar {labels[kind]} {item}"
+    return unreachable
+
 # Operadores
 
 def walk(state, driver, location1, location2):
     """El conductor camina desde location1 hasta location2."""
     if (state.driver_loc[driver] == location1 and 
         can_walk(state, location1, location2)):
-        state.driver_loc[driver] = location2
+        set_driver_loc(state, driver, location2)
         return state
     else:
         return False
@@ -35,7 +366,7 @@ def take_bus(state, driver, location1, location2):
     if (state.driver_loc[driver] == location1 and 
         can_walk(state, location1, location2) and  # Los autobuses siguen las rutas peatonales
         state.driver_money[driver] >= bus_cost(location1, location2)):
-        state.driver_loc[driver] = location2
+        set_driver_loc(state, driver, location2)
         state.driver_money[driver] -= bus_cost(location1, location2)
         return state
     else:
@@ -44,18 +375,19 @@ def take_bus(state, driver, location1, location2):
 def load_driver(state, driver, truck, location):
     """El conductor sube al camión en la ubicación indicada."""
     # Comprobar si el conductor ya está conduciendo otro camión
-    for t in state.trucks:
-        if state.truck_driver[t] == driver:
-            print(f"DEBUG: El conductor {driver} ya está conduciendo el camión {t}")
-            return False
+    t = state.driver_truck[driver]
+    if t is not None:
+        if pyhop.tracing:
+            pyhop.trace_event('debug', message=f"El conductor {driver} ya está conduciendo el camión {t}")
+        return False
     
     if (state.driver_loc[driver] == location and 
         state.truck_loc[truck] == location and 
         state.truck_driver[truck] is None):
-        state.truck_driver[truck] = driver
+        set_truck_driver(state, truck, driver)
         # Actualizar la ubicación del conductor para que coincida con la del camión
         # Esto es importante para rastrear la ubicación real del conductor
-        state.driver_loc[driver] = location
+        set_driver_loc(state, driver, location)
         return state
     else:
         return False
@@ -64,8 +396,8 @@ def unload_driver(state, driver, truck, location):
     """El conductor baja del camión en la ubicación indicada."""
     if (state.truck_loc[truck] == location and 
         state.truck_driver[truck] == driver):
-        state.truck_driver[truck] = None
-        state.driver_loc[driver] = location
+        set_truck_driver(state, truck, None)
+        set_driver_loc(state, driver, location)
         return state
     else:
         return False
@@ -75,25 +407,28 @@ def drive_truck(state, driver, truck, location1, location2):
     if (state.truck_loc[truck] == location1 and 
         state.truck_driver[truck] == driver and 
         can_drive(state, location1, location2)):
-        state.truck_loc[truck] = location2
+        set_truck_loc(state, truck, location2)
         # Actualizar la ubicación del conductor para que coincida con la del camión
-        state.driver_loc[driver] = location2
-        # Imprimir información de depuración
-        print(f"DEBUG: Conduciendo camión {truck} desde {location1} hasta {location2}")
+        set_driver_loc(state, driver, location2)
+        # Información de depuración, solo si hay alguien escuchando
+        if pyhop.tracing:
+            pyhop.trace_event('debug', message=f"Conduciendo camión {truck} desde {location1} hasta {location2}")
         return state
     else:
-        # Imprimir información de depuración para el fallo
-        print(f"DEBUG: No se pudo conducir el camión {truck} desde {location1} hasta {location2}")
-        print(f"  Ubicación del camión: {state.truck_loc.get(truck)}")
-        print(f"  Conductor del camión: {state.truck_driver.get(truck)}")
-        print(f"  Se puede conducir: {can_drive(state, location1, location2)}")
+        # Información de depuración para el fallo
+        if pyhop.tracing:
+            pyhop.trace_event('debug',
+                              message=f"No se pudo conducir el camión {truck} desde {location1} hasta {location2}",
+                              truck_loc=state.truck_loc.get(truck),
+                              truck_driver=state.truck_driver.get(truck),
+                              can_drive=can_drive(state, location1, location2))
         return False
 
 def load_package(state, package, truck, location):
     """Cargar paquete en el camión en la ubicación indicada."""
     if (state.package_loc[package] == location and 
         state.truck_loc[truck] == location):
-        state.package_loc[package] = truck
+        set_package_loc(state, package, truck)
         return state
     else:
         return False
@@ -102,7 +437,7 @@ def unload_package(state, package, truck, location):
     """Descargar paquete del camión en la ubicación indicada."""
     if (state.package_loc[package] == truck and 
         state.truck_loc[truck] == location):
-        state.package_loc[package] = location
+        set_package_loc(state, package, location)
         return state
     else:
         return False
@@ -110,8 +445,102 @@ def unload_package(state, package, truck, location):
 # Declare operators
 pyhop.declare_operators(walk, take_bus, load_driver, unload_driver, 
                         drive_truck, load_package, unload_package)
-print()
-pyhop.print_operators()
+pyhop.declare_costs(walk=WALKING_COST, take_bus=take_bus_cost, drive_truck=drive_truck_cost,
+                    load_driver=HANDLING_COST, unload_driver=HANDLING_COST,
+                    load_package=HANDLING_COST, unload_package=HANDLING_COST)
+
+# Precondiciones: para pyhop.validate_plan, cada función describe la primera
+# precondición de su operador que no se cumple, o devuelve None
+
+def _unknown(state, driver=None, truck=None, package=None):
+    """Describir el primer objeto que no existe en el estado, o None."""
+    if driver is not None and driver not in state.driver_loc:
+        return f"no existe el conductor {driver}"
+    if truck is not None and truck not in state.truck_loc:
+        return f"no existe el camión {truck}"
+    if package is not None and package not in state.package_loc:
+        return f"no existe el paquete {package}"
+    return None
+
+def walk_precondition(state, driver, location1, location2):
+    reason = _unknown(state, driver=driver)
+    if reason is not None:
+        return reason
+    if state.driver_loc[driver] != location1:
+        return f"{driver} está en {state.driver_loc[driver]}, no en {location1}"
+    if not can_walk(state, location1, location2):
+        return f"no hay camino peatonal de {location1} a {location2}"
+    return None
+
+def take_bus_precondition(state, driver, location1, location2):
+    reason = walk_precondition(state, driver, location1, location2)
+    if reason is None and state.driver_money[driver] < bus_cost(location1, location2):
+        reason = (f"{driver} tiene {state.driver_money[driver]} y el autobús cuesta "
+                  f"{bus_cost(location1, location2)}")
+    return reason
+
+def load_driver_precondition(state, driver, truck, location):
+    reason = _unknown(state, driver=driver, truck=truck)
+    if reason is not None:
+        return reason
+    if state.driver_truck[driver] is not None:
+        return f"{driver} ya está conduciendo {state.driver_truck[driver]}"
+    if state.driver_loc[driver] != location:
+        return f"{driver} está en {state.driver_loc[driver]}, no en {location}"
+    if state.truck_loc[truck] != location:
+        return f"{truck} está en {state.truck_loc[truck]}, no en {location}"
+    if state.truck_driver[truck] is not None:
+        return f"{truck} ya lo conduce {state.truck_driver[truck]}"
+    return None
+
+def unload_driver_precondition(state, driver, truck, location):
+    reason = _unknown(state, driver=driver, truck=truck)
+    if reason is not None:
+        return reason
+    if state.truck_loc[truck] != location:
+        return f"{truck} está en {state.truck_loc[truck]}, no en {location}"
+    if state.truck_driver[truck] != driver:
+        return f"{driver} no conduce {truck}"
+    return None
+
+def drive_truck_precondition(state, driver, truck, location1, location2):
+    reason = _unknown(state, driver=driver, truck=truck)
+    if reason is not None:
+        return reason
+    if state.truck_loc[truck] != location1:
+        return f"{truck} está en {state.truck_loc[truck]}, no en {location1}"
+    if state.truck_driver[truck] != driver:
+        return f"{driver} no conduce {truck}"
+    if not can_drive(state, location1, location2):
+        return f"no hay carretera de {location1} a {location2}"
+    return None
+
+def load_package_precondition(state, package, truck, location):
+    reason = _unknown(state, truck=truck, package=package)
+    if reason is not None:
+        return reason
+    if state.package_loc[package] != location:
+        return f"{package} está en {state.package_loc[package]}, no en {location}"
+    if state.truck_loc[truck] != location:
+        return f"{truck} está en {state.truck_loc[truck]}, no en {location}"
+    return None
+
+def unload_package_precondition(state, package, truck, location):
+    reason = _unknown(state, truck=truck, package=package)
+    if reason is not None:
+        return reason
+    if state.package_loc[package] != truck:
+        return f"{package} no va en {truck}"
+    if state.truck_loc[truck] != location:
+        return f"{truck} está en {state.truck_loc[truck]}, no en {location}"
+    return None
+
+pyhop.declare_preconditions(walk=walk_precondition, take_bus=take_bus_precondition,
+                            load_driver=load_driver_precondition,
+                            unload_driver=unload_driver_precondition,
+                            drive_truck=drive_truck_precondition,
+                            load_package=load_package_precondition,
+                            unload_package=unload_package_precondition)
 
 # Métodos
 
@@ -122,32 +551,17 @@ def deliver_package_already_there(state, package, goal_loc):
     return False
 
 def find_path(state, start, end, path_type='driving'):
-    """Encontrar una ruta desde start hasta end usando BFS.
-    path_type puede ser 'driving' o 'walking'."""
-    if path_type == 'driving':
-        paths = state.driving_paths
-    else:  # walking
-        paths = state.walking_paths
-    
-    # BFS para encontrar la ruta más corta
-    queue = [[start]]
-    visited = set([start])
-    
-    while queue:
-        path = queue.pop(0)
-        node = path[-1]
-        
-        if node == end:
-            return path
-        
-        for neighbor in paths.get(node, []):
-            if neighbor not in visited:
-                visited.add(neighbor)
-                new_path = list(path)
-                new_path.append(neighbor)
-                queue.append(new_path)
-    
-    return None  # No se encontró ninguna ruta
+    """Encontrar una ruta desde start hasta end.
+    path_type puede ser 'driving' o 'walking'.
+    Si el estado tiene distancias para ese grafo (driving_distances o
+    walking_distances) la ruta es la de menor distancia total (A* con cotas
+    ALT); si no, la de menos tramos (BFS). Los índices se guardan por grafo
+    en transportation_routing, así que repetir una consulta cuesta
+    O(longitud de la ruta) si los grafos son estáticos, como los deja
+    add_reverse_indexes; con grafos no estáticos cada consulta los compara
+    además con su copia indexada, en O(E)."""
+    # None si no se encontró ninguna ruta
+    return transportation_routing.state_route_index(state, path_type).path(start, end)
 
 def deliver_package_in_truck(state, package, goal_loc):
     """El paquete está en un camión, necesita conducir hasta el objetivo y descargar."""
@@ -175,14 +589,15 @@ def deliver_package_in_truck(state, package, goal_loc):
                 return [('drive_truck', driver, truck, current_loc, goal_loc),
                         ('unload_package', package, truck, goal_loc)]
             else:
-                print(f"DEBUG: No hay ruta de conducción desde {current_loc} hasta {goal_loc}")
+                if pyhop.tracing:
+                    pyhop.trace_event('debug', message=f"No hay ruta de conducción desde {current_loc} hasta {goal_loc}")
                 return False
         else:
             # Encontrar un conductor para conducir el camión
-            for d in state.driver_loc:
-                if state.driver_loc[d] == current_loc:
-                    return [('load_driver', d, truck, current_loc),
-                            ('deliver_package', package, goal_loc)]
+            d = first_driver_at(state, current_loc)
+            if d is not None:
+                return [('load_driver', d, truck, current_loc),
+                        ('deliver_package', package, goal_loc)]
             
             # No hay conductor en la ubicación del camión, necesita traer uno allí
             for d in state.driver_loc:
@@ -190,29 +605,69 @@ def deliver_package_in_truck(state, package, goal_loc):
                         ('deliver_package', package, goal_loc)]
     return False
 
+def bring_nearest_driver(state, truck, then):
+    """Subtareas para poner al volante de truck al conductor libre más
+    cercano y seguir con la lista de tareas then, o False si no hay ninguno."""
+    location = state.truck_loc[truck]
+    d = nearest_free_driver(state, location)
+    if d is None:
+        return False
+    if state.driver_loc[d] == location:
+        return [('load_driver', d, truck, location)] + then
+    return [('move_driver', d, location)] + then
+
+def deliver_package_in_truck_nearest_driver(state, package, goal_loc):
+    """El paquete está en un camión sin conductor: subir al conductor libre
+    más cercano."""
+    truck = state.package_loc[package]
+    if truck in state.truck_loc and state.truck_driver[truck] is None:
+        return bring_nearest_driver(state, truck, [('deliver_package', package, goal_loc)])
+    return False
+
+def deliver_package_at_location_nearest(state, package, goal_loc):
+    """El paquete está en una ubicación: usar el camión que haya allí o, si
+    no hay, el más cercano, con el conductor libre más cercano si le falta."""
+    current_loc = state.package_loc[package]
+    if current_loc in state.truck_loc:
+        return False
+    truck = first_truck_at(state, current_loc)
+    if truck is not None:
+        if state.truck_driver[truck] is not None:
+            # Lo resuelve deliver_package_at_location
+            return False
+        return bring_nearest_driver(state, truck, [('deliver_package', package, goal_loc)])
+    truck = nearest_truck(state, current_loc)
+    if truck is None:
+        return False
+    if state.truck_driver[truck] is not None:
+        return [('move_truck', truck, current_loc),
+                ('deliver_package', package, goal_loc)]
+    return bring_nearest_driver(state, truck, [('move_truck', truck, current_loc),
+                                               ('deliver_package', package, goal_loc)])
+
 def deliver_package_at_location(state, package, goal_loc):
     """El paquete está en una ubicación, necesita cargarse en un camión y entregarse."""
     current_loc = state.package_loc[package]
     
     # Encontrar un camión en la ubicación actual
-    for truck in state.truck_loc:
-        if state.truck_loc[truck] == current_loc:
-            # Si el camión tiene un conductor, cargar paquete y entregar
-            if state.truck_driver[truck] is not None:
-                return [('load_package', package, truck, current_loc),
+    truck = first_truck_at(state, current_loc)
+    if truck is not None:
+        # Si el camión tiene un conductor, cargar paquete y entregar
+        if state.truck_driver[truck] is not None:
+            return [('load_package', package, truck, current_loc),
+                    ('deliver_package', package, goal_loc)]
+        else:
+            # Encontrar un conductor para conducir el camión
+            d = first_driver_at(state, current_loc)
+            if d is not None:
+                return [('load_driver', d, truck, current_loc),
+                        ('load_package', package, truck, current_loc),
+                        ('deliver_package', package, goal_loc)]
+            
+            # No hay conductor en la ubicación del camión, necesita traer uno allí
+            for d in state.driver_loc:
+                return [('move_driver', d, current_loc),
                         ('deliver_package', package, goal_loc)]
-            else:
-                # Encontrar un conductor para conducir el camión
-                for d in state.driver_loc:
-                    if state.driver_loc[d] == current_loc:
-                        return [('load_driver', d, truck, current_loc),
-                                ('load_package', package, truck, current_loc),
-                                ('deliver_package', package, goal_loc)]
-                
-                # No hay conductor en la ubicación del camión, necesita traer uno allí
-                for d in state.driver_loc:
-                    return [('move_driver', d, current_loc),
-                            ('deliver_package', package, goal_loc)]
     
     # No hay camión en la ubicación actual, necesita traer uno allí
     for truck in state.truck_loc:
@@ -234,10 +689,40 @@ def deliver_package_at_location(state, package, goal_loc):
     
     return False
 
+def deliver_package_other_truck(state, package, goal_loc):
+    """Alternativa a deliver_package_at_location, que solo prueba el primer
+    camión: probar los demás uno a uno (ver deliver_package_with_truck).
+    Con pyhop.pyhop_optimize permite elegir el camión más barato."""
+    if state.package_loc[package] in state.truck_loc:
+        return False
+    return [('deliver_package_with_truck', package, goal_loc, 1)]
+
+def deliver_package_truck_k(state, package, goal_loc, k):
+    """Traer el camión k-ésimo hasta el paquete y entregarlo desde allí."""
+    current_loc = state.package_loc[package]
+    truck = state.trucks[k]
+    if state.truck_loc[truck] == current_loc:
+        return False
+    return [('move_truck', truck, current_loc),
+            ('deliver_package', package, goal_loc)]
+
+def deliver_package_next_truck(state, package, goal_loc, k):
+    """Pasar al siguiente camión."""
+    if k + 1 < len(state.trucks):
+        return [('deliver_package_with_truck', package, goal_loc, k + 1)]
+    return False
+
 pyhop.declare_methods('deliver_package', 
                       deliver_package_already_there,
+                      deliver_package_in_truck_nearest_driver,
                       deliver_package_in_truck,
-                      deliver_package_at_location)
+                      deliver_package_at_location_nearest,
+                      deliver_package_at_location,
+                      deliver_package_other_truck)
+
+pyhop.declare_methods('deliver_package_with_truck',
+                      deliver_package_truck_k,
+                      deliver_package_next_truck)
 
 def move_driver_already_there(state, driver, goal_loc):
     """El conductor ya está en la ubicación objetivo."""
@@ -247,29 +732,30 @@ def move_driver_already_there(state, driver, goal_loc):
 
 def move_driver_in_truck(state, driver, goal_loc):
     """El conductor está en un camión, necesita conducir hasta el objetivo y bajarse."""
-    for truck in state.truck_loc:
-        if state.truck_driver[truck] == driver:
-            current_loc = state.truck_loc[truck]
-            
-            # Encontrar una ruta hasta el objetivo
-            path = find_path(state, current_loc, goal_loc, 'driving')
+    truck = state.driver_truck[driver]
+    if truck is not None:
+        current_loc = state.truck_loc[truck]
+        
+        # Encontrar una ruta hasta el objetivo
+        path = find_path(state, current_loc, goal_loc, 'driving')
+        
+        if path and len(path) > 1:
+            # Crear un plan para conducir a través de cada paso en la ruta
+            plan = []
+            for i in range(len(path) - 1):
+                plan.append(('drive_truck', driver, truck, path[i], path[i+1]))
             
-            if path and len(path) > 1:
-                # Crear un plan para conducir a través de cada paso en la ruta
-                plan = []
-                for i in range(len(path) - 1):
-                    plan.append(('drive_truck', driver, truck, path[i], path[i+1]))
-                
-                # Añadir la acción de bajar al final
-                plan.append(('unload_driver', driver, truck, goal_loc))
-                return plan
-            elif can_drive(state, current_loc, goal_loc):
-                # Conducción directa
-                return [('drive_truck', driver, truck, current_loc, goal_loc),
-                        ('unload_driver', driver, truck, goal_loc)]
-            else:
-                print(f"DEBUG: No hay ruta de conducción desde {current_loc} hasta {goal_loc}")
-                return False
+            # Añadir la acción de bajar al final
+            plan.append(('unload_driver', driver, truck, goal_loc))
+            return plan
+        elif can_drive(state, current_loc, goal_loc):
+            # Conducción directa
+            return [('drive_truck', driver, truck, current_loc, goal_loc),
+                    ('unload_driver', driver, truck, goal_loc)]
+        else:
+            if pyhop.tracing:
+                pyhop.trace_event('debug', message=f"No hay ruta de conducción desde {current_loc} hasta {goal_loc}")
+            return False
     return False
 
 def move_driver_walk(state, driver, goal_loc):
@@ -324,15 +810,21 @@ def move_truck_with_driver(state, truck, goal_loc):
         return [('drive_truck', driver, truck, current_loc, goal_loc)]
     return False
 
+def move_truck_nearest_driver(state, truck, goal_loc):
+    """El camión necesita un conductor: subir al conductor libre más cercano."""
+    if state.truck_driver[truck] is not None:
+        return False
+    return bring_nearest_driver(state, truck, [('move_truck', truck, goal_loc)])
+
 def move_truck_need_driver(state, truck, goal_loc):
     """El camión necesita un conductor para moverse a la ubicación objetivo."""
     current_loc = state.truck_loc[truck]
     
     # Encontrar un conductor en la ubicación actual
-    for driver in state.driver_loc:
-        if state.driver_loc[driver] == current_loc:
-            return [('load_driver', driver, truck, current_loc),
-                    ('move_truck', truck, goal_loc)]
+    driver = first_driver_at(state, current_loc)
+    if driver is not None:
+        return [('load_driver', driver, truck, current_loc),
+                ('move_truck', truck, goal_loc)]
     
     # No hay conductor en la ubicación del camión, necesita traer uno allí
     for driver in state.driver_loc:
@@ -365,153 +857,54 @@ def move_truck_multi_step(state, truck, goal_loc):
 pyhop.declare_methods('move_truck',
                       move_truck_already_there,
                       move_truck_with_driver,
+                      move_truck_nearest_driver,
                       move_truck_need_driver,
                       move_truck_multi_step)
 
-def achieve_goals_recursive(state, goal):
-    """Lograr recursivamente todos los objetivos en el estado objetivo."""
-    # Manejar objetivos de paquetes
-    for package in goal.package_goals:
-        if package not in state.achieved_package_goals:
-            goal_loc = goal.package_goals[package]
-            if state.package_loc[package] != goal_loc:
-                state.achieved_package_goals.append(package)
-                return [('deliver_package', package, goal_loc), 
-                        ('achieve_goals', goal)]
-    
-    # Manejar objetivos de conductores
-    for driver in goal.driver_goals:
-        if driver not in state.achieved_driver_goals:
-            goal_loc = goal.driver_goals[driver]
-            if state.driver_loc[driver] != goal_loc:
-                state.achieved_driver_goals.append(driver)
-                return [('move_driver', driver, goal_loc), 
-                        ('achieve_goals', goal)]
-    
-    # Manejar objetivos de camiones
-    for truck in goal.truck_goals:
-        if truck not in state.achieved_truck_goals:
-            goal_loc = goal.truck_goals[truck]
-            if state.truck_loc[truck] != goal_loc:
-                state.achieved_truck_goals.append(truck)
-                return [('move_truck', truck, goal_loc), 
-                        ('achieve_goals', goal)]
-    
-    # Todos los objetivos logrados
-    return []
+def achieve_goals_recursive(state, goal, position=0, pending=None):
+    """Lograr uno a uno los objetivos de la agenda (ver add_goal_agenda).
+    position es la posición en goal_order por la que va el recorrido: cada
+    llamada avanza hasta el siguiente objetivo no cumplido y lanza su tarea,
+    así que cada objetivo se intenta como mucho una vez por pasada y cada
+    pasada cuesta O(G). Los objetivos que estaban cumplidos al pasar por
+    ellos pero que una tarea posterior ha deshecho se retoman en otra pasada;
+    pending es el número de objetivos sin cumplir al empezar la pasada actual
+    (None en la primera), y si una pasada no reduce ese número se falla en
+    lugar de dar por bueno un plan que deja objetivos sin cumplir. El estado
+    no se modifica aquí."""
+    unmet = state.unmet_goals
+    if not unmet:
+        # Todos los objetivos logrados
+        return []
+    if position == 0 and pending is None:
+        if dict(_goal_items(goal)) != state.goal_targets:
+            raise ValueError("La agenda del estado no corresponde a este objetivo; "
+                             "llamar a add_goal_agenda(state, goal)")
+        if state.unreachable_goals:
+            # Hay objetivos imposibles: fallar sin buscar
+            if pyhop.tracing:
+                for (kind, item), reason in state.unreachable_goals.items():
+                    pyhop.trace_event('debug', message=f"Objetivo imposible: {reason}", kind=kind, item=item)
+            return False
+    order = state.goal_order
+    while True:
+        while position < len(order):
+            key = order[position]
+            position += 1
+            if key in unmet:
+                kind, item = key
+                return [(GOAL_TASKS[kind], item, state.goal_targets[key]),
+                        ('achieve_goals', goal, position, pending)]
+        if pending is not None and len(unmet) >= pending:
+            # La pasada no ha avanzado: las tareas se deshacen unas a otras
+            if pyhop.tracing:
+                pyhop.trace_event('debug', message=f"Quedan {len(unmet)} objetivos sin cumplir tras otra pasada")
+            return False
+        position, pending = 0, len(unmet)
 
 pyhop.declare_methods('achieve_goals', achieve_goals_recursive)
 
-# Define the initial state
-state = pyhop.State('state')
-
-state.locations = [
-    'Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Bilbao', 'Zaragoza',  # Ciudades
-    'Path_Madrid_Barcelona', 'Path_Madrid_Valencia', 'Path_Barcelona_Sevilla', 
-    'Path_Barcelona_Bilbao', 'Path_Valencia_Sevilla', 'Path_Valencia_Zaragoza', 
-    'Path_Sevilla_Bilbao', 'Path_Bilbao_Zaragoza'  # Puntos de conexión
-]
-
-# Conexiones peatonales
-state.walking_paths = {
-    # Madrid
-    'Madrid': ['Path_Madrid_Barcelona', 'Path_Madrid_Valencia'],
-    'Path_Madrid_Barcelona': ['Madrid', 'Barcelona'],
-    'Path_Madrid_Valencia': ['Madrid', 'Valencia'],
-    
-    # Barcelona
-    'Barcelona': ['Path_Madrid_Barcelona', 'Path_Barcelona_Sevilla', 'Path_Barcelona_Bilbao'],
-    'Path_Barcelona_Sevilla': ['Barcelona', 'Sevilla'],
-    'Path_Barcelona_Bilbao': ['Barcelona', 'Bilbao'],
-    
-    # Valencia
-    'Valencia': ['Path_Madrid_Valencia', 'Path_Valencia_Sevilla', 'Path_Valencia_Zaragoza'],
-    'Path_Valencia_Sevilla': ['Valencia', 'Sevilla'],
-    'Path_Valencia_Zaragoza': ['Valencia', 'Zaragoza'],
-    
-    # Sevilla
-    'Sevilla': ['Path_Barcelona_Sevilla', 'Path_Valencia_Sevilla', 'Path_Sevilla_Bilbao'],
-    'Path_Sevilla_Bilbao': ['Sevilla', 'Bilbao'],
-    
-    # Bilbao
-    'Bilbao': ['Path_Barcelona_Bilbao', 'Path_Sevilla_Bilbao', 'Path_Bilbao_Zaragoza'],
-    'Path_Bilbao_Zaragoza': ['Bilbao', 'Zaragoza'],
-    
-    # Zaragoza
-    'Zaragoza': ['Path_Valencia_Zaragoza', 'Path_Bilbao_Zaragoza']
-}
-
-# Conexiones de conducción
-state.driving_paths = {
-    'Madrid': ['Barcelona', 'Valencia', 'Sevilla'],           # Madrid
-    'Barcelona': ['Madrid', 'Valencia', 'Sevilla', 'Bilbao'], # Barcelona
-    'Valencia': ['Madrid', 'Barcelona', 'Sevilla', 'Zaragoza'], # Valencia
-    'Sevilla': ['Madrid', 'Barcelona', 'Valencia', 'Bilbao', 'Zaragoza'], # Sevilla
-    'Bilbao': ['Barcelona', 'Sevilla', 'Zaragoza', 'Valencia'], # Bilbao
-    'Zaragoza': ['Valencia', 'Sevilla', 'Bilbao']             # Zaragoza
-}
-
-# Printear ubicaciones para depuración
-print("\nDriving paths:")
-for loc in state.driving_paths:
-    print(f"  From {loc} to: {state.driving_paths[loc]}")
-
-# Conductores
-state.drivers = ['D1', 'D2', 'D3', 'D4', 'D5', 'D6']
-state.driver_loc = {
-    'D1': 'Barcelona', 'D2': 'Valencia', 'D3': 'Madrid',
-    'D4': 'Sevilla', 'D5': 'Bilbao', 'D6': 'Zaragoza'
-}
-state.driver_money = {
-    'D1': 10, 'D2': 15, 'D3': 20,
-    'D4': 12, 'D5': 18, 'D6': 25
-}
-
-# Camiones
-state.trucks = ['T1', 'T2', 'T3', 'T4']
-state.truck_loc = {'T1': 'Barcelona', 'T2': 'Valencia', 'T3': 'Sevilla', 'T4': 'Bilbao'}
-state.truck_driver = {'T1': None, 'T2': None, 'T3': None, 'T4': None}
-
-# Paquetes
-state.packages = ['P1', 'P2', 'P3', 'P4', 'P5', 'P6']
-state.package_loc = {
-    'P1': 'Madrid', 'P2': 'Madrid', 'P3': 'Barcelona',
-    'P4': 'Valencia', 'P5': 'Sevilla', 'P6': 'Bilbao'
-}
-
-# Goales logrados
-state.achieved_package_goals = []
-state.achieved_driver_goals = []
-state.achieved_truck_goals = []
-
-# Definir el goal state
-goal = pyhop.Goal('goal')
-goal.package_goals = {
-    'P1': 'Barcelona', 'P2': 'Valencia', 'P3': 'Madrid',
-    'P4': 'Zaragoza', 'P5': 'Bilbao', 'P6': 'Sevilla'
-}
-goal.driver_goals = {'D1': 'Madrid', 'D4': 'Zaragoza'}
-goal.truck_goals = {'T1': 'Madrid', 'T3': 'Zaragoza'}
-
-# Printear Initial state y Goal
-print("\nInitial state:")
-pyhop.print_state(state)
-
-print("\nGoal:")
-pyhop.print_goal(goal)
-
-print("\nSolving transportation problem...")
-result = pyhop.pyhop(state, [('achieve_goals', goal)], verbose=3)
-
-if result:
-    print("\nPlan found:")
-    for action in result[0]:
-        print(f"  {action}")
-else:
-    print("\nNo plan found.")
-
-print("\nFinal state:")
-if result and len(result) > 1:
-    pyhop.print_state(result[1])
-else:
-    print("No final state available.")
+if __name__ == '__main__':
+    # El problema de ejemplo está en transportation_problems
+    import transportation_problems
+    transportation_problems.main()
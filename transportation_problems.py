@@ -0,0 +1,301 @@
+"""
+Problemas del dominio de transporte en ficheros JSON.
+transportation_domain solo define el dominio; los problemas se describen
+como datos con el formato de build_problem y se cargan con load_problem,
+que guarda el estado y el objetivo ya construidos (con sus índices inversos
+y su agenda de objetivos) en una caché pickle junto al fichero. La caché se
+identifica por el hash del contenido del fichero, así que cargar de nuevo un
+problema sin cambios solo cuesta leer la caché.
+
+Uso:
+    python transportation_problems.py                  # problema de ejemplo
+    python transportation_problems.py problema.json    # resolver un fichero
+    python transportation_problems.py --compile a.json b.json
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
+import pyhop
+import transportation_domain
+
+# Cambiar al modificar build_problem, para que no se usen cachés antiguas
+CACHE_VERSION = 1
+
+STATIC_VARIABLES = ('locations', 'walking_paths', 'driving_paths', 'driving_distances',
+                    'drivers', 'trucks', 'packages')
+
+# Problema de ejemplo: seis ciudades españolas, seis conductores, cuatro
+# camiones y seis paquetes
+DEMO_PROBLEM = {
+    'state': {
+        'locations': [
+            'Madrid', 'Barcelona', 'Valencia', 'Sevilla', 'Bilbao', 'Zaragoza',  # Ciudades
+            'Path_Madrid_Barcelona', 'Path_Madrid_Valencia', 'Path_Barcelona_Sevilla',
+            'Path_Barcelona_Bilbao', 'Path_Valencia_Sevilla', 'Path_Valencia_Zaragoza',
+            'Path_Sevilla_Bilbao', 'Path_Bilbao_Zaragoza'  # Puntos de conexión
+        ],
+        # Conexiones peatonales
+        'walking_paths': {
+            # Madrid
+            'Madrid': ['Path_Madrid_Barcelona', 'Path_Madrid_Valencia'],
+            'Path_Madrid_Barcelona': ['Madrid', 'Barcelona'],
+            'Path_Madrid_Valencia': ['Madrid', 'Valencia'],
+
+            # Barcelona
+            'Barcelona': ['Path_Madrid_Barcelona', 'Path_Barcelona_Sevilla', 'Path_Barcelona_Bilbao'],
+            'Path_Barcelona_Sevilla': ['Barcelona', 'Sevilla'],
+            'Path_Barcelona_Bilbao': ['Barcelona', 'Bilbao'],
+
+            # Valencia
+            'Valencia': ['Path_Madrid_Valencia', 'Path_Valencia_Sevilla', 'Path_Valencia_Zaragoza'],
+            'Path_Valencia_Sevilla': ['Valencia', 'Sevilla'],
+            'Path_Valencia_Zaragoza': ['Valencia', 'Zaragoza'],
+
+            # Sevilla
+            'Sevilla': ['Path_Barcelona_Sevilla', 'Path_Valencia_Sevilla', 'Path_Sevilla_Bilbao'],
+            'Path_Sevilla_Bilbao': ['Sevilla', 'Bilbao'],
+
+            # Bilbao
+            'Bilbao': ['Path_Barcelona_Bilbao', 'Path_Sevilla_Bilbao', 'Path_Bilbao_Zaragoza'],
+            'Path_Bilbao_Zaragoza': ['Bilbao', 'Zaragoza'],
+
+            # Zaragoza
+            'Zaragoza': ['Path_Valencia_Zaragoza', 'Path_Bilbao_Zaragoza']
+        },
+        # Conexiones de conducción
+        'driving_paths': {
+            'Madrid': ['Barcelona', 'Valencia', 'Sevilla'],
+            'Barcelona': ['Madrid', 'Valencia', 'Sevilla', 'Bilbao'],
+            'Valencia': ['Madrid', 'Barcelona', 'Sevilla', 'Zaragoza'],
+            'Sevilla': ['Madrid', 'Barcelona', 'Valencia', 'Bilbao', 'Zaragoza'],
+            'Bilbao': ['Barcelona', 'Sevilla', 'Zaragoza', 'Valencia'],
+            'Zaragoza': ['Valencia', 'Sevilla', 'Bilbao']
+        },
+        # Distancias por carretera (km) de cada tramo de conducción
+        'driving_distances': {
+            'Madrid': {'Barcelona': 620, 'Valencia': 360, 'Sevilla': 530},
+            'Barcelona': {'Madrid': 620, 'Valencia': 350, 'Sevilla': 990, 'Bilbao': 610},
+            'Valencia': {'Madrid': 360, 'Barcelona': 350, 'Sevilla': 650, 'Zaragoza': 310},
+            'Sevilla': {'Madrid': 530, 'Barcelona': 990, 'Valencia': 650, 'Bilbao': 860, 'Zaragoza': 840},
+            'Bilbao': {'Barcelona': 610, 'Sevilla': 860, 'Zaragoza': 300, 'Valencia': 610},
+            'Zaragoza': {'Valencia': 310, 'Sevilla': 840, 'Bilbao': 300}
+        },
+        # Conductores
+        'driver_loc': {
+            'D1': 'Barcelona', 'D2': 'Valencia', 'D3': 'Madrid',
+            'D4': 'Sevilla', 'D5': 'Bilbao', 'D6': 'Zaragoza'
+        },
+        'driver_money': {
+            'D1': 10, 'D2': 15, 'D3': 20,
+            'D4': 12, 'D5': 18, 'D6': 25
+        },
+        # Camiones
+        'truck_loc': {'T1': 'Barcelona', 'T2': 'Valencia', 'T3': 'Sevilla', 'T4': 'Bilbao'},
+        # Paquetes
+        'package_loc': {
+            'P1': 'Madrid', 'P2': 'Madrid', 'P3': 'Barcelona',
+            'P4': 'Valencia', 'P5': 'Sevilla', 'P6': 'Bilbao'
+        },
+    },
+    'goal': {
+        'package_goals': {
+            'P1': 'Barcelona', 'P2': 'Valencia', 'P3': 'Madrid',
+            'P4': 'Zaragoza', 'P5': 'Bilbao', 'P6': 'Sevilla'
+        },
+        'driver_goals': {'D1': 'Madrid', 'D4': 'Zaragoza'},
+        'truck_goals': {'T1': 'Madrid', 'T3': 'Zaragoza'},
+    },
+}
+
+
+def build_problem(data):
+    """
+    Construir (state, goal) a partir de un diccionario con la forma de
+    DEMO_PROBLEM: {'name': ..., 'state': {...}, 'goal': {...}}.
+    - state necesita locations, walking_paths, driving_paths, driver_loc,
+      driver_money, truck_loc y package_loc; driving_distances es opcional
+      y truck_driver vale None para todos los camiones si no se da. Las
+      listas drivers, trucks y packages salen de las claves de driver_loc,
+      truck_loc y package_loc si no se dan.
+    - goal puede tener package_goals, driver_goals y truck_goals.
+    El estado lleva declaradas sus variables estáticas, sus índices inversos
+    y la agenda de objetivos, listo para ('achieve_goals', goal).
+    """
+    fields = data['state']
+    missing = [name for name in ('locations', 'walking_paths', 'driving_paths', 'driver_loc',
+                                 'driver_money', 'truck_loc', 'package_loc') if name not in fields]
+    if missing:
+        raise ValueError(f"Al problema le faltan las variables {', '.join(missing)}")
+    state = pyhop.State(data.get('name', 'state'))
+    for name, value in fields.items():
+        setattr(state, name, value)
+    state.drivers = list(fields.get('drivers', state.driver_loc))
+    state.trucks = list(fields.get('trucks', state.truck_loc))
+    state.packages = list(fields.get('packages', state.package_loc))
+    if 'truck_driver' not in fields:
+        state.truck_driver = {t: None for t in state.trucks}
+    pyhop.declare_static(state, *(name for name in STATIC_VARIABLES if hasattr(state, name)))
+    transportation_domain.add_reverse_indexes(state)
+
+    goal = pyhop.Goal(data.get('goal_name', 'goal'))
+    goal.package_goals = dict(data['goal'].get('package_goals', {}))
+    goal.driver_goals = dict(data['goal'].get('driver_goals', {}))
+    goal.truck_goals = dict(data['goal'].get('truck_goals', {}))
+    transportation_domain.add_goal_agenda(state, goal)
+    return state, goal
+
+
+def _plain(value):
+    """value con sus diccionarios (también los pyhop.CowDict, que json no
+    acepta) y listas convertidos a dict y list corrientes."""
+    if isinstance(value, (dict, pyhop.CowDict)):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return value
+
+
+def problem_data(state, goal):
+    """Diccionario con el formato de build_problem que describe state y
+    goal (sin los índices ni la agenda, que build_problem reconstruye)."""
+    names = STATIC_VARIABLES + ('driver_loc', 'driver_money', 'truck_loc', 'truck_driver',
+                                'package_loc')
+    fields = {}
+    for name in names:
+        value = getattr(state, name, None)
+        if value is not None:
+            fields[name] = _plain(value)
+    return {
+        'name': state.__name__,
+        'state': fields,
+        'goal_name': goal.__name__,
+        'goal': {name: dict(getattr(goal, name, {}))
+                 for name in ('package_goals', 'driver_goals', 'truck_goals')},
+    }
+
+
+def save_problem(path, state, goal):
+    """Guardar state y goal en path como JSON (ver problem_data)."""
+    with open(path, 'w') as f:
+        json.dump(problem_data(state, goal), f, indent=1)
+
+
+def cache_path(path, digest, cache_dir=None):
+    """Ruta de la caché del fichero path con contenido de hash digest: en
+    cache_dir, o junto a path si no se da."""
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(cache_dir or directory, f'.{name}.{digest[:16]}.pickle')
+
+
+def load_problem(path, cache=True, cache_dir=None):
+    """
+    Cargar el problema JSON de path y devolver (state, goal) como
+    build_problem.
+    - Si cache es True, se usa la caché pickle de cache_path si existe y,
+      si no, se crea después de construir el problema (borrando las de
+      versiones anteriores del fichero). Escribir la caché es atómico, así
+      que varios procesos pueden cargar el mismo problema a la vez.
+    Las cachés se cargan con pickle: cache_dir tiene que ser de confianza.
+    """
+    with open(path, 'rb') as f:
+        content = f.read()
+    if not cache:
+        return build_problem(json.loads(content))
+    digest = hashlib.sha256(content + f'#{CACHE_VERSION}'.encode()).hexdigest()
+    target = cache_path(path, digest, cache_dir)
+    try:
+        with open(target, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Caché inexistente, corrupta o de una versión anterior del código
+        # (pickle puede fallar con casi cualquier excepción): se reconstruye
+        pass
+    problem = build_problem(json.loads(content))
+    directory = os.path.dirname(target)
+    prefix = os.path.basename(target)[:-len(f'{digest[:16]}.pickle')]
+    # Si no se puede escribir la caché (directorio inexistente o de solo
+    # lectura, disco lleno...) se devuelve el problema sin guardarla
+    try:
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith('.pickle'):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(directory, name))
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    except OSError:
+        return problem
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(problem, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, target)
+    except BaseException as exc:
+        with contextlib.suppress(OSError):
+            os.remove(temp)
+        if not isinstance(exc, OSError):
+            raise
+    return problem
+
+
+def demo_problem():
+    """(state, goal) del problema de ejemplo DEMO_PROBLEM."""
+    return build_problem(DEMO_PROBLEM)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='problemas JSON; por defecto, el problema de ejemplo')
+    parser.add_argument('--compile', action='store_true',
+                        help='solo crear las cachés de los problemas, sin resolverlos')
+    parser.add_argument('--no-cache', action='store_true', help='no leer ni escribir cachés')
+    parser.add_argument('--cache-dir', help='directorio de las cachés (por defecto, el del problema)')
+    parser.add_argument('--verbose', type=int, default=1, help='nivel de detalle de pyhop')
+    args = parser.parse_args(argv)
+    if args.compile:
+        for path in args.files:
+            load_problem(path, cache_dir=args.cache_dir)
+        return
+    if args.files:
+        problems = [load_problem(path, not args.no_cache, args.cache_dir) for path in args.files]
+    else:
+        problems = [demo_problem()]
+
+    print()
+    pyhop.print_operators()
+    for state, goal in problems:
+        print("\nDriving paths:")
+        for loc in state.driving_paths:
+            print(f"  From {loc} to: {state.driving_paths[loc]}")
+
+        print("\nInitial state:")
+        pyhop.print_state(state)
+
+        print("\nGoal:")
+        pyhop.print_goal(goal)
+
+        print("\nSolving transportation problem...")
+        result = pyhop.pyhop(state, [('achieve_goals', goal)], verbose=args.verbose)
+
+        if result:
+            print("\nPlan found:")
+            for action in result[0]:
+                print(f"  {action}")
+        else:
+            print("\nNo plan found.")
+            for reason in state.unreachable_goals.values():
+                print(f"  {reason}")
+
+        print("\nFinal state:")
+        if result and len(result) > 1:
+            pyhop.print_state(result[1])
+        else:
+            print("No final state available.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Reparación de planes del dominio de transporte cuando el mundo cambia a
+mitad de la ejecución (un camión se avería, se corta una carretera...).
+En lugar de volver a planificar todos los objetivos, repair_plan conserva
+las partes del plan que siguen siendo válidas y solo busca de nuevo las
+afectadas, así que el coste depende del tamaño del cambio y no del problema.
+
+Las acciones pendientes se reparten en hilos independientes: dos acciones
+van en el mismo hilo si comparten un conductor, un camión o un paquete (los
+operadores solo leen y escriben los objetos de sus argumentos), y un paquete
+cargado o un conductor subido a un camión van con el camión. Después del
+cambio:
+- Los hilos cuyas acciones siguen siendo aplicables y cuyos objetos acaban
+  en su destino se conservan tal cual.
+- Los objetivos de los demás hilos, y los que ningún hilo cumple, se
+  planifican con pyhop sobre un subproblema que solo tiene sus objetos y
+  los conductores y camiones que ningún hilo conservado usa (ver
+  transportation_decomposition.subproblem).
+Si el subproblema no tiene plan, o el plan reparado no cumple el objetivo,
+se planifica de nuevo todo el problema desde el estado cambiado.
+
+Los cambios se describen con un diccionario delta (ver apply_delta);
+road_closed y truck_broken construyen los de los casos más comunes.
+"""
+
+import copy
+
+import pyhop
+import transportation_decomposition
+import transportation_domain
+import transportation_routing
+
+# Valor de un delta que borra la clave
+REMOVE = object()
+
+
+def road_closed(state, location1, location2):
+    """Delta que corta el tramo de conducción entre location1 y location2
+    (en los dos sentidos)."""
+    paths = state.driving_paths
+    return {'driving_paths': {
+        location1: [loc for loc in paths.get(location1, ()) if loc != location2],
+        location2: [loc for loc in paths.get(location2, ()) if loc != location1],
+    }}
+
+
+def truck_broken(state, truck):
+    """Delta que retira el camión averiado de la flota: su conductor baja y
+    sus paquetes se descargan donde está."""
+    loc = state.truck_loc[truck]
+    return {
+        'trucks': [t for t in state.trucks if t != truck],
+        'truck_loc': {truck: REMOVE},
+        'truck_driver': {truck: REMOVE},
+        'package_loc': {p: loc for p, where in state.package_loc.items() if where == truck},
+    }
+
+
+def apply_delta(state, delta, goal=None):
+    """
+    Devolver una copia de state con los cambios de delta, un diccionario
+    {variable: cambio}:
+    - Si la variable es un diccionario y el cambio también, se actualizan
+      sus claves (REMOVE las borra); si no, el cambio la sustituye.
+    - Las variables estáticas siguen siéndolo (se congela el valor nuevo).
+    La copia lleva sus índices inversos recalculados y, si se da goal, la
+    agenda de sus objetivos sobre objetos que sigan en el estado, en el
+    orden de la agenda de state si la tiene. Si el cambio toca las redes de
+    caminos, las filas de distancias ya calculadas que no altera pasan a
+    las redes nuevas (ver transportation_routing.carry_distance_rows).
+    """
+    graphs = {path_type: (getattr(state, f'{path_type}_paths', None),
+                          getattr(state, f'{path_type}_distances', None))
+              for path_type in ('driving', 'walking')}
+    order = getattr(state, 'goal_order', None)
+    state = pyhop.copy_state(state)
+    for name, change in delta.items():
+        old = getattr(state, name, None)
+        if isinstance(change, dict) and isinstance(old, (dict, pyhop.CowDict)):
+            new = dict(old.items())
+            for key, value in change.items():
+                if value is REMOVE:
+                    new.pop(key, None)
+                else:
+                    new[key] = value
+        else:
+            new = change
+        setattr(state, name, pyhop.freeze(new) if pyhop.is_static(old) else copy.deepcopy(new))
+    transportation_domain.add_reverse_indexes(state)
+    for path_type, (paths, distances) in graphs.items():
+        new_paths = getattr(state, f'{path_type}_paths', None)
+        new_distances = getattr(state, f'{path_type}_distances', None)
+        if paths is not None and new_paths is not None and (new_paths is not paths or
+                                                             new_distances is not distances):
+            transportation_routing.carry_distance_rows(paths, distances, new_paths, new_distances)
+    if goal is not None:
+        transportation_domain.add_goal_agenda(state, _goal_for(goal, _objects(state), goal.__name__),
+                                              order)
+    return state
+
+
+def _objects(state):
+    return set(state.driver_loc) | set(state.truck_loc) | set(state.package_loc)
+
+
+def _goal_for(goal, objects, name):
+    """Los objetivos de goal sobre objects, como un Goal llamado name."""
+    sub = pyhop.Goal(name)
+    sub.package_goals = {p: t for p, t in goal.package_goals.items() if p in objects}
+    sub.driver_goals = {d: t for d, t in goal.driver_goals.items() if d in objects}
+    sub.truck_goals = {t: g for t, g in goal.truck_goals.items() if t in objects}
+    return sub
+
+
+def plan_threads(state, actions, objects=None):
+    """
+    Repartir actions en hilos independientes (ver el docstring del módulo)
+    y devolver una lista de (objetos, índices de sus acciones en actions).
+    objects son los nombres de conductores, camiones y paquetes que pueden
+    aparecer en actions; por defecto, los de state.
+    """
+    if objects is None:
+        objects = _objects(state)
+    parent = {}
+
+    def find(obj):
+        root = obj
+        while parent.get(root, root) != root:
+            root = parent[root]
+        parent[obj] = root
+        return root
+
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    for package, loc in state.package_loc.items():
+        if loc in state.truck_loc:
+            union(package, loc)
+    for driver, truck in state.driver_truck.items():
+        if truck is not None:
+            union(driver, truck)
+    for action in actions:
+        items = [arg for arg in action[1:] if arg in objects]
+        for item in items[1:]:
+            union(items[0], item)
+    threads = {}
+    for i, action in enumerate(actions):
+        root = find(next(arg for arg in action[1:] if arg in objects))
+        threads.setdefault(root, ({root}, []))[1].append(i)
+    for obj in parent:
+        root = find(obj)
+        if root in threads:
+            threads[root][0].add(obj)
+    return list(threads.values())
+
+
+def repair_plan(state, goal, plan, executed=0, delta=None, **options):
+    """
+    Reparar plan, un plan para ('achieve_goals', goal) desde state del que
+    ya se han ejecutado las executed primeras acciones, después del cambio
+    delta (ver apply_delta). Devolver [acciones pendientes, estado final]
+    como pyhop.pyhop, desde el estado tras el prefijo y el cambio, o [] si
+    no hay plan. Los objetivos de objetos que el cambio quita del estado se
+    descartan. options (in_place, iterative, memo_size, budget) se pasan a
+    pyhop.
+    """
+    prefix = pyhop.validate_plan(state, plan[:executed], keep_state=True)
+    if not prefix:
+        raise ValueError(f"El prefijo ejecutado no es aplicable desde el estado inicial: "
+                         f"la acción {prefix.index}, {prefix.action}, falla porque {prefix.reason}")
+    current = prefix.state
+    objects = _objects(current)
+    if delta:
+        current = apply_delta(current, delta, goal)
+    removed = objects - _objects(current)
+    goal = _goal_for(goal, _objects(current), goal.__name__)
+    remaining = plan[executed:]
+
+    # Simular los hilos y descartar los que fallan, usan objetos que ya no
+    # están o no cumplen sus objetivos
+    threads = plan_threads(current, remaining, objects | _objects(current))
+    thread_of = {}
+    owner = [None] * len(remaining)
+    for k, (members, indices) in enumerate(threads):
+        thread_of.update((obj, k) for obj in members)
+        for i in indices:
+            owner[i] = k
+    failed = set()
+    final = pyhop.copy_state(current)
+    operators = pyhop.default_domain.operators
+    for i, action in enumerate(remaining):
+        if owner[i] in failed:
+            continue
+        applied = not removed.intersection(action[1:]) and operators[action[0]](final, *action[1:])
+        if applied:
+            final = applied
+        else:
+            failed.add(owner[i])
+    failed.update(thread_of[item] for _, item in final.unmet_goals if item in thread_of)
+    if not failed and not final.unmet_goals:
+        return [list(remaining), pyhop.detach_state(final)]
+
+    # Subproblema con los objetivos afectados y los objetos libres
+    kept = {obj for k, (members, _) in enumerate(threads) if k not in failed for obj in members}
+    free = _objects(current) - kept
+    sub_goal = _goal_for(goal, free, f'{goal.__name__}_repair')
+    cluster = transportation_decomposition.GoalCluster(
+        [d for d in current.drivers if d in free],
+        [t for t in current.trucks if t in free],
+        [p for p in current.packages if p in sub_goal.package_goals],
+        sub_goal)
+    if pyhop.tracing:
+        pyhop.trace_event('debug', message=f"Reparando {len(failed)} de {len(threads)} hilos",
+                          cluster=repr(cluster))
+    result = pyhop.pyhop(transportation_decomposition.subproblem(current, cluster),
+                         [('achieve_goals', sub_goal)], **options)
+    if result:
+        repaired = [action for i, action in enumerate(remaining) if owner[i] not in failed]
+        repaired += result[0]
+        checked = pyhop.validate_plan(current, repaired, check=lambda s: not s.unmet_goals,
+                                      keep_state=True)
+        if checked:
+            return [repaired, checked.state]
+    if pyhop.tracing:
+        pyhop.trace_event('debug', message="No se pudo reparar el plan; planificando el problema entero")
+    return pyhop.pyhop(current, [('achieve_goals', goal)], **options)
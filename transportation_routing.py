@@ -0,0 +1,504 @@
+"""
+Índices de rutas para el dominio de transporte.
+Los grafos de caminos (walking_paths, driving_paths) no cambian durante una
+búsqueda, así que las rutas más cortas se calculan una sola vez por grafo y
+se reutilizan en cada intento de método, también al hacer backtracking.
+
+Si el estado tiene distancias por tramo (driving_distances, walking_distances,
+con la forma distances[origen][destino] = distancia), las rutas minimizan la
+distancia total con A* y cotas inferiores ALT (landmarks); si no, minimizan
+el número de tramos con BFS.
+
+DistanceMatrix da las distancias mínimas entre ubicaciones, para elegir el
+conductor o el camión más cercano de toda la flota con una sola consulta.
+Calcula bajo demanda, con un Dijkstra sobre el grafo invertido, las
+distancias de todas las ubicaciones hasta cada destino consultado, en lugar
+de todos los pares de antemano.
+
+Components guarda las componentes conexas de uno o varios grafos, para
+saber en O(1) si dos ubicaciones pueden estar comunicadas.
+"""
+
+import heapq
+import threading
+from collections import OrderedDict, deque
+
+import pyhop
+
+# Número máximo de grafos distintos cuyos índices se conservan en memoria
+MAX_INDEXES = 16
+
+# Número de landmarks usados por las cotas ALT de WeightedRouteIndex
+DEFAULT_LANDMARKS = 8
+
+# Número máximo de filas (destinos) que guarda cada DistanceMatrix
+MAX_MATRIX_ROWS = 1024
+
+# Número máximo de rutas (origen, destino) que guarda cada WeightedRouteIndex
+MAX_ROUTES = 4096
+
+_INF = float('inf')
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+class _Memo:
+    """Diccionario acotado a size entradas que olvida las usadas hace más
+    tiempo, como pyhop.FailureTable. Se puede usar desde varios hilos."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class RouteIndex:
+    """Árboles BFS por origen sobre un grafo fijo, construidos bajo demanda."""
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.trees = {}
+
+    def tree(self, start):
+        """Devolver el árbol BFS desde start como diccionario nodo -> padre."""
+        parents = self.trees.get(start)
+        if parents is None:
+            paths = self.paths
+            parents = {start: None}
+            queue = deque([start])
+            while queue:
+                node = queue.popleft()
+                for neighbor in paths.get(node, ()):
+                    if neighbor not in parents:
+                        parents[neighbor] = node
+                        queue.append(neighbor)
+            self.trees[start] = parents
+        return parents
+
+    def path(self, start, end):
+        """Devolver la ruta más corta de start a end, o None si no existe.
+        Coste O(longitud de la ruta) una vez construido el árbol de start."""
+        parents = self.tree(start)
+        if end not in parents:
+            return None
+        path = [end]
+        node = parents[end]
+        while node is not None:
+            path.append(node)
+            node = parents[node]
+        path.reverse()
+        return path
+
+
+class WeightedRouteIndex:
+    """Rutas de distancia mínima sobre un grafo fijo con pesos por tramo.
+    Precalcula distancias desde y hacia unos pocos landmarks y responde cada
+    consulta con A* guiado por la cota inferior ALT, guardando las max_routes
+    rutas usadas más recientemente."""
+
+    def __init__(self, paths, distances, landmarks=DEFAULT_LANDMARKS, max_routes=MAX_ROUTES):
+        nodes = list(paths)
+        ids = {node: i for i, node in enumerate(nodes)}
+        for node in list(paths):
+            for neighbor in paths[node]:
+                if neighbor not in ids:
+                    ids[neighbor] = len(nodes)
+                    nodes.append(neighbor)
+        forward = [[] for _ in nodes]
+        backward = [[] for _ in nodes]
+        for node, neighbors in paths.items():
+            weights = distances.get(node, {})
+            for neighbor in neighbors:
+                if neighbor not in weights:
+                    raise ValueError(f"Falta la distancia del tramo {node} -> {neighbor}")
+                weight = weights[neighbor]
+                if weight < 0:
+                    raise ValueError(f"Distancia negativa en el tramo {node} -> {neighbor}")
+                forward[ids[node]].append((ids[neighbor], weight))
+                backward[ids[neighbor]].append((ids[node], weight))
+        self.nodes = nodes
+        self.ids = ids
+        self.forward = forward
+        self.backward = backward
+        self.routes = _Memo(max_routes)
+        self._choose_landmarks(landmarks)
+
+    @staticmethod
+    def _dijkstra(adjacency, source):
+        dist = [_INF] * len(adjacency)
+        dist[source] = 0
+        heap = [(0, source)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            for v, w in adjacency[u]:
+                nd = d + w
+                if nd < dist[v]:
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return dist
+
+    def _choose_landmarks(self, count):
+        """Elegir landmarks por el punto más lejano a los ya elegidos."""
+        self.from_landmark = []
+        self.to_landmark = []
+        if not self.nodes:
+            return
+        nearest = [_INF] * len(self.nodes)
+        landmark = 0
+        for _ in range(min(count, len(self.nodes))):
+            dist_from = self._dijkstra(self.forward, landmark)
+            self.from_landmark.append(dist_from)
+            self.to_landmark.append(self._dijkstra(self.backward, landmark))
+            for i, d in enumerate(dist_from):
+                if d < nearest[i]:
+                    nearest[i] = d
+            # El siguiente landmark es el nodo alcanzable más alejado
+            candidates = [(d, i) for i, d in enumerate(nearest) if 0 < d < _INF]
+            if not candidates:
+                unreached = [i for i, d in enumerate(nearest) if d == _INF]
+                if not unreached:
+                    break
+                landmark = unreached[0]
+            else:
+                landmark = max(candidates)[1]
+
+    def lower_bound(self, u, t):
+        """Cota inferior ALT de la distancia entre los nodos (ids) u y t."""
+        bound = 0
+        for dist_from, dist_to in zip(self.from_landmark, self.to_landmark):
+            if dist_from[u] < _INF:
+                gap = dist_from[t] - dist_from[u]
+                if gap > bound:
+                    bound = gap
+            if dist_to[t] < _INF:
+                gap = dist_to[u] - dist_to[t]
+                if gap > bound:
+                    bound = gap
+        return bound
+
+    def route(self, start, end):
+        """Devolver (distancia, ruta) de start a end, o (None, None) si no hay ruta."""
+        key = (start, end)
+        found = self.routes.get(key)
+        if found is None:
+            found = self._search(start, end)
+            self.routes.put(key, found)
+        return found
+
+    def path(self, start, end):
+        """Devolver la ruta de distancia mínima de start a end, o None si no existe."""
+        return self.route(start, end)[1]
+
+    def distance(self, start, end):
+        """Devolver la distancia mínima de start a end, o None si no hay ruta."""
+        return self.route(start, end)[0]
+
+    def _search(self, start, end):
+        if start == end:
+            return 0, [start]
+        ids = self.ids
+        if start not in ids or end not in ids:
+            return None, None
+        s, t = ids[start], ids[end]
+        forward = self.forward
+        best = {s: 0}
+        parents = {s: None}
+        closed = set()
+        heap = [(self.lower_bound(s, t), 0, s)]
+        while heap:
+            _, g, u = heapq.heappop(heap)
+            if u in closed:
+                continue
+            if u == t:
+                path = []
+                while u is not None:
+                    path.append(self.nodes[u])
+                    u = parents[u]
+                path.reverse()
+                return g, path
+            closed.add(u)
+            for v, w in forward[u]:
+                ng = g + w
+                if v not in closed and ng < best.get(v, _INF):
+                    h = self.lower_bound(v, t)
+                    if h < _INF:
+                        best[v] = ng
+                        parents[v] = u
+                        heapq.heappush(heap, (ng + h, ng, v))
+        return None, None
+
+
+class DistanceMatrix:
+    """Distancias mínimas entre los nodos de un grafo fijo, en tramos o, si
+    se dan distances, en distancia total. Las filas se calculan bajo
+    demanda: la de un destino son las distancias de todos los nodos hasta
+    él, con un Dijkstra desde el destino sobre el grafo invertido, en
+    O((V + E) log V). Se guardan las max_rows usadas más recientemente, así
+    que la memoria es O(max_rows V) en lugar de O(V²)."""
+
+    def __init__(self, paths, distances=None, max_rows=MAX_MATRIX_ROWS):
+        nodes = list(paths)
+        ids = {node: i for i, node in enumerate(nodes)}
+        for node in list(paths):
+            for neighbor in paths[node]:
+                if neighbor not in ids:
+                    ids[neighbor] = len(nodes)
+                    nodes.append(neighbor)
+        backward = [[] for _ in nodes]
+        for node, neighbors in paths.items():
+            weights = distances.get(node, {}) if distances is not None else None
+            for neighbor in neighbors:
+                weight = 1 if weights is None else weights.get(neighbor)
+                if weight is None:
+                    raise ValueError(f"Falta la distancia del tramo {node} -> {neighbor}")
+                backward[ids[neighbor]].append((ids[node], weight))
+        self.nodes = nodes
+        self.ids = ids
+        self.backward = backward
+        self.rows = _Memo(max_rows)
+
+    def row(self, target):
+        """Devolver la lista de distancias de cada nodo (por id) hasta
+        target, calculándola si hace falta, o None si target no está en el
+        grafo."""
+        t = self.ids.get(target)
+        if t is None:
+            return None
+        row = self.rows.get(t)
+        if row is None:
+            row = WeightedRouteIndex._dijkstra(self.backward, t)
+            self.rows.put(t, row)
+        return row
+
+    def distance(self, start, end):
+        """Devolver la distancia mínima de start a end, o None si no hay ruta.
+        Si la fila de end no está calculada no se calcula entera: el
+        Dijkstra desde end se para al llegar a start."""
+        ids = self.ids
+        s, t = ids.get(start), ids.get(end)
+        if s is None or t is None:
+            return None
+        row = self.rows.get(t)
+        d = row[s] if row is not None else self._search(s, t)
+        return None if d == _INF else d
+
+    def _search(self, s, t):
+        backward = self.backward
+        dist = {t: 0}
+        heap = [(0, t)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u == s:
+                return d
+            if d > dist[u]:
+                continue
+            for v, w in backward[u]:
+                nd = d + w
+                if nd < dist.get(v, _INF):
+                    dist[v] = nd
+                    heapq.heappush(heap, (nd, v))
+        return _INF
+
+    def nearest(self, locations, target):
+        """Devolver la posición en locations de la ubicación más cercana a
+        target (la primera si hay empate), o None si ninguna llega a target."""
+        row = self.row(target) if locations else None
+        if row is None:
+            return None
+        ids = self.ids
+        column = [row[ids[loc]] if loc in ids else _INF for loc in locations]
+        best = min(range(len(column)), key=column.__getitem__)
+        return None if column[best] == _INF else best
+
+
+class Components:
+    """Componentes conexas de la unión de uno o varios grafos, sin tener en
+    cuenta el sentido de los tramos: dos ubicaciones están en la misma
+    componente si hay un camino entre ellas en algún sentido."""
+
+    def __init__(self, *graphs):
+        parent = {}
+
+        def find(node):
+            root = node
+            while parent[root] != root:
+                root = parent[root]
+            while parent[node] != root:
+                parent[node], node = root, parent[node]
+            return root
+
+        for paths in graphs:
+            for node, neighbors in paths.items():
+                parent.setdefault(node, node)
+                for neighbor in neighbors:
+                    parent.setdefault(neighbor, neighbor)
+                    a, b = find(node), find(neighbor)
+                    if a != b:
+                        parent[a] = b
+        self.component = {node: find(node) for node in parent}
+
+    def of(self, location):
+        """Devolver el representante de la componente de location, o None
+        si no está en ningún grafo."""
+        return self.component.get(location)
+
+    def same(self, location1, location2):
+        """Comprobar si location1 y location2 están en la misma componente."""
+        component = self.component.get(location1)
+        return component is not None and component == self.component.get(location2)
+
+
+def _graph(value):
+    return value.base if isinstance(value, pyhop.CowDict) else value
+
+
+def _snapshot(value):
+    return {node: (dict(neighbors) if isinstance(neighbors, dict) else list(neighbors))
+            for node, neighbors in value.items()}
+
+
+def _existing_index(build, graphs):
+    """El índice de build para graphs si ya está construido y sigue valiendo, o None."""
+    key = (build,) + tuple(id(graph) for graph in graphs)
+    with _indexes_lock:
+        entry = _indexes.get(key)
+        if entry is not None:
+            cached, snapshots, index = entry
+            if (all(a is b for a, b in zip(cached, graphs)) and
+                    all(snap is None or snap == graph for snap, graph in zip(snapshots, graphs))):
+                _indexes.move_to_end(key)
+                return index
+    return None
+
+
+def _cached_index(build, *graphs):
+    """Devolver el índice construido por build(*graphs), reutilizándolo
+    mientras los grafos sean los mismos objetos y no hayan cambiado.
+    Los grafos estáticos (pyhop.declare_static) se identifican por referencia,
+    en O(1); los demás se comparan con la copia a partir de la que se
+    indexaron, lo que cuesta O(E) en cada llamada, así que conviene declarar
+    estáticos los grafos que se consultan muchas veces.
+    Se puede llamar desde varios hilos a la vez."""
+    graphs = tuple(_graph(graph) for graph in graphs)
+    index = _existing_index(build, graphs)
+    if index is not None:
+        return index
+    snapshots = tuple(None if pyhop.is_static(graph) else _snapshot(graph) for graph in graphs)
+    index = build(*(graph if snap is None else snap for graph, snap in zip(graphs, snapshots)))
+    key = (build,) + tuple(id(graph) for graph in graphs)
+    with _indexes_lock:
+        _indexes[key] = (graphs, snapshots, index)
+        _indexes.move_to_end(key)
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def route_index(paths):
+    """Devolver el RouteIndex (BFS) del grafo paths, construyéndolo si hace falta."""
+    return _cached_index(RouteIndex, paths)
+
+
+def weighted_route_index(paths, distances):
+    """Devolver el WeightedRouteIndex del grafo paths con pesos distances."""
+    return _cached_index(WeightedRouteIndex, paths, distances)
+
+
+def distance_matrix(paths, distances=None):
+    """Devolver la DistanceMatrix del grafo paths (con pesos distances, si
+    se dan), construyéndola si hace falta."""
+    if distances is None:
+        return _cached_index(DistanceMatrix, paths)
+    return _cached_index(DistanceMatrix, paths, distances)
+
+
+def components(*graphs):
+    """Devolver las Components de la unión de graphs, calculándolas si hace falta."""
+    return _cached_index(Components, *graphs)
+
+
+def carry_distance_rows(old_paths, old_distances, new_paths, new_distances=None):
+    """Después de cambiar el grafo old_paths (con pesos old_distances o
+    None) por new_paths, pasar a la DistanceMatrix del grafo nuevo las filas
+    ya calculadas en la del viejo que el cambio no altera, para no repetir
+    sus Dijkstra. Una fila (distancias hasta un destino) sigue valiendo si
+    ningún tramo quitado o alargado estaba en un camino mínimo hasta el
+    destino y ningún tramo nuevo o acortado da uno más corto. Cuesta
+    O(tramos cambiados) por fila. Devolver el número de filas pasadas."""
+    def graphs(paths, distances):
+        return (paths,) if distances is None else (paths, distances)
+    old = _existing_index(DistanceMatrix, tuple(_graph(g) for g in graphs(old_paths, old_distances)))
+    if old is None or not old.rows.entries:
+        return 0
+    new = distance_matrix(new_paths, new_distances)
+    if new.nodes != old.nodes:
+        return 0
+
+    def edges(paths, distances, node):
+        weights = distances.get(node, {}) if distances is not None else None
+        return {v: 1 if weights is None else weights[v] for v in paths.get(node, ())}
+
+    removed, added = [], []
+    ids = old.ids
+    for node in set(old_paths) | set(new_paths):
+        before = edges(old_paths, old_distances, node)
+        after = edges(new_paths, new_distances, node)
+        if before == after:
+            continue
+        u = ids[node]
+        removed += [(u, ids[v], w) for v, w in before.items() if after.get(v) != w]
+        added += [(u, ids[v], w) for v, w in after.items() if before.get(v) != w]
+    with old.rows.lock:
+        rows = list(old.rows.entries.items())
+    carried = 0
+    for t, row in rows:
+        if any(row[v] < _INF and row[u] == row[v] + w for u, v, w in removed):
+            continue
+        if any(row[v] + w < row[u] for u, v, w in added):
+            continue
+        new.rows.put(t, row)
+        carried += 1
+    return carried
+
+
+def state_distance_matrix(state, path_type='driving'):
+    """Devolver la DistanceMatrix del estado para path_type ('driving' o
+    'walking'), con las distancias del estado para ese grafo si las tiene."""
+    paths = state.driving_paths if path_type == 'driving' else state.walking_paths
+    return distance_matrix(paths, getattr(state, f'{path_type}_distances', None))
+
+
+def state_route_index(state, path_type='driving'):
+    """Devolver el índice de rutas del estado para path_type ('driving' o
+    'walking'): ponderado si el estado tiene distancias para ese grafo."""
+    paths = state.driving_paths if path_type == 'driving' else state.walking_paths
+    distances = getattr(state, f'{path_type}_distances', None)
+    if distances is None:
+        return route_index(paths)
+    return weighted_route_index(paths, distances)
+
+
+def clear_route_indexes():
+    """Olvidar todos los índices de rutas construidos."""
+    with _indexes_lock:
+        _indexes.clear()